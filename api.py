@@ -1,9 +1,12 @@
 import os
 import sys
+import json
 import time
 import pickle
 import logging
 from redminelib import Redmine
+from request_schema import validate_request
+from automators.worker_queue import live_workers, queue_job, requeue_orphans, take_stale_jobs
 from settings import AUTOMATOR_KEYWORDS, API_KEY, BIO_REQUESTS_DIR
 
 
@@ -199,6 +202,19 @@ def submit_slurm_job(redmine_instance, issue, work_dir, cmd, job_type, cpu_count
     logging.info('Output for {} is available in {}'.format(issue.id, work_dir))
 
 
+def reject_request(redmine_instance, issue, notes):
+    """
+    Closes off a request that failed validation, without anything being sent to the cluster
+    :param redmine_instance: instantiated Redmine API object
+    :param issue: object pulled from Redmine instance
+    :param notes: string explaining what is wrong with the request
+    """
+    redmine_instance.issue.update(resource_id=issue.id,
+                                  status_id=4,
+                                  notes=notes)
+    logging.info('Rejected {} before submission: {}'.format(issue.id, notes))
+
+
 def prepare_automation_command(automation_script, pickles, work_dir):
     """
     Function for preparing the system call to an automation script
@@ -224,6 +240,137 @@ def prepare_automation_command(automation_script, pickles, work_dir):
     return cmd
 
 
+def submit_worker_job(redmine_instance, issue, work_dir, pickles, job_type):
+    """
+    Hands a job to the resident workers for its automator instead of SLURM
+    :param redmine_instance: instantiated Redmine API object
+    :param issue: object pulled from Redmine instance
+    :param work_dir: string path to working directory for Redmine job
+    :param pickles: dictionary from the pickle_redmine() function
+    :param job_type: string containing job type
+    """
+    redmine_instance.issue.update(resource_id=issue.id,
+                                  status_id=2,
+                                  notes='Your {} job has been submitted to the OLC automator workers.'.format(
+                                      job_type.upper()))
+    logging.info('Updated job status for {} to In Progress'.format(issue.id))
+
+    manifest = queue_job(job_type, {'redmine_instance': pickles['redmine_instance'],
+                                    'issue': pickles['issue'],
+                                    'description': pickles['description'],
+                                    'work_dir': work_dir})
+    logging.info('Queued {} for the {} workers: {}'.format(issue.id, job_type.upper(), manifest))
+
+
+def prepare_batch_command(job_type, manifest):
+    """
+    Function for preparing the system call that runs a batch of issues through one automator
+    :param job_type: string containing job type (i.e. 'ec_typer')
+    :param manifest: path to the batch manifest written by submit_slurm_batch()
+    :return: string of completed command to pass to the batch runner
+    """
+    batch_runner_path = os.path.join(os.path.dirname(__file__), 'automators', 'batch_runner.py')
+    cmd = 'python {script} --automator {automator} --manifest {manifest}'.format(script=batch_runner_path,
+                                                                                automator=job_type,
+                                                                                manifest=manifest)
+    return cmd
+
+
+def submit_slurm_batch(redmine_instance, batch, job_type):
+    """
+    Submits every issue waiting in a batch as a single SLURM job. The job script, manifest and SLURM output go in the
+    work directory of the first issue in the batch - each issue's own output is written to batch.log in its work
+    directory by the batch runner. A batch with only one issue in it is submitted the same way as any other issue
+    :param redmine_instance: instantiated Redmine API object
+    :param batch: list of dictionaries with the issue, its work_dir and its pickles, in the order they came in
+    :param job_type: string containing job type
+    """
+    if len(batch) == 1:
+        cmd = prepare_automation_command(automation_script=job_type + '.py',
+                                         pickles=batch[0]['pickles'],
+                                         work_dir=batch[0]['work_dir'])
+        submit_slurm_job(redmine_instance=redmine_instance,
+                         issue=batch[0]['issue'],
+                         work_dir=batch[0]['work_dir'],
+                         cmd=cmd,
+                         job_type=job_type,
+                         cpu_count=AUTOMATOR_KEYWORDS[job_type]['n_cpu'],
+                         memory=AUTOMATOR_KEYWORDS[job_type]['memory'])
+        return
+
+    # Write the manifest the batch runner works through
+    manifest = os.path.join(batch[0]['work_dir'], 'batch_manifest.json')
+    with open(manifest, 'w') as file:
+        json.dump([{'redmine_instance': job['pickles']['redmine_instance'],
+                    'issue': job['pickles']['issue'],
+                    'description': job['pickles']['description'],
+                    'work_dir': job['work_dir']} for job in batch], file, indent=4)
+
+    # Set status of every issue in the batch to In Progress
+    for job in batch:
+        redmine_instance.issue.update(resource_id=job['issue'].id,
+                                      status_id=2,
+                                      notes='Your {} job has been submitted to the OLC Slurm cluster.'.format(
+                                          job_type.upper()))
+
+    slurm_template = create_template(issue=batch[0]['issue'],
+                                     cpu_count=AUTOMATOR_KEYWORDS[job_type]['n_cpu'],
+                                     memory=AUTOMATOR_KEYWORDS[job_type]['memory'],
+                                     work_dir=batch[0]['work_dir'],
+                                     cmd=prepare_batch_command(job_type=job_type, manifest=manifest))
+
+    issue_ids = ', '.join(str(job['issue'].id) for job in batch)
+    logging.info('Submitting {} batch of {} to Slurm'.format(job_type.upper(), issue_ids))
+    os.system('sbatch ' + slurm_template)
+    logging.info('Output for {} is available in {}'.format(issue_ids, batch[0]['work_dir']))
+
+
+def submit_ready_batches(redmine_instance, batches):
+    """
+    Submits each batch that has been open for its automator's batch_window (in seconds), or has reached its batch_size
+    :param redmine_instance: instantiated Redmine API object
+    :param batches: dictionary of job type: {'started': time the first issue came in, 'jobs': list of issues}. Batches
+                    that are submitted are removed from it
+    """
+    for job_type in list(batches):
+        batch = batches[job_type]
+        settings = AUTOMATOR_KEYWORDS[job_type]
+        if time.time() - batch['started'] >= settings['batch_window'] or \
+                len(batch['jobs']) >= settings.get('batch_size', 20):
+            submit_slurm_batch(redmine_instance=redmine_instance, batch=batch['jobs'], job_type=job_type)
+            del batches[job_type]
+            logging.info('----' * 12)
+
+
+def submit_stale_worker_jobs(redmine_instance):
+    """
+    Jobs held by workers that have died are put back in their queue, and anything that has been waiting on the workers
+    for longer than worker_queue.PENDING_TIMEOUT (i.e. because every worker went down after it was queued) is sent to
+    SLURM instead
+    :param redmine_instance: instantiated Redmine API object
+    """
+    for job_type, settings in AUTOMATOR_KEYWORDS.items():
+        if not settings.get('worker'):
+            continue
+        for requeued in requeue_orphans(job_type):
+            logging.info('Requeued {} for the {} workers'.format(requeued, job_type.upper()))
+        for job in take_stale_jobs(job_type):
+            with open(job['issue'], 'rb') as f:
+                issue = pickle.load(f)
+            logging.info('No {} worker picked up {}, sending it to Slurm'.format(job_type.upper(), issue.id))
+            cmd = prepare_automation_command(automation_script=job_type + '.py',
+                                             pickles=job,
+                                             work_dir=job['work_dir'])
+            submit_slurm_job(redmine_instance=redmine_instance,
+                             issue=issue,
+                             work_dir=job['work_dir'],
+                             cmd=cmd,
+                             job_type=job_type,
+                             cpu_count=settings['n_cpu'],
+                             memory=settings['memory'])
+            logging.info('----' * 12)
+
+
 def main():
     """
     USAGE:
@@ -247,6 +394,10 @@ def main():
     # Greetings
     logging.info('OLCRedmineAutomator is actively monitoring for new jobs')
 
+    # Issues for automators with a batch_window that are waiting for their batch to be submitted. They stay New
+    # until then, so they're skipped when they come up again
+    batches = dict()
+
     # Continually monitor for new jobs
     while True:
         # Grab all issues belonging to CFIA
@@ -254,10 +405,13 @@ def main():
 
         # Pull any new automation job requests from issues
         new_jobs = new_automation_jobs(issues)
+        waiting = set(batch_job['issue'].id for batch in batches.values() for batch_job in batch['jobs'])
 
         if len(new_jobs) > 0:
             # Queue up a SLURM job for each new issue
             for job, job_type in new_jobs.items():
+                if job.id in waiting:
+                    continue
                 logging.info('Detected {} job for Redmine issue {}'.format(job_type.upper(), job.id))
 
                 # Grab work directory
@@ -269,12 +423,36 @@ def main():
                 # Pull issue description
                 description = retrieve_issue_description(job)
 
+                # Malformed requests are turned away here rather than taking up a node to find out
+                rejection = validate_request(issue=job, job_type=job_type, description=description)
+                if rejection is not None:
+                    reject_request(redmine_instance=redmine, issue=job, notes=rejection)
+                    logging.info('----' * 12)
+                    continue
+
                 # Pickle objects for usage by analysis scripts
                 pickles = pickle_redmine(redmine_instance=redmine,
                                          issue=job,
                                          work_dir=work_dir,
                                          description=description)
 
+                # Automators with resident workers skip SLURM altogether whenever one of their workers is up
+                if AUTOMATOR_KEYWORDS[job_type].get('worker') and live_workers(job_type) > 0:
+                    submit_worker_job(redmine_instance=redmine,
+                                      issue=job,
+                                      work_dir=work_dir,
+                                      pickles=pickles,
+                                      job_type=job_type)
+                    logging.info('----' * 12)
+                    continue
+
+                # Small jobs can wait to share a SLURM job with others of the same type
+                if AUTOMATOR_KEYWORDS[job_type].get('batch_window'):
+                    batches.setdefault(job_type, {'started': time.time(), 'jobs': list()})['jobs'].append(
+                        {'issue': job, 'work_dir': work_dir, 'pickles': pickles})
+                    logging.info('Added {} to the {} batch'.format(job.id, job_type.upper()))
+                    continue
+
                 # Prepare command
                 cmd = prepare_automation_command(automation_script=job_type + '.py',
                                                  pickles=pickles,
@@ -305,6 +483,12 @@ def main():
                                      memory=memory)
                 logging.info('----' * 12)
 
+        # Submit batches that have finished collecting issues
+        submit_ready_batches(redmine_instance=redmine, batches=batches)
+
+        # Fall back to SLURM for worker jobs that aren't getting picked up
+        submit_stale_worker_jobs(redmine_instance=redmine)
+
         # Pause for 30 seconds
         time.sleep(30)
 
@@ -1,12 +1,17 @@
 import os
 import re
+import sys
 import glob
 import click
 import pickle
 import shutil
-import sentry_sdk
 from automator_settings import COWBAT_DATABASES, SENTRY_DSN
-from nastools.nastools import retrieve_nas_files
+from result_cache import ResultCache, database_version
+from lazy_import import lazy_import, lazy_function
+sentry_sdk = lazy_import('sentry_sdk')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
+# Set once capture_exception has initialized Sentry
+SENTRY_STARTED = list()
 
 
 def before_send(event, hint):
@@ -24,13 +29,49 @@ def before_send(event, hint):
         return event
 
 
+def capture_exception(exception):
+    """
+    Reports an exception to Sentry. Sentry is only set up the first time something goes wrong, so jobs that run
+    cleanly never pay for importing and starting it
+    :param exception: the exception to report
+    """
+    if not SENTRY_STARTED:
+        sentry_sdk.init(SENTRY_DSN, before_send=before_send)
+        SENTRY_STARTED.append(True)
+    sentry_sdk.capture_exception(exception)
+
+
+def report_uncaught(exception_type, exception, traceback):
+    """
+    sys.excepthook that reports exceptions nothing caught (i.e. a pickle that won't load, or a failed import) to Sentry
+    before printing them as usual. Once Sentry has been started it installs its own hook ahead of this one, which has
+    already reported the exception by the time it gets here
+    """
+    if not SENTRY_STARTED and not issubclass(exception_type, KeyboardInterrupt):
+        try:
+            capture_exception(exception)
+        except Exception:  # Reporting must never hide the original error
+            pass
+    sys.__excepthook__(exception_type, exception, traceback)
+
+
+def report_uncaught_exceptions():
+    """
+    Sends every uncaught exception in this process to Sentry, without starting Sentry until there is one. Done for every
+    automator when it imports this module
+    """
+    sys.excepthook = report_uncaught
+
+
+report_uncaught_exceptions()
+
+
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
 @click.option('--issue', help='Path to pickled Redmine issue')
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def resfinder_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     # Unpickle Redmine objects
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
     issue = pickle.load(open(issue, 'rb'))
@@ -56,33 +97,50 @@ def resfinder_redmine(redmine_instance, issue, work_dir, description):
 
         # Use the COWBAT_DATABASES variable as the database path
         db_path = COWBAT_DATABASES
-        # Run ResFindr
-        cmd = 'GeneSeekr blastn -s {seqfolder} -t {targetfolder} -r {reportdir} -A'\
-            .format(seqfolder=work_dir,
-                    targetfolder=os.path.join(db_path, 'resfinder'),
-                    reportdir=os.path.join(work_dir, 'reports'))
-        # Update the issue with the ResFinder command
-        redmine_instance.issue.update(resource_id=issue.id,
-                                      notes='ResFinder command:\n {cmd}'.format(cmd=cmd))
-        os.system(cmd)
-        # These unfortunate hard coded paths appear to be necessary
-        activate = 'source /home/ubuntu/miniconda3/bin/activate /mnt/nas2/virtual_environments/cowbat'
-        # Run sipprverse with the necessary arguments
-        mob_cmd = 'python -m spadespipeline.mobrecon -s {seqfolder} -r {targetfolder}' \
-            .format(seqfolder=work_dir,
-                    targetfolder=os.path.join(db_path, 'mobrecon'))
-        # Update the issue with the MOB Recon command
-        redmine_instance.issue.update(resource_id=issue.id,
-                                      notes='MOB Recon command:\n {cmd}'.format(cmd=mob_cmd))
-        # Create another shell script to execute within the PlasmidExtractor conda environment
-        template = "#!/bin/bash\n{} && {}".format(activate, mob_cmd)
-        mob_script = os.path.join(work_dir, 'run_mob_recon.sh')
-        with open(mob_script, 'w+') as file:
-            file.write(template)
-        # Modify the permissions of the script to allow it to be run on the node
-        make_executable(mob_script)
-        # Run shell script
-        os.system(mob_script)
+        # Only assemblies without cached ResFinder, MOB Recon and AMR summary rows are analysed
+        fasta_dict = dict()
+        for fasta in glob.glob(os.path.join(work_dir, '*.fasta')):
+            fasta_dict[os.path.splitext(os.path.basename(fasta))[0]] = fasta
+
+        def run_amrsummary(seqfolder, reportdir):
+            # Run ResFindr
+            cmd = 'GeneSeekr blastn -s {seqfolder} -t {targetfolder} -r {reportdir} -A'\
+                .format(seqfolder=seqfolder,
+                        targetfolder=os.path.join(db_path, 'resfinder'),
+                        reportdir=reportdir)
+            # Update the issue with the ResFinder command
+            redmine_instance.issue.update(resource_id=issue.id,
+                                          notes='ResFinder command:\n {cmd}'.format(cmd=cmd))
+            os.system(cmd)
+            # These unfortunate hard coded paths appear to be necessary
+            activate = 'source /home/ubuntu/miniconda3/bin/activate /mnt/nas2/virtual_environments/cowbat'
+            # Run sipprverse with the necessary arguments
+            mob_cmd = 'python -m spadespipeline.mobrecon -s {seqfolder} -r {targetfolder}' \
+                .format(seqfolder=seqfolder,
+                        targetfolder=os.path.join(db_path, 'mobrecon'))
+            # Update the issue with the MOB Recon command
+            redmine_instance.issue.update(resource_id=issue.id,
+                                          notes='MOB Recon command:\n {cmd}'.format(cmd=mob_cmd))
+            # Create another shell script to execute within the PlasmidExtractor conda environment
+            template = "#!/bin/bash\n{} && {}".format(activate, mob_cmd)
+            mob_script = os.path.join(work_dir, 'run_mob_recon.sh')
+            with open(mob_script, 'w+') as file:
+                file.write(template)
+            # Modify the permissions of the script to allow it to be run on the node
+            make_executable(mob_script)
+            # Run shell script
+            os.system(mob_script)
+        cache = ResultCache(automator='amrsummary',
+                            parameters={'analysis': 'resfinder', 'blast': 'blastn'},
+                            db_version=database_version(os.path.join(db_path, 'resfinder')) +
+                            database_version(os.path.join(db_path, 'mobrecon')))
+        try:
+            cache.combined_reports(fasta_dict=fasta_dict,
+                                   report_dir=os.path.join(work_dir, 'reports'),
+                                   work_dir=work_dir,
+                                   analyse=run_amrsummary)
+        finally:
+            cache.close()
         # Get the output file uploaded.
         output_list = list()
         output_dict = dict()
@@ -111,7 +169,7 @@ def resfinder_redmine(redmine_instance, issue, work_dir, description):
         except IOError:
             pass
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -2,10 +2,9 @@ import os
 import glob
 import click
 import pickle
-import sentry_sdk
-from amrsummary import before_send
-from automator_settings import SENTRY_DSN
-from nastools.nastools import retrieve_nas_files
+from amrsummary import capture_exception
+from lazy_import import lazy_function
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
@@ -13,7 +12,6 @@ from nastools.nastools import retrieve_nas_files
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def clark_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     # Unpickle Redmine objects
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
     issue = pickle.load(open(issue, 'rb'))
@@ -84,7 +82,7 @@ def clark_redmine(redmine_instance, issue, work_dir, description):
         # Clean up all FASTA/FASTQ files so we don't take up too
         os.system('rm {workdir}/*fasta {workdir}/*fastq*'.format(workdir=work_dir))
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -4,12 +4,18 @@ import os
 import re
 import click
 import pickle
-import pylatex as pl
+import hashlib
+import subprocess
 import autoroga_extract_report_data as extract_report_data
 
 from datetime import datetime
-from pylatex.utils import bold, italic
-from autoroga_database import update_db
+from concurrent.futures import ThreadPoolExecutor
+from autoroga_request import lab_info, permitted_users, parse_request
+from lazy_import import lazy_import, lazy_function
+pl = lazy_import('pylatex')
+update_db = lazy_function('autoroga_database', 'update_db')
+bold = lazy_function('pylatex.utils', 'bold')
+italic = lazy_function('pylatex.utils', 'italic')
 
 """
 This script receives input from a CFIA Redmine issue and will generate a ROGA using associated assembly data.
@@ -28,6 +34,9 @@ The Redmine issue description input must be formatted as follows:
     SEQID
     ... etc.
 
+Several reports can be requested in one issue by separating their descriptions with a line containing only ---.
+The reports share one read of the metadata, are compiled at the same time, and are all attached to the issue together.
+
 A note on Sample IDs:
 LSTS ID should be parsed from SampleSheet.csv by the COWBAT pipeline, and is available within the combinedMetadata.csv
 file. The LSTS ID is available under the 'SampleName' column in combinedMetadata.csv
@@ -37,19 +46,6 @@ line at the end of the description that says FORCE in order to make the automato
 
 """
 
-lab_info = {
-    'GTA': ('2301 Midland Ave., Scarborough, ON, M1P 4R7', '416-952-3203'),
-    'BUR': ('3155 Willington Green, Burnaby, BC, V5G 4P2', '604-292-6028'),
-    'OLC': ('960 Carling Ave, Building 22 CEF, Ottawa, ON, K1A 0Y9', '613-759-1267'),
-    'FFFM': ('960 Carling Ave, Building 22 CEF, Ottawa, ON, K1A 0Y9', '613-759-1220'),
-    'DAR': ('1992 Agency Dr., Dartmouth, NS, B2Y 3Z7', '902-536-1012'),
-    'CAL': ('3650 36 Street NW, Calgary, AB, T2L 2L1', '403-338-5200'),
-    'STH': ('3400 Casavant Boulevard W., St. Hyacinthe, QC, J2S 8E3', '450-768-6800')
-}
-
-# User level security to ensure only permitted users can submit AutoROGA requests
-# Permitted users - Andrew, Adam, Julie, Cathy, Paul, Martine, Ray.
-permitted_users = [296, 106, 429, 225, 226, 448, 529]
 
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
@@ -71,166 +67,90 @@ def redmine_roga(redmine_instance, issue, work_dir, description):
                                             'If you think you should be authorized, please contact andrew.low@canada.ca')
         quit()
 
-    # Setup
-    amended_report_id = None
-    lab = None
-    genus = None
-    source = None
-    seqids = None
-    lstsids = None
-    seq_lsts_dict = None
-
-    # Remove all newlines/empty lines from the description items
-    description = [x for x in description if x != '']
-
-    # Amendment functionality
-    amendment_flag = False
-    force_flag = False
-    amendment_check = description[0].upper()
-    if 'AMENDMENT' in amendment_check:
-        amendment_flag = True
-    if 'FORCE' in description[-1].upper():
-        force_flag = True
-        description.pop()
-
-    # Parse fields
-    if amendment_flag is False:
-        # Parse lab ID
-        lab = description[0]
-        # Verify lab ID
-        if lab not in lab_info:
-            valid_labs = str([x for x, y in lab_info.items()])
-            redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                          notes='ERROR: Invalid Lab ID provided. Please ensure the first line of your '
-                                                'Redmine description specifies one of the following labs:\n'
-                                                '{}\n'
-                                                'Your input: {}'.format(valid_labs, description))
-            quit()
-
-        # Parse source
-        source = description[1].lower()
-        # Quick verification check to make sure this line isn't a Seq ID. This is brittle and should be changed.
-        if len(source.split('-')) > 2:
-            redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                          notes='ERROR: Invalid source provided. '
-                                                'Line 2 of the Redmine description must be a valid string e.g. "flour"')
-            quit()
-
-        # Parse genus
-        genus = description[2].capitalize()
-        if genus not in ['Escherichia', 'Salmonella', 'Listeria', 'Vibrio']:
-            redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                          notes='ERROR: Input genus "{}" does not match any of the acceptable values'
-                                                ' which include: "Escherichia", "Salmonella", "Listeria", "Vibrio"'.format(genus))
-            quit()
+    # Parse fields. Several reports can be requested in one issue by separating them with a line of ---
+    try:
+        report_specs, force_flag = parse_request(description)
+    except ValueError as e:
+        redmine_instance.issue.update(resource_id=issue.id, status_id=4, notes=str(e))
+        quit()
 
-        # Parse Seq IDs
-        # NOTE: Now should have SeqID;LSTSID format
-        try:
-            seqids, lstsids = parse_seqid_list(description)
-        except:
-            redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                          notes='ERROR: Could not pair Seq IDs and LSTS IDs from the provided '
-                                                'description. Confirm that each sample follows the required format '
-                                                'of [SEQID; LSTSID] or [SEQID   LSTSID] for each line.')
-            quit()
+    # Reports for every Seq ID in the request are only looked up and read once, and shared between validation and
+    # report generation
+    all_seqids = list()
+    for report_spec in report_specs:
+        all_seqids += [seqid for seqid in report_spec['seqids'] if seqid not in all_seqids]
+    report_context = extract_report_data.ReportContext(all_seqids)
 
-        seq_lsts_dict = dict(zip(seqids, lstsids))
+    for report_spec in report_specs:
+        genus = report_spec['genus']
+        seqids = report_spec['seqids']
 
-    elif amendment_flag:
+        # Validate Seq IDs
+        validated_list = []
         try:
-            amended_report_id = amendment_check.split(':')[1]
-        except IndexError:
-            redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                          notes='ERROR: Could not parse AutoROGA ID from AMENDMENT field.\n'
-                                                'Must be formatted as follows: AMENDMENT:ROGAID')
-            quit()
-
-        # Parse lab ID
-        lab = description[1]
-        if lab not in lab_info:
-            valid_labs = str([x for x, y in lab_info.items()])
-            redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                          notes='ERROR: Invalid Lab ID provided. Please ensure the first line of your '
-                                                'Redmine description specifies one of the following labs:\n'
-                                                '{}'.format(valid_labs))
-            quit()
-
-        # Parse source
-        source = description[2].lower()
-        if len(source.split('-')) > 2:
+            validated_list = extract_report_data.generate_validated_list(seq_list=seqids, genus=genus,
+                                                                         report_context=report_context)
+        except KeyError as e:
             redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                          notes='ERROR: Invalid source provided. '
-                                                'Line 2 of the Redmine description must be a valid string e.g. "flour"')
+                                          notes='ERROR: Could not find one or more of the provided Seq IDs on the NAS.\n'
+                                                'TRACEBACK: {}'.format(e))
             quit()
 
-        # Parse genus
-        genus = description[3].capitalize()
-        if genus not in ['Escherichia', 'Salmonella', 'Listeria']:
+        if len(validated_list) == 0:
             redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                          notes='ERROR: Input genus "{}" does not match any of the acceptable values'
-                                                ' which include: "Escherichia", "Salmonella", "Listeria"'.format(genus))
+                                          notes='ERROR: No samples provided matched the expected genus '
+                                                '"{}"'.format(genus.upper()))
             quit()
 
-        # Parse Seq IDs
-        try:
-            seqids, lstsids = parse_seqid_list(description, starting_row=4)
-        except:
+        if validated_list != seqids:
             redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                          notes='ERROR: Could not pair Seq IDs and LSTS IDs from the provided '
-                                                'description. Confirm that each sample follows the required format '
-                                                'of [SEQID; LSTSID] or [SEQID   LSTSID] for each line.')
+                                          notes='ERROR: Could not validate SeqIDs.\nValidated list: {}\nSeqList: {}'
+                                          .format(validated_list, seqids))
             quit()
-        seq_lsts_dict = dict(zip(seqids, lstsids))
-
-    # Validate Seq IDs
-    validated_list = []
-    try:
-        validated_list = extract_report_data.generate_validated_list(seq_list=seqids, genus=genus)
-    except KeyError as e:
-        redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                      notes='ERROR: Could not find one or more of the provided Seq IDs on the NAS.\n'
-                                            'TRACEBACK: {}'.format(e))
-        quit()
-
-    if len(validated_list) == 0:
-        redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                      notes='ERROR: No samples provided matched the expected genus '
-                                            '"{}"'.format(genus.upper()))
-        quit()
 
-    if validated_list != seqids:
-        redmine_instance.issue.update(resource_id=issue.id, status_id=4,
-                                      notes='ERROR: Could not validate SeqIDs.\nValidated list: {}\nSeqList: {}'
-                                      .format(validated_list, seqids))
-        quit()
+    # GENERATE REPORTS - the LaTeX for every report is written first, and then all of them are compiled at once
+    pdf_files = list()
+    idiot_proof = list()
+    for report_spec in report_specs:
+        pdf_file, report_idiot_proof = generate_roga(seq_lsts_dict=report_spec['seq_lsts_dict'],
+                                                     genus=report_spec['genus'],
+                                                     lab=report_spec['lab'],
+                                                     source=report_spec['source'],
+                                                     work_dir=work_dir,
+                                                     amendment_flag=report_spec['amendment_flag'],
+                                                     amended_id=report_spec['amended_report_id'],
+                                                     report_context=report_context.subset(report_spec['seqids']),
+                                                     compile_pdf=False)
+        pdf_files.append(pdf_file)
+        idiot_proof += report_idiot_proof
+    with report_context.phase('pdf build'):
+        compile_reports([os.path.splitext(pdf_file)[0] for pdf_file in pdf_files], work_dir)
+    print('AutoROGA timings:\n{}'.format(report_context.timing_report()))
 
-    # GENERATE REPORT
-    pdf_file, idiot_proof = generate_roga(seq_lsts_dict=seq_lsts_dict,
-                                          genus=genus,
-                                          lab=lab,
-                                          source=source,
-                                          work_dir=work_dir,
-                                          amendment_flag=amendment_flag,
-                                          amended_id=amended_report_id)
     if len(idiot_proof) > 0 and force_flag is False:
         redmine_instance.issue.update(resource_id=issue.id, status_id=4,
                                       notes='The following issues were found while creating the report:\n\n{}\n\nIf you really want to make '
                                             'this ROGA, add the FORCEFLAG!'.format('\n'.join(idiot_proof)))
-    else:
-        # Output list containing dictionaries with file path as the key for upload to Redmine
-        output_list = [
-            {
-                'path': os.path.join(work_dir, pdf_file),
-                'filename': os.path.basename(pdf_file)
-            }
-        ]
+        return
+
+    # Output list containing dictionaries with file path as the key for upload to Redmine
+    output_list = [
+        {
+            'path': os.path.join(work_dir, pdf_file),
+            'filename': os.path.basename(pdf_file)
+        }
+        for pdf_file in pdf_files
+    ]
 
     redmine_instance.issue.update(resource_id=issue.id, uploads=output_list, status_id=4, assigned_to_id=529,  # Assign to Ray
-                                  notes='Generated ROGA successfully. Completed PDF report is attached.')
+                                  notes='Generated ROGA successfully. Completed PDF report is attached.'
+                                  if len(output_list) == 1 else
+                                  'Generated {} ROGAs successfully. Completed PDF reports are attached.'
+                                  .format(len(output_list)))
 
 
-def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, amended_id):
+def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, amended_id, report_context=None,
+                  compile_pdf=True):
     """
     Generates PDF
     :param seq_lsts_dict: Dict of SeqIDs;LSTSIDs
@@ -240,14 +160,20 @@ def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, a
     :param work_dir: bio_request directory
     :param amendment_flag: determined if the report is an amendment type or not (True/False)
     :param amended_id: ID of the original report that the new report is amending
+    :param report_context: ReportContext the Seq IDs were validated with, so the reports don't get read again
+    :param compile_pdf: compile the PDF here. If False, only the .tex is written, for compile_reports() to compile
     """
 
     # RETRIEVE DATAFRAMES FOR EACH SEQID
     seq_list = list(seq_lsts_dict.keys())
+    if report_context is None:
+        report_context = extract_report_data.ReportContext(seq_list)
 
-    metadata_reports = extract_report_data.get_combined_metadata(seq_list)
-    gdcs_reports = extract_report_data.get_gdcs(seq_list)
-    gdcs_dict = extract_report_data.generate_gdcs_dict(gdcs_reports)
+    metadata_reports = report_context.metadata_reports
+    gdcs_dict = extract_report_data.generate_gdcs_dict(report_context.gdcs_reports)
+    # Genus, marker and AMR checks for every sample, worked out together
+    sample_summary = report_context.summary
+    report_start = datetime.now()
 
     # Create our idiot proofing list. There are a bunch of things that can go wrong that should make us not send
     # out reports. As we go through data retrieval/report generation, add things that are wrong to the list, and users
@@ -273,8 +199,11 @@ def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, a
     doc.change_document_style("header")
 
     # DATABASE HANDLING
-    report_id = update_db(date=date, year=year, genus=genus, lab=lab, source=source,
-                          amendment_flag=amendment_flag, amended_id=amended_id)
+    database_start = datetime.now()
+    with report_context.phase('database'):
+        report_id = update_db(date=date, year=year, genus=genus, lab=lab, source=source,
+                              amendment_flag=amendment_flag, amended_id=amended_id)
+    database_seconds = (datetime.now() - database_start).total_seconds()
 
     # MARKER VARIABLES SETUP
     all_uida = False
@@ -287,7 +216,7 @@ def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, a
 
     # SECOND VALIDATION SCREEN
     if genus == 'Escherichia':
-        validated_ecoli_dict = extract_report_data.validate_ecoli(seq_list, metadata_reports)
+        validated_ecoli_dict = extract_report_data.validate_ecoli(seq_list, metadata_reports, sample_summary)
         vt_list = []
         uida_list = []
         hlya_list = []
@@ -322,7 +251,8 @@ def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, a
             some_vt = True
 
     elif genus == 'Listeria':
-        validated_listeria_dict = extract_report_data.validate_listeria(seq_list, metadata_reports)
+        validated_listeria_dict = extract_report_data.validate_listeria(seq_list, metadata_reports,
+                                                                           sample_summary)
         mono_list = []
         for key, value in validated_listeria_dict.items():
             mono_list.append(value)
@@ -332,7 +262,8 @@ def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, a
             all_mono = True
 
     elif genus == 'Salmonella':
-        validated_salmonella_dict = extract_report_data.validate_salmonella(seq_list, metadata_reports)
+        validated_salmonella_dict = extract_report_data.validate_salmonella(seq_list, metadata_reports,
+                                                                               sample_summary)
         enterica_list = []
         for key, value in validated_salmonella_dict.items():
             enterica_list.append(value)
@@ -342,7 +273,7 @@ def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, a
             all_enterica = True
 
     elif genus == 'Vibrio':
-        validated_vibrio_dict = extract_report_data.validate_vibrio(seq_list, metadata_reports)
+        validated_vibrio_dict = extract_report_data.validate_vibrio(seq_list, metadata_reports, sample_summary)
         vibrio_list = list()
         for key, value in validated_vibrio_dict.items():
             vibrio_list.append(value)
@@ -711,9 +642,8 @@ def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, a
         amr_samples = []  # keep track of which samples to create rows for
 
         # Grab AMR profile as a pre-check to see if we should even create the AMR Profile table
-        for sample_id, df in metadata_reports.items():
-            profile = df.loc[df['SeqID'] == sample_id]['AMR_Profile'].values[0]
-            parsed_profile = extract_report_data.parse_amr_profile(profile)
+        for sample_id in metadata_reports:
+            parsed_profile = sample_summary.at[sample_id, 'amr_profile']
             if parsed_profile is not None:
                 if genus == 'Salmonella':
                     amr_samples.append(sample_id)
@@ -744,12 +674,10 @@ def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, a
                     previous_resistance = 'akjsdhfasdf'
                     # For the AMR table, don't re-write sample id if same sample has multiple resistances
                     # Also, don't re-write resistances if same resistance has multiple genes.
-                    for sample_id, df in metadata_reports.items():
+                    for sample_id in metadata_reports:
                         if sample_id in amr_samples:
-                            # Grab AMR profile
-                            profile = df.loc[df['SeqID'] == sample_id]['AMR_Profile'].values[0]
-                            # Parse and iterate through profile to generate rows
-                            parsed_profile = extract_report_data.parse_amr_profile(profile)
+                            # Grab the parsed AMR profile and iterate through it to generate rows
+                            parsed_profile = sample_summary.at[sample_id, 'amr_profile']
                             if parsed_profile is not None:
                                 # Rows
                                 for value in parsed_profile:
@@ -871,53 +799,91 @@ def generate_roga(seq_lsts_dict, genus, lab, source, work_dir, amendment_flag, a
                                                "height=0.3in"],
                                       arguments=''))
 
+    report_context.timings['report layout'] = (report_context.timings.get('report layout', 0.0) +
+                                               (datetime.now() - report_start).total_seconds() - database_seconds)
+
     # OUTPUT PDF FILE
     pdf_file = os.path.join(work_dir, '{}_{}_{}'.format(report_id, genus, date))
 
-    try:
-        doc.generate_pdf(pdf_file, clean_tex=False)
-    except:
-        pass
+    if compile_pdf:
+        with report_context.phase('pdf build'):
+            try:
+                doc.generate_pdf(pdf_file, clean_tex=False)
+            except:
+                pass
+    else:
+        doc.generate_tex(pdf_file)
 
     pdf_file += '.pdf'
     return pdf_file, idiot_proofing_list
 
 
-def parse_seqid_list(description, starting_row=3):
-    seqids = list()
-    lstsids = list()
-
-    # Remove whitespace
-    description = [x.replace(' ', '') for x in description]
-
-    try:
-        for item in description[starting_row:]:
-            seqid_item = None
-            lstsid_item = None
-
-            # Accomodating pasting straight from Excel
-            if '\t' in item:
-                seqid_item = item.split('\t')[0]
-                lstsid_item = item.split('\t')[1]
-
-            # Manually delimiting IDs with a semicolon in the description
-            elif ';' in item:
-                seqid_item = item.split(';')[0]
-                lstsid_item = item.split(';')[1]
-
-            seqid_item = seqid_item.upper().strip()
-            lstsid_item = lstsid_item.upper().strip()
-
-            if seqid_item != '':
-                seqids.append(seqid_item)
-            if lstsid_item != '':
-                lstsids.append(lstsid_item)
-    except IndexError:
-        return None
-
-    seqids = tuple(seqids)
-    lstsids = tuple(lstsids)
-    return seqids, lstsids
+def build_preamble_format(tex_file, work_dir):
+    """
+    Dumps the preamble of a report (document class, packages, header with the logo) into a LaTeX format file with
+    mylatexformat, so each report compile can start from it instead of loading every package again
+    :param tex_file: Path to a report's .tex file
+    :param work_dir: Folder to write the format file into
+    :return: Name of the format, or None if it couldn't be built
+    """
+    with open(tex_file, 'r') as f:
+        preamble = f.read().split('\\begin{document}')[0]
+    format_name = 'roga_preamble_' + hashlib.sha1(preamble.encode()).hexdigest()[:12]
+    format_file = os.path.join(work_dir, format_name + '.fmt')
+    if not os.path.isfile(format_file):
+        with open(os.path.join(work_dir, format_name + '.tex'), 'w') as f:
+            f.write(preamble + '\\begin{document}\n\\end{document}\n')
+        subprocess.call(['pdflatex', '-ini', '-interaction=nonstopmode', '-jobname=' + format_name, '&pdflatex',
+                         'mylatexformat.ltx', format_name + '.tex'],
+                        cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if os.path.isfile(format_file):
+        return format_name
+    return None
+
+
+def compile_report(tex_prefix, work_dir, format_name=None, max_runs=3):
+    """
+    Compiles a report's .tex into a PDF with pdflatex, rerunning for as long as LaTeX asks for it (same as pylatex's
+    generate_pdf). Compile errors are ignored, as they were when generate_pdf was called directly
+    :param tex_prefix: Path to the report without the .tex extension
+    :param work_dir: Folder to compile in
+    :param format_name: Precompiled preamble format to start from, or None to compile the whole file
+    :param max_runs: Maximum number of pdflatex runs
+    :return: Path to the PDF
+    """
+    cmd = ['pdflatex', '-interaction=nonstopmode']
+    if format_name is not None:
+        cmd.append('-fmt=' + format_name)
+    cmd.append(os.path.basename(tex_prefix) + '.tex')
+    for _ in range(max_runs):
+        subprocess.call(cmd, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            with open(tex_prefix + '.log', 'r', errors='ignore') as f:
+                if 'Rerun' not in f.read():
+                    break
+        except IOError:
+            break
+    for extension in ['.aux', '.log', '.out']:
+        if os.path.isfile(tex_prefix + extension):
+            os.remove(tex_prefix + extension)
+    return tex_prefix + '.pdf'
+
+
+def compile_reports(tex_prefixes, work_dir, processes=4):
+    """
+    Compiles several reports at once. Reports that share a preamble share a precompiled format for it
+    :param tex_prefixes: List of paths to reports without the .tex extension
+    :param work_dir: Folder to compile in
+    :param processes: Number of pdflatex processes to run at once
+    :return: List of paths to the PDFs
+    """
+    format_names = dict()
+    for tex_prefix in tex_prefixes:
+        format_names[tex_prefix] = build_preamble_format(tex_prefix + '.tex', work_dir)
+    # Every compile is its own pdflatex process, so threads are enough to keep them all busy
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(lambda tex_prefix: compile_report(tex_prefix, work_dir, format_names[tex_prefix]),
+                                 tex_prefixes))
 
 
 def produce_header_footer():
@@ -972,13 +938,26 @@ def get_image():
     return image_filename
 
 
-class Form(pl.base_classes.Environment):
-    """A class to wrap hyperref's form environment."""
-    _latex_name = 'Form'
+def Form():
+    """
+    Builds the class that wraps hyperref's form environment the first time it's needed, so that pylatex is only loaded
+    once a report is actually being made
+    :return: Form environment
+    """
+    global _form_class
+    if _form_class is None:
+        class Form(pl.base_classes.Environment):
+            """A class to wrap hyperref's form environment."""
+            _latex_name = 'Form'
+
+            packages = [pl.Package('hyperref')]
+            escape = False
+            content_separator = "\n"
+        _form_class = Form
+    return _form_class()
+
 
-    packages = [pl.Package('hyperref')]
-    escape = False
-    content_separator = "\n"
+_form_class = None
 
 
 if __name__ == '__main__':
@@ -1,100 +1,92 @@
 import sqlalchemy as sa
 import datetime
-import time
 
 from automator_settings import POSTGRES_PASSWORD, POSTGRES_USERNAME
 
+# Key for the transaction level advisory lock held while a ROGA ID is handed out. The year gets added on, so requests
+# for different years never wait on each other
+ROGA_ID_LOCK = 0x524f4741
+
+# Table definition is kept here rather than reflected from the database on every request
+metadata = sa.MetaData()
+ROGA_ID_SEQ = sa.Sequence('roga_id_seq')
+autoroga_project_table = sa.Table('autoroga_project_table', metadata,
+                                  sa.Column('id', sa.INTEGER, ROGA_ID_SEQ,
+                                            primary_key=True, server_default=ROGA_ID_SEQ.next_value()),
+                                  sa.Column('roga_id', sa.String(64)),
+                                  sa.Column('genus', sa.String(64)),
+                                  sa.Column('lab', sa.String(16)),
+                                  sa.Column('source', sa.String(64)),
+                                  sa.Column('amendment_flag', sa.String(16)),
+                                  sa.Column('amended_id', sa.String(64)),
+                                  sa.Column('date', sa.Date),
+                                  sa.Column('time', sa.DateTime, default=datetime.datetime.utcnow),
+                                  sa.Column('deletion_date', sa.Date),
+                                  sa.Column('deletion_reason', sa.String(256))
+                                  )
+
+# Pooled engines, keyed on connection URL
+engines = dict()
+
 
 # Default connection to the address of the head node - should be 192.168.1.5
 def connect(user, password, db, host='192.168.1.5', port=5432):
+    """
+    :return: Pooled engine for the ROGA database. The first call in a process makes sure the project table and the
+             index used to look up a year's ROGA IDs exist
+    """
     url = 'postgresql://{}:{}@{}:{}/{}'
     url = url.format(user, password, host, port, db)
 
-    # To prevent race conditions, the POSTGRES_USERNAME should be set up with a connection limit of 1.
-    # Then, if other users are currently accessing ROGA database, just wait.
-    connection_created = False
-
-    while connection_created is False:
-        try:
-            # The return value of create_engine() is the connection object
-            con = sa.create_engine(url, client_encoding='utf8')
+    if url not in engines:
+        con = sa.create_engine(url, client_encoding='utf8', pool_size=2, pool_pre_ping=True)
+        metadata.create_all(con)
+        # text_pattern_ops lets the roga_id LIKE 'YEAR-ROGA-%' lookup use the index
+        con.execute('CREATE INDEX IF NOT EXISTS autoroga_project_table_roga_id '
+                    'ON autoroga_project_table (roga_id text_pattern_ops)')
+        engines[url] = con
 
-            # Bind the connection to MetaData()
-            meta = sa.MetaData(bind=con, reflect=True)
-            connection_created = True
-        except sa.exc.OperationalError:  # This is the error you get if too many users try to connect.
-            time.sleep(10)
+    return engines[url]
 
-    return con, meta
 
-
-def update_db(date, year, genus, lab, source, amendment_flag, amended_id):
-    con, meta = connect(user=POSTGRES_USERNAME, password=POSTGRES_PASSWORD, db='autoroga')
-
-    ROGA_ID_SEQ = sa.Sequence('roga_id_seq')
-
-    try:  # Create table if it doesn't already exist
-        autoroga_project_table = sa.Table('autoroga_project_table', meta,
-                                          sa.Column('id', sa.INTEGER, ROGA_ID_SEQ,
-                                                    primary_key=True, server_default=ROGA_ID_SEQ.next_value()),
-                                          sa.Column('roga_id', sa.String(64)),
-                                          sa.Column('genus', sa.String(64)),
-                                          sa.Column('lab', sa.String(16)),
-                                          sa.Column('source', sa.String(64)),
-                                          sa.Column('amendment_flag', sa.String(16)),
-                                          sa.Column('amended_id', sa.String(64)),
-                                          sa.Column('date', sa.Date),
-                                          sa.Column('time', sa.DateTime, default=datetime.datetime.utcnow),
-                                          sa.Column('deletion_date', sa.Date),
-                                          sa.Column('deletion_reason', sa.String(256))
-                                          )
-        meta.create_all()
-        print('Successfully created autoroga_project_table')
-
-    except:  # Retrieve table if it already exists
-        autoroga_project_table = sa.Table('autoroga_project_table', meta, autoload=True, autoload_with=sa.engine)
-        print('Successfully retrieved autoroga_project_table')
-
-    # Grab what the next key value will be
-    select_next_value = sa.select([autoroga_project_table.c.id])
-    keys = con.execute(select_next_value)
-
-    try:
-        next_val = max(keys)[0] + 1
-    except:
-        next_val = 1
-
-    # Create ROGA ID
-    select_next_roga_id = sa.select([autoroga_project_table.c.roga_id])
-    keys = con.execute(select_next_roga_id)
-    roga_ids = keys.fetchall()
-    # Now parse through ROGA IDs to figure out what the next one should be. roga_ids are a list of tuples
-    ids_for_year = list()
-    for item in roga_ids:
-        # ROGA is actually first element of tuple.
-        roga = item[0]
+def next_roga_number(roga_ids):
+    """
+    :param roga_ids: ROGA IDs already given out for a year
+    :return: Lowest number not yet used for the year
+    """
+    used = set()
+    for roga in roga_ids:
         try:
-            roga_year = int(roga.split('-')[0])
-            roga_id = int(roga.split('-')[-1])
-            if roga_year == int(year):
-                ids_for_year.append(roga_id)
+            used.add(int(roga.split('-')[-1]))
         except ValueError:  # For some reason a few old ROGAs don't have proper IDs. Ignore them.
             pass
-
     i = 1
-    roga_id_found = False
-    while roga_id_found is False:
-        if i in ids_for_year:
-            i += 1
-        else:
-            roga_id_found = True
-
-    roga_id = year + '-ROGA-' + '{:04d}'.format(i)
-
-    # Insert new row into autoroga_project_table table
-    ins = autoroga_project_table.insert().values(roga_id=roga_id, genus=genus, date=date, lab=lab, source=source,
-                                                 amendment_flag=amendment_flag, amended_id=amended_id,
-                                                 time=datetime.datetime.utcnow())
-    con.execute(ins)
+    while i in used:
+        i += 1
+    return i
+
+
+def update_db(date, year, genus, lab, source, amendment_flag, amended_id):
+    con = connect(user=POSTGRES_USERNAME, password=POSTGRES_PASSWORD, db='autoroga')
+
+    # Picking the ROGA ID and inserting the row happen in one transaction. The advisory lock for the year is released
+    # when the transaction ends, so concurrent requests for the same year queue up on it in the database rather than
+    # needing the single-connection limit on the role
+    with con.begin() as transaction:
+        transaction.execute(sa.select([sa.func.pg_advisory_xact_lock(ROGA_ID_LOCK + int(year))]))
+
+        # Only this year's ROGA IDs are read, through the roga_id index
+        prefix = '{}-ROGA-'.format(year)
+        select_roga_ids = sa.select([autoroga_project_table.c.roga_id]).where(
+            autoroga_project_table.c.roga_id.like(prefix + '%'))
+        roga_ids = [row[0] for row in transaction.execute(select_roga_ids)]
+
+        roga_id = prefix + '{:04d}'.format(next_roga_number(roga_ids))
+
+        # Insert new row into autoroga_project_table table
+        ins = autoroga_project_table.insert().values(roga_id=roga_id, genus=genus, date=date, lab=lab, source=source,
+                                                     amendment_flag=amendment_flag, amended_id=amended_id,
+                                                     time=datetime.datetime.utcnow())
+        transaction.execute(ins)
 
     return roga_id
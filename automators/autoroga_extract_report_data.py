@@ -1,23 +1,26 @@
 import os
 import re
 import glob
+import time
+import contextlib
 import collections
-import pandas as pd
 from automator_settings import ASSEMBLIES_FOLDER, MERGED_ASSEMBLIES_FOLDER
+from lazy_import import lazy_import
+pd = lazy_import('pandas')
 
 
-def create_report_dictionary(report_list, seq_list, id_column='SeqID'):
+def create_report_table(report_list, seq_list, id_column='SeqID'):
     """
+    Reads each report once and keeps only the rows for the Seq IDs of interest
     :param report_list: List of paths to report files
     :param seq_list: List of OLC Seq IDs
     :param id_column: Column used to specify primary key
-    :return: Dictionary containing Seq IDs as keys and dataframes as values
+    :return: DataFrame indexed on id_column with a single row for each Seq ID that was found. If a Seq ID shows up in
+             more than one report, the row from the last report is used
     """
-    report_dict = {}
-
+    matched_rows = list()
     # Iterate over every metadata file (e.g. combinedMetadata.csv or GDCS.csv)
     for report in report_list:
-        # Check if the sample we want is in file
         print(report)
 
         # Accomodating runs that might still be in progress
@@ -28,157 +31,186 @@ def create_report_dictionary(report_list, seq_list, id_column='SeqID'):
         # might need to use from pandas.io.parser import CParserError try/except with CParserError for this
 
         # Accomodating old reports coming up
-        try:
-            samples = df[id_column]
-        except KeyError:
-            samples = df['SampleName']  # This was the old column name for SeqID
+        if id_column not in df.columns:
+            if 'SampleName' not in df.columns:
+                continue
+            df = df.rename(columns={'SampleName': id_column})  # This was the old column name for SeqID
+
+        # Check all of our sequences of interest to see if they are in the report in one go
+        rows = df.loc[df[id_column].isin(seq_list)].drop_duplicates(subset=id_column, keep='first')
+        if not rows.empty:
+            matched_rows.append(rows)
+
+    if matched_rows:
+        table = pd.concat(matched_rows, ignore_index=True, sort=False).drop_duplicates(subset=id_column, keep='last')
+    else:
+        table = pd.DataFrame(columns=[id_column])
+    table = table.set_index(id_column, drop=False).sort_index()
+    return table
+
+
+def create_report_dictionary(report_list, seq_list, id_column='SeqID'):
+    """
+    :param report_list: List of paths to report files
+    :param seq_list: List of OLC Seq IDs
+    :param id_column: Column used to specify primary key
+    :return: Dictionary containing Seq IDs as keys and single row dataframes as values
+    """
+    table = create_report_table(report_list=report_list, seq_list=seq_list, id_column=id_column)
+    return report_dictionary(table)
 
-        # Check all of our sequences of interest to see if they are in the combinedMetadata file
-        for seq in seq_list:
-            if seq in samples.values:
-                # Associate dataframe with sampleID
-                report_dict[seq] = df
 
-    ordered_dict = collections.OrderedDict(sorted(report_dict.items()))
+def report_dictionary(table):
+    """
+    :param table: DataFrame from create_report_table()
+    :return: Dictionary containing Seq IDs as keys and single row dataframes as values
+    """
+    ordered_dict = collections.OrderedDict()
+    for seq in table.index:
+        ordered_dict[seq] = table.loc[[seq]].reset_index(drop=True)
     return ordered_dict
 
 
+def combined_metadata_reports():
+    """
+    :return: List of paths to every combinedMetadata.csv we have
+    """
+    all_reports = glob.glob(os.path.join(ASSEMBLIES_FOLDER, '*/reports/combinedMetadata.csv'))
+    all_reports += glob.glob(os.path.join(MERGED_ASSEMBLIES_FOLDER, '*/reports/combinedMetadata.csv'))
+    return all_reports
+
+
 def get_combined_metadata(seq_list):
     """
     :param seq_list: List of OLC Seq IDs
     :return: Dictionary containing Seq IDs as keys and combinedMetadata dataframes as values
     """
-    # Grab every single combinedMetadata.csv file we have
-    all_reports = glob.glob(os.path.join(ASSEMBLIES_FOLDER, '*/reports/combinedMetadata.csv'))
-    all_reports += glob.glob(os.path.join(MERGED_ASSEMBLIES_FOLDER, '*/reports/combinedMetadata.csv'))
-    metadata_report_dict = create_report_dictionary(report_list=all_reports, seq_list=seq_list)
+    metadata_report_dict = create_report_dictionary(report_list=combined_metadata_reports(), seq_list=seq_list)
     return metadata_report_dict
 
 
+def gdcs_reports():
+    """
+    :return: List of paths to every GDCS.csv we have
+    """
+    all_reports = glob.glob(os.path.join(ASSEMBLIES_FOLDER, '*/reports/GDCS.csv'))
+    all_reports += glob.glob(os.path.join(MERGED_ASSEMBLIES_FOLDER, '*/reports/GDCS.csv'))
+    return all_reports
+
+
 def get_gdcs(seq_list):
     """
     :param seq_list: List of OLC Seq IDs
     :return: Dictionary containing Seq IDs as keys and GDCS dataframes as values
     """
-    # Grab every single GDCS.csv file we have
-    gdcs_reports = glob.glob(os.path.join(ASSEMBLIES_FOLDER, '*/reports/GDCS.csv'))
-    gdcs_reports += glob.glob(os.path.join(MERGED_ASSEMBLIES_FOLDER, '*/reports/GDCS.csv'))
-    gdcs_report_dict = create_report_dictionary(report_list=gdcs_reports, seq_list=seq_list, id_column='Strain')
+    gdcs_report_dict = create_report_dictionary(report_list=gdcs_reports(), seq_list=seq_list, id_column='Strain')
     return gdcs_report_dict
 
 
-def validate_genus(seq_list, genus):
+def summarise_samples(metadata_reports):
+    """
+    Works out the genus, marker and AMR checks for every sample in one pass over their combinedMetadata rows
+    :param metadata_reports: Dictionary retrieved from get_combined_metadata()
+    :return: DataFrame indexed on Seq ID with the observed genus, presence (True/False) of each marker the validation
+             steps look for, the parsed GeneSeekr markers and the parsed AMR profile
+    """
+    columns = ['Genus', 'uidA', 'vt', 'hlyA', 'IGS', 'inlj', 'invA', 'stn', 'groEL', 'r72h', 'markers',
+               'amr_profile']
+    if not metadata_reports:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(list(metadata_reports.values()), ignore_index=True, sort=False).set_index('SeqID')
+    profile = df['GeneSeekr_Profile'].astype(str)
+    summary = pd.DataFrame(index=df.index)
+    summary['Genus'] = df['Genus']
+    for marker in ['uidA', 'hlyA', 'IGS', 'inlj', 'invA', 'stn', 'groEL', 'r72h']:
+        summary[marker] = profile.str.contains(marker, regex=False)
+    summary['vt'] = df['Vtyper_Profile'].astype(str).str.contains('vt', regex=False)
+    summary['markers'] = profile.map(parse_geneseekr_profile)
+    summary['amr_profile'] = df['AMR_Profile'].map(parse_amr_profile)
+    return summary[columns]
+
+
+def validate_genus(seq_list, genus, metadata_table=None):
     """
     Validates whether or not the expected genus matches the observed genus parsed from combinedMetadata.
     :param seq_list: List of OLC Seq IDs
     :param genus: String of expected genus (Salmonella, Listeria, Escherichia)
+    :param metadata_table: DataFrame from create_report_table() for the combinedMetadata reports, if already loaded
     :return: Dictionary containing Seq IDs as keys and a 'valid status' as the value
     """
-    metadata_reports = get_combined_metadata(seq_list)
+    if metadata_table is None:
+        metadata_table = create_report_table(report_list=combined_metadata_reports(), seq_list=seq_list)
 
     valid_status = collections.OrderedDict()
 
     for seqid in seq_list:
         print('Validating {} genus'.format(seqid))
-        df = metadata_reports[seqid]
-        observed_genus = df.loc[df['SeqID'] == seqid]['Genus'].values[0]
-        if observed_genus == genus:
-            valid_status[seqid] = True  # Valid genus
-        else:
-            valid_status[seqid] = False  # Invalid genus
+        valid_status[seqid] = metadata_table.at[seqid, 'Genus'] == genus
 
     return valid_status
 
 
-def validate_ecoli(seq_list, metadata_reports):
+def validate_ecoli(seq_list, metadata_reports, summary=None):
     """
     Checks if the uidA marker, hlyA marker and vt markers are present in the combinedMetadata sheets and stores True/False for
     each SeqID. Values are stored as tuples: (uida_present, verotoxigenic, hlya_present)
     :param seq_list: List of OLC Seq IDs
     :param metadata_reports: Dictionary retrieved from get_combined_metadata()
+    :param summary: DataFrame from summarise_samples(), if it has already been made
     :return: Dictionary containing Seq IDs as keys and (uidA, vt, hlyA) presence or absence for values.
              Present = True, Absent = False
     """
+    if summary is None:
+        summary = summarise_samples(metadata_reports)
     ecoli_seq_status = {}
 
     for seqid in seq_list:
         print('Validating {} uidA and vt marker detection'.format(seqid))
-        df = metadata_reports[seqid]
-        observed_genus = df.loc[df['SeqID'] == seqid]['Genus'].values[0]
-        uida_present = False
-        verotoxigenic = False
-        hlya_present = False
-
-        if observed_genus == 'Escherichia':
-            if 'uidA' in df.loc[df['SeqID'] == seqid]['GeneSeekr_Profile'].values[0]:
-                uida_present = True
-            if 'vt' in df.loc[df['SeqID'] == seqid]['Vtyper_Profile'].values[0]:
-                verotoxigenic = True
-            if 'hlyA' in df.loc[df['SeqID'] == seqid]['GeneSeekr_Profile'].values[0]:
-                hlya_present = True
-            ecoli_seq_status[seqid] = (uida_present, verotoxigenic, hlya_present)
+        sample = summary.loc[seqid]
+        if sample['Genus'] == 'Escherichia':
+            ecoli_seq_status[seqid] = (bool(sample['uidA']), bool(sample['vt']), bool(sample['hlyA']))
 
     return ecoli_seq_status
 
 
-def validate_vibrio(seq_list, metadata_reports):
+def validate_vibrio(seq_list, metadata_reports, summary=None):
     """
     Checks combined metadata for presence of r72h and/or groEL in the GeneSeekr_Profile column
     :param seq_list: List of OLC Seq IDs
     :param metadata_reports: dictionary retrived from get_combined_metadata()
+    :param summary: DataFrame from summarise_samples(), if it has already been made
     :return: dict with pair of SeqID:boolean where True means GeneSeekr confirms the identity
     """
+    if summary is None:
+        summary = summarise_samples(metadata_reports)
     vibrio_seq_status = dict()
     for seqid in seq_list:
         print('Validating {} r72h OR groEL marker detection for Vibrio'.format(seqid))
-        df = metadata_reports[seqid]
-        observed_genus = df.loc[df['SeqID'] == seqid]['Genus'].values[0]
-        r72h_present = False
-        groel_present = False
-
-        if observed_genus == 'Vibrio':
-            if 'groEL' in df.loc[df['SeqID'] == seqid]['GeneSeekr_Profile'].values[0]:
-                groel_present = True
-            if 'r72h' in df.loc[df['SeqID'] == seqid]['GeneSeekr_Profile'].values[0]:
-                r72h_present = True
-
-        if groel_present is True or r72h_present is True:
-            vibrio_seq_status[seqid] = True
-        else:
-            vibrio_seq_status[seqid] = False
+        sample = summary.loc[seqid]
+        vibrio_seq_status[seqid] = bool(sample['Genus'] == 'Vibrio' and (sample['groEL'] or sample['r72h']))
     return vibrio_seq_status
 
 
-def validate_salmonella(seq_list, metadata_reports):
+def validate_salmonella(seq_list, metadata_reports, summary=None):
     """
     Checks combined metadata for presence of invA or stn in the GeneSeekr_Profile column
     :param seq_list:
     :param metadata_reports:
+    :param summary: DataFrame from summarise_samples(), if it has already been made
     :return: dict with pair of SeqID:boolean where True means GeneSeekr confirms the identity
     """
+    if summary is None:
+        summary = summarise_samples(metadata_reports)
     salmonella_seq_status = {}
 
     for seqid in seq_list:
         print('Validating {} invA OR stn marker detection for Salmonella'.format(seqid))
-        df = metadata_reports[seqid]
-        observed_genus = df.loc[df['SeqID'] == seqid]['Genus'].values[0]
-        inva_present = False
-        stn_present = False
-
-        if observed_genus == 'Salmonella':
-            if 'invA' in df.loc[df['SeqID'] == seqid]['GeneSeekr_Profile'].values[0]:
-                inva_present = True
-            if 'stn' in df.loc[df['SeqID'] == seqid]['GeneSeekr_Profile'].values[0]:
-                stn_present = True
-
-        if stn_present is True or inva_present is True:
-            salmonella_seq_status[seqid] = True
-        else:
-            salmonella_seq_status[seqid] = False
+        sample = summary.loc[seqid]
+        salmonella_seq_status[seqid] = bool(sample['Genus'] == 'Salmonella' and (sample['invA'] or sample['stn']))
     return salmonella_seq_status
 
 
-def validate_listeria(seq_list, metadata_reports):
+def validate_listeria(seq_list, metadata_reports, summary=None):
     """
     Checks combined metadata for presence of IGS, inlJ, and hlyA in the GeneSeekr_Profile column
 
@@ -187,44 +219,35 @@ def validate_listeria(seq_list, metadata_reports):
 
     :param seq_list:
     :param metadata_reports:
+    :param summary: DataFrame from summarise_samples(), if it has already been made
     :return: dict with pair of SeqID:boolean where True means GeneSeekr confirms the identity
     """
+    if summary is None:
+        summary = summarise_samples(metadata_reports)
     listeria_seq_status = {}
 
     for seqid in seq_list:
         print('Validating {} invA OR stn marker detection for Salmonella'.format(seqid))
-        df = metadata_reports[seqid]
-        observed_genus = df.loc[df['SeqID'] == seqid]['Genus'].values[0]
-        igs_present = False
-        hlya_present = False
-        inlj_present = False
-
-        if observed_genus == 'Listeria':
-            if 'IGS' in df.loc[df['SeqID'] == seqid]['GeneSeekr_Profile'].values[0]:
-                igs_present = True
-            if 'hlyA' in df.loc[df['SeqID'] == seqid]['GeneSeekr_Profile'].values[0]:
-                hlya_present = True
-            if 'inlj' in df.loc[df['SeqID'] == seqid]['GeneSeekr_Profile'].values[0]:
-                inlj_present = True
-
-        if igs_present is True:
-            if hlya_present is True or inlj_present is True:
-                listeria_seq_status[seqid] = True
-            else:
-                listeria_seq_status[seqid] = False
-        else:
-            listeria_seq_status[seqid] = False
+        sample = summary.loc[seqid]
+        listeria_seq_status[seqid] = bool(sample['Genus'] == 'Listeria' and sample['IGS'] and
+                                          (sample['hlyA'] or sample['inlj']))
     return listeria_seq_status
 
 
-def generate_validated_list(seq_list, genus):
+def generate_validated_list(seq_list, genus, report_context=None):
     """
     :param seq_list: List of OLC Seq IDs
     :param genus: String of expected genus (Salmonella, Listeria, Escherichia)
+    :param report_context: ReportContext for the request, so the reports loaded here can be reused for the report
     :return: List containing each valid Seq ID
     """
     validated_list = []
-    validated_dict = validate_genus(seq_list=seq_list, genus=genus)
+    if report_context is not None:
+        metadata_table = report_context.metadata_table
+        with report_context.phase('genus validation'):
+            validated_dict = validate_genus(seq_list=seq_list, genus=genus, metadata_table=metadata_table)
+    else:
+        validated_dict = validate_genus(seq_list=seq_list, genus=genus)
 
     for seqid, valid_status in validated_dict.items():
         if validated_dict[seqid]:
@@ -293,7 +316,92 @@ def generate_gdcs_dict(gdcs_reports):
     """
     gdcs_dict = {}
     for sample_id, df in gdcs_reports.items():
-        matches = df.loc[df['Strain'] == sample_id]['Matches'].values[0]
-        passfail = df.loc[df['Strain'] == sample_id]['Pass/Fail'].values[0]
-        gdcs_dict[sample_id] = (matches, passfail)
+        gdcs_dict[sample_id] = (df['Matches'].values[0], df['Pass/Fail'].values[0])
     return gdcs_dict
+
+
+class ReportContext(object):
+    """
+    Everything a single ROGA request reads off the NAS. The combinedMetadata and GDCS reports are discovered and
+    loaded the first time they're asked for, and then shared between validation and report generation. Time spent in
+    each phase of the request is kept in timings
+    """
+    def __init__(self, seq_list):
+        self.seq_list = list(seq_list)
+        self.timings = collections.OrderedDict()
+        self._metadata_table = None
+        self._gdcs_table = None
+        self._summary = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Adds the time spent inside the with block to timings[name]
+        :param name: Name of the phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - start
+
+    @property
+    def metadata_table(self):
+        if self._metadata_table is None:
+            with self.phase('metadata discovery'):
+                report_list = combined_metadata_reports()
+            with self.phase('metadata loading'):
+                self._metadata_table = create_report_table(report_list=report_list, seq_list=self.seq_list)
+        return self._metadata_table
+
+    @property
+    def gdcs_table(self):
+        if self._gdcs_table is None:
+            with self.phase('gdcs discovery'):
+                report_list = gdcs_reports()
+            with self.phase('gdcs loading'):
+                self._gdcs_table = create_report_table(report_list=report_list, seq_list=self.seq_list,
+                                                       id_column='Strain')
+        return self._gdcs_table
+
+    @property
+    def metadata_reports(self):
+        """
+        :return: Same as get_combined_metadata(seq_list)
+        """
+        return report_dictionary(self.metadata_table)
+
+    @property
+    def gdcs_reports(self):
+        """
+        :return: Same as get_gdcs(seq_list)
+        """
+        return report_dictionary(self.gdcs_table)
+
+    @property
+    def summary(self):
+        """
+        :return: Same as summarise_samples(metadata_reports)
+        """
+        if self._summary is None:
+            metadata_reports = self.metadata_reports
+            with self.phase('marker validation'):
+                self._summary = summarise_samples(metadata_reports)
+        return self._summary
+
+    def subset(self, seq_list):
+        """
+        :param seq_list: Some of the Seq IDs this context was made for
+        :return: ReportContext for just those Seq IDs, sharing the reports already loaded here and the timings
+        """
+        context = ReportContext(seq_list)
+        context.timings = self.timings
+        context._metadata_table = self.metadata_table.loc[self.metadata_table.index.isin(seq_list)]
+        context._gdcs_table = self.gdcs_table.loc[self.gdcs_table.index.isin(seq_list)]
+        return context
+
+    def timing_report(self):
+        """
+        :return: String with one line per phase and the number of seconds spent in it
+        """
+        return '\n'.join('{}: {:.2f}s'.format(name, seconds) for name, seconds in self.timings.items())
@@ -0,0 +1,194 @@
+"""
+Parsing and checking of AutoROGA request descriptions. Kept apart from the report generation so that requests can be
+checked before a job is sent to the cluster, without loading pylatex or the report data.
+"""
+
+lab_info = {
+    'GTA': ('2301 Midland Ave., Scarborough, ON, M1P 4R7', '416-952-3203'),
+    'BUR': ('3155 Willington Green, Burnaby, BC, V5G 4P2', '604-292-6028'),
+    'OLC': ('960 Carling Ave, Building 22 CEF, Ottawa, ON, K1A 0Y9', '613-759-1267'),
+    'FFFM': ('960 Carling Ave, Building 22 CEF, Ottawa, ON, K1A 0Y9', '613-759-1220'),
+    'DAR': ('1992 Agency Dr., Dartmouth, NS, B2Y 3Z7', '902-536-1012'),
+    'CAL': ('3650 36 Street NW, Calgary, AB, T2L 2L1', '403-338-5200'),
+    'STH': ('3400 Casavant Boulevard W., St. Hyacinthe, QC, J2S 8E3', '450-768-6800')
+}
+
+# User level security to ensure only permitted users can submit AutoROGA requests
+# Permitted users - Andrew, Adam, Julie, Cathy, Paul, Martine, Ray.
+permitted_users = [296, 106, 429, 225, 226, 448, 529]
+
+
+def parse_request(description):
+    """
+    Parses an AutoROGA request, which may hold several reports separated by lines of ---
+    :param description: List of description lines
+    :return: Tuple of (list of report dictionaries from parse_report_spec, True if the request was FORCEd)
+    :raises ValueError: with the note to post to Redmine if the description can't be used
+    """
+    # Remove all newlines/empty lines from the description items
+    description = [x for x in description if x != '']
+
+    # FORCE applies to every report in the request
+    force_flag = False
+    if 'FORCE' in description[-1].upper():
+        force_flag = True
+        description.pop()
+
+    report_specs = [parse_report_spec(report_description)
+                    for report_description in split_report_descriptions(description)]
+    return report_specs, force_flag
+
+
+def split_report_descriptions(description):
+    """
+    :param description: List of description lines, with empty lines removed
+    :return: List of descriptions, one per report, split on lines of ---
+    """
+    report_descriptions = [[]]
+    for line in description:
+        if line.strip() == '---':
+            report_descriptions.append([])
+        else:
+            report_descriptions[-1].append(line)
+    return [report_description for report_description in report_descriptions if report_description]
+
+
+def parse_report_spec(description):
+    """
+    Parses the description for a single report
+    :param description: List of description lines for the report
+    :return: Dictionary of lab, source, genus, seqids, lstsids, seq_lsts_dict, amendment_flag and amended_report_id
+    :raises ValueError: with the note to post to Redmine if the description can't be used
+    """
+    # Setup
+    amended_report_id = None
+    lab = None
+    genus = None
+    source = None
+    seqids = None
+    lstsids = None
+    seq_lsts_dict = None
+
+    # Amendment functionality
+    amendment_flag = False
+    amendment_check = description[0].upper()
+    if 'AMENDMENT' in amendment_check:
+        amendment_flag = True
+
+    # Parse fields
+    if amendment_flag is False:
+        # Parse lab ID
+        lab = description[0]
+        # Verify lab ID
+        if lab not in lab_info:
+            valid_labs = str([x for x, y in lab_info.items()])
+            raise ValueError('ERROR: Invalid Lab ID provided. Please ensure the first line of your '
+                             'Redmine description specifies one of the following labs:\n'
+                             '{}\n'
+                             'Your input: {}'.format(valid_labs, description))
+
+        # Parse source
+        source = description[1].lower()
+        # Quick verification check to make sure this line isn't a Seq ID. This is brittle and should be changed.
+        if len(source.split('-')) > 2:
+            raise ValueError('ERROR: Invalid source provided. '
+                             'Line 2 of the Redmine description must be a valid string e.g. "flour"')
+
+        # Parse genus
+        genus = description[2].capitalize()
+        if genus not in ['Escherichia', 'Salmonella', 'Listeria', 'Vibrio']:
+            raise ValueError('ERROR: Input genus "{}" does not match any of the acceptable values'
+                             ' which include: "Escherichia", "Salmonella", "Listeria", "Vibrio"'.format(genus))
+
+        # Parse Seq IDs
+        # NOTE: Now should have SeqID;LSTSID format
+        try:
+            seqids, lstsids = parse_seqid_list(description)
+        except:
+            raise ValueError('ERROR: Could not pair Seq IDs and LSTS IDs from the provided '
+                             'description. Confirm that each sample follows the required format '
+                             'of [SEQID; LSTSID] or [SEQID   LSTSID] for each line.')
+
+        seq_lsts_dict = dict(zip(seqids, lstsids))
+
+    elif amendment_flag:
+        try:
+            amended_report_id = amendment_check.split(':')[1]
+        except IndexError:
+            raise ValueError('ERROR: Could not parse AutoROGA ID from AMENDMENT field.\n'
+                             'Must be formatted as follows: AMENDMENT:ROGAID')
+
+        # Parse lab ID
+        lab = description[1]
+        if lab not in lab_info:
+            valid_labs = str([x for x, y in lab_info.items()])
+            raise ValueError('ERROR: Invalid Lab ID provided. Please ensure the first line of your '
+                             'Redmine description specifies one of the following labs:\n'
+                             '{}'.format(valid_labs))
+
+        # Parse source
+        source = description[2].lower()
+        if len(source.split('-')) > 2:
+            raise ValueError('ERROR: Invalid source provided. '
+                             'Line 2 of the Redmine description must be a valid string e.g. "flour"')
+
+        # Parse genus
+        genus = description[3].capitalize()
+        if genus not in ['Escherichia', 'Salmonella', 'Listeria']:
+            raise ValueError('ERROR: Input genus "{}" does not match any of the acceptable values'
+                             ' which include: "Escherichia", "Salmonella", "Listeria"'.format(genus))
+
+        # Parse Seq IDs
+        try:
+            seqids, lstsids = parse_seqid_list(description, starting_row=4)
+        except:
+            raise ValueError('ERROR: Could not pair Seq IDs and LSTS IDs from the provided '
+                             'description. Confirm that each sample follows the required format '
+                             'of [SEQID; LSTSID] or [SEQID   LSTSID] for each line.')
+        seq_lsts_dict = dict(zip(seqids, lstsids))
+
+    return {'lab': lab,
+            'source': source,
+            'genus': genus,
+            'seqids': seqids,
+            'lstsids': lstsids,
+            'seq_lsts_dict': seq_lsts_dict,
+            'amendment_flag': amendment_flag,
+            'amended_report_id': amended_report_id}
+
+
+def parse_seqid_list(description, starting_row=3):
+    seqids = list()
+    lstsids = list()
+
+    # Remove whitespace
+    description = [x.replace(' ', '') for x in description]
+
+    try:
+        for item in description[starting_row:]:
+            seqid_item = None
+            lstsid_item = None
+
+            # Accomodating pasting straight from Excel
+            if '\t' in item:
+                seqid_item = item.split('\t')[0]
+                lstsid_item = item.split('\t')[1]
+
+            # Manually delimiting IDs with a semicolon in the description
+            elif ';' in item:
+                seqid_item = item.split(';')[0]
+                lstsid_item = item.split(';')[1]
+
+            seqid_item = seqid_item.upper().strip()
+            lstsid_item = lstsid_item.upper().strip()
+
+            if seqid_item != '':
+                seqids.append(seqid_item)
+            if lstsid_item != '':
+                lstsids.append(lstsid_item)
+    except IndexError:
+        return None
+
+    seqids = tuple(seqids)
+    lstsids = tuple(lstsids)
+    return seqids, lstsids
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+Runs several issues for the same automator one after another in a single process. api.py submits one of these instead
+of a job per issue for automators that have a batch_window in AUTOMATOR_KEYWORDS, so queueing, activating the
+virtualenv, imports and anything the automator loads at module level are only paid for once per batch.
+
+Each issue is still run through the automator's own command with its own pickles and work directory, and posts its own
+results and errors. An issue that fails doesn't stop the rest of the batch.
+"""
+import os
+import json
+import click
+import pickle
+import importlib
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+
+def automator_command(module):
+    """
+    :param module: imported automator module
+    :return: the click command the automator runs when called as a script
+    """
+    commands = [value for value in vars(module).values()
+                if isinstance(value, click.Command) and value.callback.__module__ == module.__name__]
+    if len(commands) != 1:
+        raise ValueError('Expected one click command in {}, found {}'.format(module.__name__, len(commands)))
+    return commands[0]
+
+
+def run_issue(command, job):
+    """
+    Runs one issue through an automator command. Output from the automator goes to batch.log in the issue's work
+    directory, since the SLURM output files only exist in the work directory of the batch's first issue
+    :param command: click command for the automator
+    :param job: dictionary of paths to the issue's redmine_instance, issue and description pickles, and its work_dir
+    :return: True if the automator finished, False if it raised
+    """
+    args = ['--redmine_instance', job['redmine_instance'],
+            '--issue', job['issue'],
+            '--work_dir', job['work_dir'],
+            '--description', job['description']]
+    cwd = os.getcwd()
+    with open(os.path.join(job['work_dir'], 'batch.log'), 'a') as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            command.main(args=args, standalone_mode=False)
+            return True
+        except SystemExit:
+            # Automators quit() once they've posted a note about a bad request
+            return True
+        except Exception:
+            traceback.print_exc()
+            return False
+        finally:
+            os.chdir(cwd)
+
+
+def report_failure(job):
+    """
+    Lets the issue's author know that their request fell over somewhere the automator didn't catch
+    :param job: dictionary of paths to the issue's pickles, as in the manifest
+    """
+    redmine_instance = pickle.load(open(job['redmine_instance'], 'rb'))
+    issue = pickle.load(open(job['issue'], 'rb'))
+    redmine_instance.issue.update(resource_id=issue.id,
+                                  notes='Something went wrong! We log this automatically and will look into the '
+                                        'problem and get back to you with a fix soon.')
+
+
+@click.command()
+@click.option('--automator', help='Name of the automator module to run (i.e. ec_typer)')
+@click.option('--manifest', help='Path to JSON list of the pickles and work directory for each issue in the batch')
+def batch_runner(automator, manifest):
+    with open(manifest) as f:
+        jobs = json.load(f)
+    command = automator_command(importlib.import_module(automator))
+    for job in jobs:
+        print('Running {} for {}'.format(automator, job['work_dir']))
+        if not run_issue(command, job):
+            print('{} failed, see {}'.format(job['work_dir'], os.path.join(job['work_dir'], 'batch.log')))
+            try:
+                report_failure(job)
+            except Exception:
+                traceback.print_exc()
+
+
+if __name__ == '__main__':
+    batch_runner()
@@ -1,12 +1,17 @@
 import os
 import glob
 import click
+import heapq
 import pickle
-import sentry_sdk
-from amrsummary import before_send
-from automator_settings import SENTRY_DSN
-from biotools import mash
-from nastools.nastools import retrieve_nas_files
+import subprocess
+from amrsummary import capture_exception
+from sketch_database import current_sketch
+from lazy_import import lazy_function
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
+
+# Number of closest hits written to the results CSV
+CSV_RESULT_LIMIT = 1000
+
 
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
@@ -14,7 +19,6 @@ from nastools.nastools import retrieve_nas_files
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def closerelatives_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     # Unpickle Redmine objects
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
     issue = pickle.load(open(issue, 'rb'))
@@ -47,31 +51,24 @@ def closerelatives_redmine(redmine_instance, issue, work_dir, description):
                                           status_id=4)
             return
 
-        # Run mash dist with the FASTQ file specified against the sketch of all our stuff.
+        # Run mash dist with the FASTA file specified against the sketch of all our stuff, keeping only the closest
+        # hits as the output streams out of mash.
         query_fasta = glob.glob(os.path.join(work_dir, 'fasta', '*.fasta'))[0]
-        mash.dist(query_fasta, '/mnt/nas2/redmine/bio_requests/14674/all_sequences.msh',
-                  threads=8, output_file=os.path.join(work_dir, 'distances.tab'))
-        mash_results = mash.read_mash_output(os.path.join(work_dir, 'distances.tab'))
-        result_dict = dict()
-        # Put all the results into a dictionary, where the key is the sequence file and the value is mash distance
-        # between query fastq and reference fastq.
-        for item in mash_results:
-            seq_name = os.path.split(item.query)[-1].split('_')[0]
-            result_dict[seq_name] = item.distance
-
-        # Sort the results, store the sorted dictionary keys in a list.
-        sorted_distance_results = sorted(result_dict, key=result_dict.get)
+        closest = closest_relatives(query_fasta=query_fasta,
+                                    sketch=current_sketch(),
+                                    num_results=max(num_close_relatives, CSV_RESULT_LIMIT),
+                                    threads=8)
 
         # Prepare a string that lists the top hit SEQIDs to be posted to redmine.
         upload_string = ''
-        for i in range(num_close_relatives):
-            upload_string = upload_string + sorted_distance_results[i].replace('.fasta', '') + ' (' + str(result_dict[sorted_distance_results[i]]) + ')\n'
+        for distance, seq_name in closest[:num_close_relatives]:
+            upload_string = upload_string + seq_name.replace('.fasta', '') + ' (' + str(distance) + ')\n'
 
-        # Also make a CSV file of all results, in case someone wants to take a closer look.
+        # Also make a CSV file of the closest results, in case someone wants to take a closer look.
         with open(os.path.join(work_dir, 'close_relatives_results.csv'), 'w') as f:
             f.write('Strain,MashDistance\n')
-            for seq in sorted_distance_results:
-                f.write('{},{}\n'.format(seq.replace('.fasta', ''), result_dict[seq]))
+            for distance, seq_name in closest:
+                f.write('{},{}\n'.format(seq_name.replace('.fasta', ''), distance))
 
         output_list = [
             {
@@ -90,10 +87,40 @@ def closerelatives_redmine(redmine_instance, issue, work_dir, description):
                                       uploads=output_list)
 
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
 
+def closest_relatives(query_fasta, sketch, num_results, threads=8):
+    """
+    Runs mash dist of the query against the sketch, parsing the output as it is piped out of mash. Only a bounded set
+    of the closest hits is ever held in memory, rather than the tens of thousands of rows in the full output
+    :param query_fasta: path to query FASTA
+    :param sketch: path to the sketch of all sequences
+    :param num_results: number of closest hits to return
+    :param threads: number of threads for mash to use
+    :return: list of (distance, seq_name) for the num_results closest sequences, sorted by distance
+    """
+    best = dict()
+    process = subprocess.Popen(['mash', 'dist', '-p', str(threads), query_fasta, sketch],
+                               stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    for line in process.stdout:
+        # Columns are reference, query, distance, p-value, shared hashes
+        fields = line.split('\t')
+        seq_name = os.path.split(fields[1])[-1].split('_')[0]
+        distance = float(fields[2])
+        if distance < best.get(seq_name, float('inf')):
+            best[seq_name] = distance
+        # Prune back down to the closest hits whenever the candidates grow past a few times what was asked for
+        if len(best) > num_results * 4:
+            best = dict((name, dist) for dist, name in
+                        heapq.nsmallest(num_results, ((dist, name) for name, dist in best.items())))
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, 'mash dist')
+    return heapq.nsmallest(num_results, ((dist, name) for name, dist in best.items()))
+
+
 if __name__ == '__main__':
     closerelatives_redmine()
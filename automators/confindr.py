@@ -2,7 +2,8 @@ import os
 import click
 import pickle
 import shutil
-from nastools.nastools import retrieve_nas_files
+from lazy_import import lazy_function
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 
 @click.command()
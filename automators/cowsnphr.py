@@ -4,12 +4,11 @@ import click
 import pickle
 import shutil
 import zipfile
-import sentry_sdk
-from automator_settings import SENTRY_DSN
-from amrsummary import before_send
-from biotools import mash
+from amrsummary import capture_exception
 from externalretrieve import upload_to_ftp
-from nastools.nastools import retrieve_nas_files
+from lazy_import import lazy_import, lazy_function
+mash = lazy_import('biotools.mash')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 
 @click.command()
@@ -18,7 +17,6 @@ from nastools.nastools import retrieve_nas_files
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def cowsnphr_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     try:
         # Unpickle Redmine objects
         redmine_instance = pickle.load(open(redmine_instance, 'rb'))
@@ -187,7 +185,7 @@ def cowsnphr_redmine(redmine_instance, issue, work_dir, description):
         shutil.rmtree(reference_folder)
         shutil.rmtree(seq_folder)
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
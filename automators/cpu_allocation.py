@@ -0,0 +1,14 @@
+import os
+
+
+def allocated_cpus():
+    """
+    :return: number of CPUs the current job may use. multiprocessing.cpu_count() is the size of the whole node, so the
+    SLURM allocation (or the job's share of a resident worker, which sets the same variable) is used when there is one,
+    and otherwise the CPUs the process is allowed to run on
+    """
+    cpus = len(os.sched_getaffinity(0))
+    for variable in ('SLURM_CPUS_PER_TASK', 'SLURM_NTASKS'):
+        if os.environ.get(variable, str()).isdigit():
+            return max(1, min(cpus, int(os.environ[variable])))
+    return cpus
@@ -4,14 +4,22 @@ import os
 import glob
 import click
 import pickle
-import sentry_sdk
+import tempfile
 import subprocess
-from biotools import mash
-from amrsummary import before_send
-from strainchoosr import strainchoosr
-from automator_settings import SENTRY_DSN
+from sketch_cache import sketch_assemblies, combine_sketches
+from amrsummary import capture_exception
 
-from nastools.nastools import retrieve_nas_files
+from result_cache import ResultCache, database_version
+from lazy_import import lazy_import, lazy_function
+mash = lazy_import('biotools.mash')
+strainchoosr = lazy_import('strainchoosr.strainchoosr')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
+
+# Tree building programs available to DiversiTree
+TREE_PROGRAMS = {
+    'parsnp': '/mnt/nas2/virtual_environments/mob_suite/bin/parsnp',
+    'mashtree': '/home/ubuntu/bin/mashtree'
+}
 
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
@@ -19,7 +27,6 @@ from nastools.nastools import retrieve_nas_files
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def diversitree_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     # Unpickle Redmine objects
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
     issue = pickle.load(open(issue, 'rb'))
@@ -76,27 +83,34 @@ def diversitree_redmine(redmine_instance, issue, work_dir, description):
                                                 'try again.'.format(samples=outstr,
                                                                     reference=os.path.split(reference_file)[-1]))
 
-        # Remove distances.tab and sketch.msh from fastas folder, because sometimes they make
-        # parsnp crash. Other times they don't. I have no idea why, so remove just to be safe.
+        # Trees are cached by the set of assemblies (their names, which label the tips, and their contents) and the tree
+        # program, so resubmitting the same strains with a different number of strains to pick goes straight to
+        # StrainChoosr.
+        tree_file = os.path.join(work_dir, 'output', 'parsnp.tree')
+        fastas = sorted(glob.glob(os.path.join(work_dir, 'fastas', '*.fasta')))
+        tree_cache = ResultCache(automator='diversitree',
+                                 parameters={'treeprogram': treemaker},
+                                 db_version=database_version(TREE_PROGRAMS[treemaker]))
         try:
-            os.remove(os.path.join(work_dir, 'fastas', 'distances.tab'))
-            os.remove(os.path.join(work_dir, 'fastas', 'sketch.msh'))
-        except OSError:
-            pass
-
-        # Full paths needed here since SLURM doesn't give the $PATH of the host machine to the script for some reason
-        if treemaker == 'parsnp':
-            cmd = '/mnt/nas2/virtual_environments/mob_suite/bin/parsnp -r ! -d {input} -o {output} -p {threads}'.format(input=os.path.join(work_dir, 'fastas'),
-                                                                           output=os.path.join(work_dir, 'output'),
-                                                                           threads=24)
-        elif treemaker == 'mashtree':
-            if not os.path.isdir(os.path.join(work_dir, 'output')):
-                os.makedirs(os.path.join(work_dir, 'output'))
-            cmd = '/home/ubuntu/bin/mashtree --numcpus 24 --outtree {output_newick} {input_fastas}'.format(output_newick=os.path.join(work_dir, 'output', 'parsnp.tree'),
-                                                                                   input_fastas=os.path.join(work_dir, 'fastas', '*.fasta'))
-        returncode = subprocess.call(cmd, shell=True, env={'PERL5LIB': '$PERL5LIB:/home/ubuntu/lib/perl5'})
-        if returncode != 0:
-            raise Exception('Tree creation command ({}) for {} had return code {}'.format(cmd, issue.id, returncode))
+            if not tree_cache.fetch_set(fastas, tree_file):
+                # Full paths needed here since SLURM doesn't give the $PATH of the host machine to the script for some reason
+                if treemaker == 'parsnp':
+                    cmd = '{parsnp} -r ! -d {input} -o {output} -p {threads}'.format(parsnp=TREE_PROGRAMS['parsnp'],
+                                                                                     input=os.path.join(work_dir, 'fastas'),
+                                                                                     output=os.path.join(work_dir, 'output'),
+                                                                                     threads=24)
+                elif treemaker == 'mashtree':
+                    if not os.path.isdir(os.path.join(work_dir, 'output')):
+                        os.makedirs(os.path.join(work_dir, 'output'))
+                    cmd = '{mashtree} --numcpus 24 --outtree {output_newick} {input_fastas}'.format(mashtree=TREE_PROGRAMS['mashtree'],
+                                                                                                    output_newick=tree_file,
+                                                                                                    input_fastas=os.path.join(work_dir, 'fastas', '*.fasta'))
+                returncode = subprocess.call(cmd, shell=True, env={'PERL5LIB': '$PERL5LIB:/home/ubuntu/lib/perl5'})
+                if returncode != 0:
+                    raise Exception('Tree creation command ({}) for {} had return code {}'.format(cmd, issue.id, returncode))
+                tree_cache.store_set(fastas, tree_file)
+        finally:
+            tree_cache.close()
         # Now use diversitree to pick the strains we actually want.
         # IMPORTANT NOTE TO ANYONE MAINTAINING THIS: Need to have xvfb installed on nodes in order to make this run.
         # StrainChoosr uses ete3 to draw trees, which uses PyQt, which needs some sort of display.
@@ -120,7 +134,7 @@ def diversitree_redmine(redmine_instance, issue, work_dir, description):
                                       notes='DiversiTree process complete!')
         os.system('rm {fasta_files}'.format(fasta_files=os.path.join(work_dir, '*fasta')))
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -128,14 +142,18 @@ def diversitree_redmine(redmine_instance, issue, work_dir, description):
 
 def check_distances(ref_fasta, fasta_folder):
     bad_fastqs = list()
-    # fastqs = glob.glob(os.path.join(fastq_folder, '*R1*'))
-    mash.sketch(os.path.join(fasta_folder, '*.fasta'), output_sketch=os.path.join(fasta_folder, 'sketch.msh'), threads=56)
-    mash.dist(os.path.join(fasta_folder, 'sketch.msh'), ref_fasta, threads=56, output_file=os.path.join(fasta_folder, 'distances.tab'))
-    mash_output = mash.read_mash_output(os.path.join(fasta_folder, 'distances.tab'))
-    for item in mash_output:
-        print(item.reference, item.query, str(item.distance))
-        if item.distance > 0.06:  # May need to adjust this value.
-            bad_fastqs.append(item.reference)
+    # Sketches come out of the persistent sketch cache, so only assemblies that haven't been seen before get sketched.
+    # The combined sketch and distances are kept out of fasta_folder, since they sometimes make parsnp crash.
+    fastas = sorted(glob.glob(os.path.join(fasta_folder, '*.fasta')))
+    ref_sketch = sketch_assemblies([ref_fasta], threads=56)[0]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        sketch = combine_sketches(sketch_assemblies(fastas, threads=56), os.path.join(temp_dir, 'sketch'))
+        mash.dist(sketch, ref_sketch, threads=56, output_file=os.path.join(temp_dir, 'distances.tab'))
+        mash_output = mash.read_mash_output(os.path.join(temp_dir, 'distances.tab'))
+        for item in mash_output:
+            print(item.reference, item.query, str(item.distance))
+            if item.distance > 0.06:  # May need to adjust this value.
+                bad_fastqs.append(item.reference)
     return bad_fastqs
 
 
@@ -3,10 +3,10 @@ import glob
 import click
 import pickle
 import shutil
-import sentry_sdk
-from amrsummary import before_send
-from automator_settings import SENTRY_DSN
-from nastools.nastools import retrieve_nas_files
+from amrsummary import capture_exception
+from result_cache import ResultCache, database_version, link_assemblies
+from lazy_import import lazy_function
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 
 @click.command()
@@ -15,7 +15,6 @@ from nastools.nastools import retrieve_nas_files
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def ec_typer_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     try:
         # Unpickle Redmine objects
         redmine_instance = pickle.load(open(redmine_instance, 'rb'))
@@ -50,21 +49,55 @@ def ec_typer_redmine(redmine_instance, issue, work_dir, description):
         # These unfortunate hard coded paths appear to be necessary
         activate = 'source /home/ubuntu/miniconda3/bin/activate /mnt/nas2/virtual_environments/cowbat'
         ectyper = '/mnt/nas2/virtual_environments/cowbat/bin/ectyper'
-
-        # Prepare command
-        cmd = '{ectyper} -i {input_folder} -o {output_folder}'.format(ectyper=ectyper,
-                                                                      input_folder=assemblies_folder,
-                                                                      output_folder=output_folder)
-
-        # Create another shell script to execute within the PlasmidExtractor conda environment
-        template = "#!/bin/bash\n{} && {}".format(activate, cmd)
-        ec_script = os.path.join(work_dir, 'run_ec_typer.sh')
-        with open(ec_script, 'w+') as file:
-            file.write(template)
-        make_executable(ec_script)
-
-        # Run shell script
-        os.system(ec_script)
+        # The ECTyper database ships within the package, so that is what cached rows are stamped with
+        ectyper_db = glob.glob('/mnt/nas2/virtual_environments/cowbat/lib/python3*/site-packages/ectyper/Data')
+
+        # Pull the rows for any assemblies that have already been typed out of the result cache. Each SeqID gets its
+        # own single row report in seqid_folder, and only the assemblies without one are linked into uncached_folder
+        fasta_dict = dict()
+        for fasta in glob.glob(os.path.join(assemblies_folder, '*.fasta')):
+            fasta_dict[os.path.splitext(os.path.basename(fasta))[0]] = fasta
+        seqid_folder = os.path.join(output_folder, 'seqids')
+        os.makedirs(seqid_folder)
+        cache = ResultCache(automator='ec_typer',
+                            parameters=dict(),
+                            db_version=database_version(ectyper_db[0] if ectyper_db else ectyper, recursive=True))
+        try:
+            uncached = cache.partition(fasta_dict=fasta_dict,
+                                       output_dir=seqid_folder,
+                                       output_name='{seqid}.tsv')
+            if uncached:
+                uncached_folder = os.path.join(work_dir, 'uncached_assemblies')
+                link_assemblies(fasta_dict=uncached,
+                                folder=uncached_folder)
+                ectyper_folder = os.path.join(work_dir, 'ectyper_output')
+                # Prepare command
+                cmd = '{ectyper} -i {input_folder} -o {output_folder}'.format(ectyper=ectyper,
+                                                                              input_folder=uncached_folder,
+                                                                              output_folder=ectyper_folder)
+
+                # Create another shell script to execute within the PlasmidExtractor conda environment
+                template = "#!/bin/bash\n{} && {}".format(activate, cmd)
+                ec_script = os.path.join(work_dir, 'run_ec_typer.sh')
+                with open(ec_script, 'w+') as file:
+                    file.write(template)
+                make_executable(ec_script)
+
+                # Run shell script
+                os.system(ec_script)
+                split_report(report=os.path.join(ectyper_folder, 'output.tsv'),
+                             output_dir=seqid_folder)
+                cache.store_all(fasta_dict=uncached,
+                                output_dir=seqid_folder,
+                                output_name='{seqid}.tsv')
+                shutil.rmtree(uncached_folder)
+                shutil.rmtree(ectyper_folder)
+        finally:
+            cache.close()
+        # Assemble the final report from the cached and freshly typed rows
+        combine_reports(report_dir=seqid_folder,
+                        seqids=sorted(fasta_dict),
+                        report=os.path.join(output_folder, 'output.tsv'))
 
         # Get the output file uploaded.
         output_list = list()
@@ -80,7 +113,7 @@ def ec_typer_redmine(redmine_instance, issue, work_dir, description):
         shutil.rmtree(output_folder)
         shutil.rmtree(assemblies_folder)
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -96,6 +129,46 @@ def make_executable(path):
     os.chmod(path, mode)
 
 
+def split_report(report, output_dir):
+    """
+    Splits an ECTyper report into one report per SeqID, each with its own copy of the header
+    :param report: path to ECTyper output.tsv
+    :param output_dir: folder to write the {seqid}.tsv reports to
+    """
+    if not os.path.isfile(report):
+        return
+    with open(report, 'r') as f:
+        header = f.readline()
+        for line in f:
+            if not line.strip():
+                continue
+            seqid = line.split('\t')[0]
+            with open(os.path.join(output_dir, '{seqid}.tsv'.format(seqid=seqid)), 'w') as seqid_report:
+                seqid_report.write(header)
+                seqid_report.write(line)
+
+
+def combine_reports(report_dir, seqids, report):
+    """
+    Combines per-SeqID ECTyper reports back into a single report
+    :param report_dir: folder containing the {seqid}.tsv reports
+    :param seqids: sorted list of SeqIDs to include
+    :param report: path to the combined report to write
+    """
+    header = str()
+    data = str()
+    for seqid in seqids:
+        seqid_report = os.path.join(report_dir, '{seqid}.tsv'.format(seqid=seqid))
+        if not os.path.isfile(seqid_report):
+            continue
+        with open(seqid_report, 'r') as f:
+            header = f.readline()
+            data += f.read()
+    with open(report, 'w') as f:
+        f.write(header)
+        f.write(data)
+
+
 def verify_fasta_files_present(seqid_list, fasta_dir):
     missing_fastas = list()
     for seqid in seqid_list:
@@ -3,10 +3,10 @@ import glob
 import click
 import pickle
 import shutil
-import sentry_sdk
-from amrsummary import before_send
-from automator_settings import SENTRY_DSN
-from nastools.nastools import retrieve_nas_files
+from amrsummary import capture_exception
+from result_cache import ResultCache, database_version
+from lazy_import import lazy_function
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 
 @click.command()
@@ -15,7 +15,6 @@ from nastools.nastools import retrieve_nas_files
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def ecgf(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     """
     """
     # Unpickle Redmine objects
@@ -44,25 +43,45 @@ def ecgf(redmine_instance, issue, work_dir, description):
             os.makedirs(output_dir)
         # These unfortunate hard coded paths appear to be necessary
         activate = 'source /home/ubuntu/miniconda3/bin/activate /mnt/nas2/virtual_environments/ecgf'
+        # Reuse the reports of any assemblies that have already been run through eCGF, and only process the rest
+        fasta_dict = dict()
+        for fasta in fasta_files:
+            fasta_dict[os.path.split(fasta)[-1].split('.')[0]] = fasta
+        # eCGF ships its allele database within the package, so the whole package is stamped rather than only bin/
+        ecgf_package = glob.glob('/mnt/nas2/virtual_environments/ecgf/lib/python*/site-packages/ecgf')
+        cache = ResultCache(automator='ecgf',
+                            parameters=dict(),
+                            db_version=database_version(ecgf_package[0] if ecgf_package
+                                                        else '/mnt/nas2/virtual_environments/ecgf/bin',
+                                                        recursive=True))
         # As the files are processed one at a time, create a list of all the reports in order to create a summary report
         reports = list()
-        for fasta in sorted(fasta_files):
-            seqid = os.path.split(fasta)[-1].split('.')[0]
-            report = os.path.join(output_dir, '{seqid}.csv'.format(seqid=seqid))
-            reports.append(report)
-            # Create the command line call to eCGF
-            cmd = 'eCGF {fasta} {csv}'.format(fasta=fasta,
-                                              csv=report)
-            # Create another shell script to execute within the conda environment
-            template = "#!/bin/bash\n{activate} && {cmd}".format(activate=activate,
-                                                                 cmd=cmd)
-            ecgf_script = os.path.join(work_dir, 'run_ecgf.sh')
-            with open(ecgf_script, 'w+') as file:
-                file.write(template)
-            # Modify the permissions of the script to allow it to be run on the node
-            make_executable(ecgf_script)
-            # Run shell script
-            os.system(ecgf_script)
+        for seqid in sorted(fasta_dict):
+            reports.append(os.path.join(output_dir, '{seqid}.csv'.format(seqid=seqid)))
+        try:
+            uncached = cache.partition(fasta_dict=fasta_dict,
+                                       output_dir=output_dir,
+                                       output_name='{seqid}.csv')
+            for seqid, fasta in sorted(uncached.items()):
+                report = os.path.join(output_dir, '{seqid}.csv'.format(seqid=seqid))
+                # Create the command line call to eCGF
+                cmd = 'eCGF {fasta} {csv}'.format(fasta=fasta,
+                                                  csv=report)
+                # Create another shell script to execute within the conda environment
+                template = "#!/bin/bash\n{activate} && {cmd}".format(activate=activate,
+                                                                     cmd=cmd)
+                ecgf_script = os.path.join(work_dir, 'run_ecgf.sh')
+                with open(ecgf_script, 'w+') as file:
+                    file.write(template)
+                # Modify the permissions of the script to allow it to be run on the node
+                make_executable(ecgf_script)
+                # Run shell script
+                os.system(ecgf_script)
+            cache.store_all(fasta_dict=uncached,
+                            output_dir=output_dir,
+                            output_name='{seqid}.csv')
+        finally:
+            cache.close()
         # Create a summary report of all the individual reports
         header = str()
         data = str()
@@ -109,7 +128,7 @@ def ecgf(redmine_instance, issue, work_dir, description):
             pass
 
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -5,11 +5,10 @@ import ftplib
 import pickle
 import shutil
 import socket
-import sentry_sdk
-from amrsummary import before_send
-from automator_settings import SENTRY_DSN
-from nastools.nastools import retrieve_nas_files
+from amrsummary import capture_exception
 from automator_settings import FTP_USERNAME, FTP_PASSWORD
+from lazy_import import lazy_function
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 
 @click.command()
@@ -18,7 +17,6 @@ from automator_settings import FTP_USERNAME, FTP_PASSWORD
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def externalretrieve_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     print('External retrieving!')
     # Unpickle Redmine objects
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
@@ -98,7 +96,7 @@ def externalretrieve_redmine(redmine_instance, issue, work_dir, description):
                                                 'Results are available at the following FTP address:\n'
                                                 'ftp://ftp.agr.gc.ca/outgoing/cfia-ak/{}'.format(str(issue.id) + '.zip'))
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
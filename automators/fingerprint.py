@@ -0,0 +1,155 @@
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Index of file fingerprints, kept on node-local disk (in the temporary folder) since SQLite locking can't be trusted on
+# the NAS. Each node keeps its own index - it is only a cache of hashes, so nothing is lost by not sharing it
+FINGERPRINT_DB = 'redmine_fingerprints.sqlite'
+# Size of the blocks read from the start, middle and end of a file for the sampled hash
+SAMPLE_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    """
+    :param path: path to file
+    :return: sha256 hex digest of the entire file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(SAMPLE_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_sampled_hash(path):
+    """
+    Quick, approximate fingerprint of a file - the size plus a block from the start, middle and end. Good enough to
+    tell apart assemblies/FASTQs for dedup purposes while only reading 3MB of a multi-GB file
+    :param path: path to file
+    :return: sha256 hex digest of the size and sampled blocks
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        for offset in (0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)):
+            f.seek(offset)
+            digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+class FingerprintStore(object):
+    """
+    Cache of (path, inode, size, mtime) -> sha256/sampled hash. A lookup for a file that hasn't changed since it was
+    last hashed is a single indexed query; anything new or modified is hashed (either on demand, or ahead of time in
+    a background thread pool via prefetch()) and the index is updated
+    """
+
+    def __init__(self, db_path=None, threads=8):
+        """
+        :param db_path: path to the SQLite fingerprint index. Defaults to FINGERPRINT_DB in the node's temporary folder
+        :param threads: number of threads used to hash files in the background
+        """
+        if db_path is None:
+            db_path = os.path.join(tempfile.gettempdir(), FINGERPRINT_DB)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS fingerprints ('
+                                'path TEXT PRIMARY KEY, '
+                                'inode INTEGER, '
+                                'size INTEGER, '
+                                'mtime REAL, '
+                                'sha256 TEXT, '
+                                'sampled TEXT, '
+                                'hashed REAL)')
+        self.connection.commit()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = dict()
+
+    def _lookup(self, path, stat):
+        """
+        :return: (sha256, sampled) for path if the stored fingerprint is still valid for stat, otherwise None
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT inode, size, mtime, sha256, sampled FROM fingerprints '
+                                          'WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[:3] == (stat.st_ino, stat.st_size, stat.st_mtime):
+            return row[3], row[4]
+        return None
+
+    def _hash(self, path):
+        """
+        Hashes path (if it isn't already up to date in the index) and records the result
+        :return: (sha256, sampled)
+        """
+        stat = os.stat(path)
+        stored = self._lookup(path, stat)
+        if stored is not None:
+            return stored
+        sha256 = file_sha256(path)
+        sampled = file_sampled_hash(path)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (path, stat.st_ino, stat.st_size, stat.st_mtime, sha256, sampled, time.time()))
+            self.connection.commit()
+        return sha256, sampled
+
+    def _fingerprint(self, path):
+        """
+        :return: (sha256, sampled) for path, waiting on a background hash if one has been queued
+        """
+        # Links (i.e. files put into a work directory by retrieve_nas_files) share the fingerprint of their target
+        path = os.path.realpath(path)
+        future = self.pending.pop(path, None)
+        if future is not None:
+            return future.result()
+        return self._hash(path)
+
+    def sha256(self, path):
+        """
+        :param path: path to file
+        :return: sha256 hex digest of the file
+        """
+        return self._fingerprint(path)[0]
+
+    def sampled(self, path):
+        """
+        :param path: path to file
+        :return: sampled hash of the file (see file_sampled_hash)
+        """
+        return self._fingerprint(path)[1]
+
+    def prefetch(self, paths):
+        """
+        Queues up hashing of paths in the background thread pool, so that later calls to sha256()/sampled() don't
+        have to wait on the reads
+        :param paths: iterable of file paths
+        """
+        for path in paths:
+            path = os.path.realpath(path)
+            if path not in self.pending:
+                self.pending[path] = self.executor.submit(self._hash, path)
+
+    def close(self):
+        """
+        Waits for any background hashing to finish, and closes the index
+        """
+        self.executor.shutdown(wait=True)
+        self.pending = dict()
+        self.connection.close()
+
+
+_store = None
+
+
+def get_store():
+    """
+    :return: FingerprintStore shared by everything running in this process
+    """
+    global _store
+    if _store is None:
+        _store = FingerprintStore()
+    return _store
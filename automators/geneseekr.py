@@ -3,12 +3,13 @@ import glob
 import click
 import pickle
 import shutil
-from biotools import mash
-from amrsummary import before_send
-import sentry_sdk
-from automator_settings import SENTRY_DSN
+from amrsummary import capture_exception
 from automator_settings import COWBAT_DATABASES
-from nastools.nastools import retrieve_nas_files
+from result_cache import ResultCache, database_version
+from fingerprint import file_sha256
+from lazy_import import lazy_import, lazy_function
+mash = lazy_import('biotools.mash')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 
 @click.command()
@@ -17,7 +18,6 @@ from nastools.nastools import retrieve_nas_files
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def geneseekr_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     # Unpickle Redmine objects
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
     issue = pickle.load(open(issue, 'rb'))
@@ -180,32 +180,60 @@ def geneseekr_redmine(redmine_instance, issue, work_dir, description):
         # These unfortunate hard coded paths appear to be necessary
         activate = 'source /home/ubuntu/miniconda3/bin/activate /mnt/nas2/virtual_environments/geneseekr'
         seekr_py = '/mnt/nas2/virtual_environments/geneseekr/bin/GeneSeekr'
-        # Run sipprverse with the necessary arguments
-        seekr_cmd = 'python {seekr_py} {blast} -s {seqpath} -r {outpath} -t {dbpath} -c {cutoff} -e {evalue} {atf}'\
-            .format(seekr_py=seekr_py,
-                    blast=argument_dict['blast'],
-                    seqpath=work_dir,
-                    outpath=os.path.join(work_dir, 'reports'),
-                    dbpath=database_path[argument_dict['analysis']],
-                    cutoff=argument_dict['cutoff'],
-                    evalue=argument_dict['evalue'],
-                    atf=argument_flags[argument_dict['analysis']])
-        # Append the align and/or the unique flags are required
-        seekr_cmd += ' -a' if argument_dict['align'] else ''
-        seekr_cmd += ' -u' if argument_dict['unique'] else ''
-        seekr_cmd += ' -f' if argument_dict['fasta'] else ''
-        # Update the issue with the GeneSeekr command
-        redmine_instance.issue.update(resource_id=issue.id,
-                                      notes='GeneSeekr command:\n {cmd}'.format(cmd=seekr_cmd))
-        # Create another shell script to execute within the PlasmidExtractor conda environment
-        template = "#!/bin/bash\n{} && {}".format(activate, seekr_cmd)
-        geneseekr_script = os.path.join(work_dir, 'run_geneseekr.sh')
-        with open(geneseekr_script, 'w+') as file:
-            file.write(template)
-        # Modify the permissions of the script to allow it to be run on the node
-        make_executable(geneseekr_script)
-        # Run shell script
-        os.system(geneseekr_script)
+
+        def run_geneseekr(seqpath, outpath):
+            # Run sipprverse with the necessary arguments
+            seekr_cmd = 'python {seekr_py} {blast} -s {seqpath} -r {outpath} -t {dbpath} -c {cutoff} -e {evalue} ' \
+                        '{atf}'.format(seekr_py=seekr_py,
+                                       blast=argument_dict['blast'],
+                                       seqpath=seqpath,
+                                       outpath=outpath,
+                                       dbpath=database_path[argument_dict['analysis']],
+                                       cutoff=argument_dict['cutoff'],
+                                       evalue=argument_dict['evalue'],
+                                       atf=argument_flags[argument_dict['analysis']])
+            # Append the align and/or the unique flags are required
+            seekr_cmd += ' -a' if argument_dict['align'] else ''
+            seekr_cmd += ' -u' if argument_dict['unique'] else ''
+            seekr_cmd += ' -f' if argument_dict['fasta'] else ''
+            # Update the issue with the GeneSeekr command
+            redmine_instance.issue.update(resource_id=issue.id,
+                                          notes='GeneSeekr command:\n {cmd}'.format(cmd=seekr_cmd))
+            # Create another shell script to execute within the PlasmidExtractor conda environment
+            template = "#!/bin/bash\n{} && {}".format(activate, seekr_cmd)
+            geneseekr_script = os.path.join(work_dir, 'run_geneseekr.sh')
+            with open(geneseekr_script, 'w+') as file:
+                file.write(template)
+            # Modify the permissions of the script to allow it to be run on the node
+            make_executable(geneseekr_script)
+            # Run shell script
+            os.system(geneseekr_script)
+
+        if argument_dict['align'] or argument_dict['fasta']:
+            # Alignments and FASTA outputs are written per gene rather than per strain, so these aren't cached
+            run_geneseekr(seqpath=work_dir,
+                          outpath=os.path.join(work_dir, 'reports'))
+        else:
+            # Only assemblies without cached rows for this analysis are run through GeneSeekr. Custom targets are
+            # different in every issue, so they are identified by their contents rather than the folder they are in
+            fasta_dict = dict()
+            for fasta in glob.glob(os.path.join(work_dir, '*.fasta')):
+                fasta_dict[os.path.splitext(os.path.basename(fasta))[0]] = fasta
+            if argument_dict['analysis'] == 'custom':
+                db_version = file_sha256(os.path.join(target_dir, 'targets.tfa'))
+            else:
+                db_version = database_version(database_path[argument_dict['analysis']])
+            cache = ResultCache(automator='geneseekr',
+                                parameters={key: value for key, value in argument_dict.items()
+                                            if key not in ('align', 'fasta')},
+                                db_version=db_version)
+            try:
+                cache.combined_reports(fasta_dict=fasta_dict,
+                                       report_dir=os.path.join(work_dir, 'reports'),
+                                       work_dir=work_dir,
+                                       analyse=run_geneseekr)
+            finally:
+                cache.close()
 
         # Zip output
         output_filename = 'geneseekr_output'
@@ -234,7 +262,7 @@ def geneseekr_redmine(redmine_instance, issue, work_dir, description):
                                       notes='{at} analysis with GeneSeekr complete!'
                                       .format(at=argument_dict['analysis'].lower()))
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -0,0 +1,149 @@
+import os
+import re
+import glob
+import shutil
+import socket
+import tempfile
+from fingerprint import get_store
+from result_cache import database_version
+from concurrent.futures import ThreadPoolExecutor
+from lazy_import import lazy_import
+mash = lazy_import('biotools.mash')
+
+# RefSeq sketch used to call the genus of assemblies
+REFSEQ_SKETCH = '/mnt/nas2/databases/confindr/databases/refseq.msh'
+# Genus calls are cached by assembly fingerprint and sketch version, as one file per assembly holding the genus under
+# {sketch version}/{sha256[:2]}/{sha256}. Calls are written once and never updated, so jobs on different nodes can add to
+# the cache at the same time without the locking that SQLite can't do reliably on the NAS
+GENUS_CACHE_DIR = '/mnt/nas2/redmine/genus_cache'
+
+
+def stage_sketch(sketch, local_dir=None):
+    """
+    Copies a mash sketch from the NAS to node-local storage, so that every screen run on the node reads it from local
+    disk instead of pulling it over NFS again. The copy is reused for as long as the size and mtime of the original
+    stay the same. Staging a new version removes the copies of older versions
+    :param sketch: path to the mash sketch on the NAS
+    :param local_dir: node-local folder to copy the sketch to. Defaults to the temporary folder
+    :return: path to the local copy of the sketch
+    """
+    if local_dir is None:
+        local_dir = tempfile.gettempdir()
+    stat = os.stat(sketch)
+    local_sketch = os.path.join(local_dir, '{size}_{mtime}_{name}'.format(size=stat.st_size,
+                                                                      mtime=int(stat.st_mtime),
+                                                                      name=os.path.basename(sketch)))
+    if not os.path.isfile(local_sketch):
+        temp_sketch = local_sketch + '.{pid}.tmp'.format(pid=os.getpid())
+        shutil.copyfile(sketch, temp_sketch)
+        os.replace(temp_sketch, local_sketch)
+        # Jobs still screening against an old copy keep their open file, so it is safe to remove
+        for old_sketch in glob.glob(os.path.join(local_dir, '*_*_{name}'.format(name=os.path.basename(sketch)))):
+            if old_sketch != local_sketch and re.match(r'\d+_\d+_', os.path.basename(old_sketch)):
+                try:
+                    os.remove(old_sketch)
+                except OSError:  # Another job got there first
+                    pass
+    return local_sketch
+
+
+def screen_genus(fasta, sketch, output_file, threads):
+    """
+    Runs mash screen on an assembly, and pulls the genus of the best hit out of the RefSeq path of the hit
+    :param fasta: path to assembly
+    :param sketch: path to the RefSeq mash sketch
+    :param output_file: path to write the mash screen output to
+    :param threads: number of threads for mash to use
+    :return: genus of the assembly, or None if mash didn't find anything
+    """
+    mash.screen(sketch,
+                fasta,
+                threads=threads,
+                w='',
+                i='0.95',
+                output_file=output_file,
+                returncmd=True)
+    organism = None
+    for screen in mash.read_mash_screen(output_file):
+        # Extract the genus from the mash results
+        organism = screen.query_id.split('/')[-3]
+    return organism
+
+
+def cached_genus(cache_dir, sha256):
+    """
+    :param cache_dir: folder of genus calls for the current sketch version
+    :param sha256: sha256 of the assembly
+    :return: the cached genus of the assembly, or None if it hasn't been called yet
+    """
+    try:
+        with open(os.path.join(cache_dir, sha256[:2], sha256)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def cache_genus(cache_dir, sha256, organism):
+    """
+    Records the genus of an assembly. The call is written under a temporary name and renamed into place, so a reader
+    never sees half of it
+    :param cache_dir: folder of genus calls for the current sketch version
+    :param sha256: sha256 of the assembly
+    :param organism: genus of the assembly
+    """
+    path = os.path.join(cache_dir, sha256[:2], sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = '{path}.{host}_{pid}.tmp'.format(path=path, host=socket.gethostname(), pid=os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write(organism)
+    os.replace(temp_path, path)
+
+
+def call_genera(fasta_dict, output_dir, threads=8, processes=4, sketch=REFSEQ_SKETCH, cache_root=GENUS_CACHE_DIR):
+    """
+    Determines the genus of a set of assemblies. Previously screened assemblies are looked up by fingerprint; the
+    rest are screened concurrently against a single node-local copy of the sketch. The mash screen output for each
+    screened assembly is written to output_dir/{seqid}_screen.tab
+    :param fasta_dict: dictionary of SeqID: path to assembly
+    :param output_dir: folder to write mash screen outputs to
+    :param threads: total number of threads to use
+    :param processes: maximum number of mash screen processes to run at once
+    :param sketch: path to the RefSeq mash sketch
+    :param cache_root: folder of cached genus calls
+    :return: dictionary of SeqID: genus. SeqIDs mash could not call are left out
+    """
+    fingerprints = get_store()
+    fingerprints.prefetch(fasta_dict.values())
+    sketch_version = database_version(sketch)
+    cache_dir = os.path.join(cache_root, sketch_version)
+    genus_dict = dict()
+    unscreened = dict()
+    for seqid, fasta in fasta_dict.items():
+        organism = cached_genus(cache_dir, fingerprints.sha256(fasta))
+        if organism is not None:
+            genus_dict[seqid] = organism
+        else:
+            unscreened[seqid] = fasta
+    if unscreened:
+        local_sketch = stage_sketch(sketch)
+        processes = min(processes, len(unscreened))
+        with ThreadPoolExecutor(max_workers=processes) as executor:
+            futures = dict()
+            for seqid, fasta in unscreened.items():
+                futures[seqid] = executor.submit(screen_genus,
+                                                 fasta=fasta,
+                                                 sketch=local_sketch,
+                                                 output_file=os.path.join(output_dir,
+                                                                          '{seqid}_screen.tab'.format(seqid=seqid)),
+                                                 threads=max(1, threads // processes))
+        for seqid, future in futures.items():
+            organism = future.result()
+            # Failed screens aren't cached, so that they get another chance next time
+            if organism is not None:
+                genus_dict[seqid] = organism
+                cache_genus(cache_dir, fingerprints.sha256(unscreened[seqid]), organism)
+        # Calls made against older versions of the sketch are never looked up again
+        for old_dir in glob.glob(os.path.join(cache_root, '*')):
+            if old_dir != cache_dir:
+                shutil.rmtree(old_dir, ignore_errors=True)
+    return genus_dict
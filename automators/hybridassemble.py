@@ -6,11 +6,12 @@ import click
 import pickle
 import shutil
 import fnmatch
-from nastools.nastools import retrieve_nas_files
 
 from ftplib import FTP
 from automator_settings import FTP_USERNAME, FTP_PASSWORD
 import traceback
+from lazy_import import lazy_function
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
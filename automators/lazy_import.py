@@ -0,0 +1,50 @@
+"""
+Deferred imports for the heavy dependencies of the automators (pandas, Bio, pylatex, sentry_sdk, biotools, nastools,
+...). Automators are started fresh for every job, and a lot of requests get a note posted back within a moment of
+starting (a bad description, a missing SeqID) - those shouldn't have to wait for several seconds of imports they never
+use. sentry_sdk is not even started until something goes wrong - see amrsummary.capture_exception and
+amrsummary.report_uncaught.
+tests/import_budget.py keeps an eye on how long importing each automator takes.
+
+    pd = lazy_import('pandas')                                         # instead of import pandas as pd
+    mash = lazy_import('biotools.mash')                                # instead of from biotools import mash
+    retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
+"""
+import sys
+import importlib
+import importlib.util
+
+
+def lazy_import(name):
+    """
+    :param name: full name of the module to import (i.e. 'Bio.SeqIO')
+    :return: the module, which is only actually loaded the first time one of its attributes is used. Parent packages
+             are imported straight away, so only the named module itself is deferred
+    :raises ImportError: if the module can't be found, the same as a normal import would
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named {}'.format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    if '.' in name:
+        parent, child = name.rsplit('.', 1)
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def lazy_function(module_name, function_name):
+    """
+    :param module_name: full name of the module the function lives in
+    :param function_name: name of the function
+    :return: stand-in for the function that imports the module the first time it is called
+    """
+    def function(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), function_name)(*args, **kwargs)
+    function.__name__ = function_name
+    return function
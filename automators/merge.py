@@ -3,13 +3,11 @@ import glob
 import click
 import pickle
 import shutil
-import pandas as pd
-from pandas import ExcelWriter
-import sentry_sdk
-from amrsummary import before_send
-from automator_settings import SENTRY_DSN
-from nastools.nastools import retrieve_nas_files
+from amrsummary import capture_exception
 from automator_settings import COWBAT_IMAGE, COWBAT_DATABASES
+from lazy_import import lazy_import, lazy_function
+pd = lazy_import('pandas')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 
 @click.command()
@@ -19,7 +17,6 @@ from automator_settings import COWBAT_IMAGE, COWBAT_DATABASES
 @click.option('--description', help='Path to pickled Redmine description')
 def merge_redmine(redmine_instance, issue, work_dir, description):
     # Unpickle Redmine objects
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
     issue = pickle.load(open(issue, 'rb'))
     description = pickle.load(open(description, 'rb'))
@@ -108,7 +105,7 @@ def merge_redmine(redmine_instance, issue, work_dir, description):
         redmine_instance.issue.update(resource_id=issue.id, uploads=output_list, status_id=4,
                                       notes='Merge Process Complete! Reports attached.')
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -121,7 +118,7 @@ def convert_excel_file(infile, outfile):
         if column not in to_keep:
             df = df.drop(column, axis=1)
     df = df.rename(columns={'SEQID': 'Name', 'OtherName': 'Merge'})
-    writer = ExcelWriter(outfile)
+    writer = pd.ExcelWriter(outfile)
     df.to_excel(writer, 'Sheet1', index=False)
     writer.save()
 
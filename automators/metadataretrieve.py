@@ -2,9 +2,7 @@ import os
 import glob
 import click
 import pickle
-import sentry_sdk
-from amrsummary import before_send
-from automator_settings import SENTRY_DSN
+from amrsummary import capture_exception
 
 
 @click.command()
@@ -13,7 +11,6 @@ from automator_settings import SENTRY_DSN
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def metadataretrieve_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     print('Metadata retrieving!')
     # Unpickle Redmine objects
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
@@ -66,7 +63,7 @@ def metadataretrieve_redmine(redmine_instance, issue, work_dir, description):
                                       notes='Metadata Retrieve Complete.')
 
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -4,12 +4,12 @@ import click
 import pickle
 import shutil
 import ftplib
-import sentry_sdk
-from automator_settings import SENTRY_DSN
-from amrsummary import before_send
+from amrsummary import capture_exception
 from externalretrieve import upload_to_ftp
 from automator_settings import FTP_USERNAME, FTP_PASSWORD
-from nastools.nastools import retrieve_nas_files
+from result_cache import ResultCache, database_version
+from lazy_import import lazy_function
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
@@ -17,7 +17,6 @@ from nastools.nastools import retrieve_nas_files
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def mob_suite(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     """
     """
     # Unpickle Redmine objects
@@ -49,14 +48,37 @@ def mob_suite(redmine_instance, issue, work_dir, description):
         if not os.path.isdir(output_dir):
             os.makedirs(output_dir)
 
+        # Copy the results of any assemblies that have already been through mob_recon out of the result cache, and only
+        # run the rest
+        fasta_dict = dict()
         for fasta in fasta_files:
-            seqid = os.path.split(fasta)[-1].split('.')[0]
-            # Run mobsuite via docker, since I can't seem to make it work with slurm any other way.
-            cmd = 'docker run --rm -i -u $(id -u) -v /mnt/nas2:/mnt/nas2 mob_suite:latest /bin/bash -c "source activate ' \
-                  '/mnt/nas2/virtual_environments/mob_suite && mob_recon -i {input_fasta} -o {output_dir} ' \
-                  '--run_typer"'.format(input_fasta=fasta,
-                                        output_dir=os.path.join(output_dir, seqid))
-            os.system(cmd)
+            fasta_dict[os.path.split(fasta)[-1].split('.')[0]] = fasta
+        # The MOB-suite databases live within the package, and are updated in place by mob_init
+        mob_suite_db = glob.glob('/mnt/nas2/virtual_environments/mob_suite/lib/python3*/site-packages/mob_suite/'
+                                 'databases')
+        cache = ResultCache(automator='mobsuite',
+                            parameters={'run_typer': True},
+                            db_version=database_version(mob_suite_db[0] if mob_suite_db
+                                                        else '/mnt/nas2/virtual_environments/mob_suite',
+                                                        recursive=True))
+        try:
+            uncached = cache.partition(fasta_dict=fasta_dict,
+                                       output_dir=output_dir,
+                                       output_name='{seqid}')
+
+            for seqid, fasta in sorted(uncached.items()):
+                # Run mobsuite via docker, since I can't seem to make it work with slurm any other way.
+                cmd = 'docker run --rm -i -u $(id -u) -v /mnt/nas2:/mnt/nas2 mob_suite:latest /bin/bash -c ' \
+                      '"source activate /mnt/nas2/virtual_environments/mob_suite && ' \
+                      'mob_recon -i {input_fasta} -o {output_dir} --run_typer"'\
+                    .format(input_fasta=fasta,
+                            output_dir=os.path.join(output_dir, seqid))
+                os.system(cmd)
+            cache.store_all(fasta_dict=uncached,
+                            output_dir=output_dir,
+                            output_name='{seqid}')
+        finally:
+            cache.close()
 
         # With mobsuite done, zip up the results folder and upload to the FTP.
         shutil.make_archive(root_dir=output_dir,
@@ -84,7 +106,7 @@ def mob_suite(redmine_instance, issue, work_dir, description):
                                                 'Please try again later.')
 
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -2,11 +2,15 @@ import os
 import glob
 import click
 import pickle
-from Bio import Phylo
-from Bio import SeqIO
-from biotools import mash
-from collections import OrderedDict
-from nastools.nastools import retrieve_nas_files
+import tempfile
+from sketch_cache import sketch_assemblies, combine_sketches
+from tree_distances import distances_to_clade
+from lazy_import import lazy_import, lazy_function
+np = lazy_import('numpy')
+Phylo = lazy_import('Bio.Phylo')
+SeqIO = lazy_import('Bio.SeqIO')
+mash = lazy_import('biotools.mash')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
@@ -89,14 +93,6 @@ def neartree_redmine(redmine_instance, issue, work_dir, description):
                                                 'try again.'.format(samples=outstr,
                                                                     reference=os.path.split(reference_file)[-1]))
 
-        # Remove distances.tab and sketch.msh from fastas folder, because sometimes they make
-        # parsnp crash. Other times they don't. I have no idea why, so remove just to be safe.
-        try:
-            os.remove(os.path.join(work_dir, 'fastas', 'distances.tab'))
-            os.remove(os.path.join(work_dir, 'fastas', 'sketch.msh'))
-        except OSError:
-            pass
-
         cmd = '/mnt/nas/Programs/Parsnp-Linux64-v1.2/parsnp -r {workdir}/reference.fasta -d {input} ' \
               '-c -o {output} -p {threads}'.format(threads=48,
                                                    workdir=work_dir,
@@ -108,21 +104,18 @@ def neartree_redmine(redmine_instance, issue, work_dir, description):
         ref_clades = tree.find_clades('reference.fasta.ref')
         for clade in ref_clades:
             ref_clade = clade
-        clades = tree.get_terminals()
-        distance_dict = dict()
-        for clade in clades:
-            distance = tree.distance(clade, ref_clade)
-            distance_dict[clade.name] = distance
-
-        # Use some stackoverflow magic to sort dict https://stackoverflow.com/questions/613183/how-do-i-sort-a-dictionary-by-value
-        sorted_dict = OrderedDict(sorted(distance_dict.items(), key=lambda x: x[1]))
+        # Distances from every tip to the reference come out of a single walk of the tree
+        clades, distances = distances_to_clade(tree, ref_clade)
+        names = [clade.name for clade in clades]
+        candidates = np.array([i for i, name in enumerate(names) if 'reference' not in name], dtype=int)
+        num_strains = min(desired_num_strains, len(candidates))
 
-        i = 0
+        # Only the closest num_strains tips need to be sorted
         outstr = ''
-        for key in sorted_dict:
-            if 'reference' not in key and i < desired_num_strains:
-                outstr += key.replace('.fasta', '') + '\n'
-                i += 1
+        if num_strains > 0:
+            closest = candidates[np.argpartition(distances[candidates], num_strains - 1)[:num_strains]]
+            for i in closest[np.argsort(distances[closest], kind='mergesort')]:
+                outstr += names[i].replace('.fasta', '') + '\n'
 
         redmine_instance.issue.update(resource_id=issue.id, status_id=4,
                                       notes='NearTree process complete! Closest strains are:\n {}'.format(outstr))
@@ -135,14 +128,18 @@ def neartree_redmine(redmine_instance, issue, work_dir, description):
 
 def check_distances(ref_fasta, fasta_folder):
     bad_fastqs = list()
-    # fastqs = glob.glob(os.path.join(fastq_folder, '*R1*'))
-    mash.sketch(os.path.join(fasta_folder, '*.fasta'), output_sketch=os.path.join(fasta_folder, 'sketch.msh'), threads=56)
-    mash.dist(os.path.join(fasta_folder, 'sketch.msh'), ref_fasta, threads=56, output_file=os.path.join(fasta_folder, 'distances.tab'))
-    mash_output = mash.read_mash_output(os.path.join(fasta_folder, 'distances.tab'))
-    for item in mash_output:
-        print(item.reference, item.query, str(item.distance))
-        if item.distance > 0.06:  # May need to adjust this value.
-            bad_fastqs.append(item.reference)
+    # Sketches come out of the persistent sketch cache, so only assemblies that haven't been seen before get sketched.
+    # The combined sketch and distances are kept out of fasta_folder, since they sometimes make parsnp crash.
+    fastas = sorted(glob.glob(os.path.join(fasta_folder, '*.fasta')))
+    ref_sketch = sketch_assemblies([ref_fasta], threads=56)[0]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        sketch = combine_sketches(sketch_assemblies(fastas, threads=56), os.path.join(temp_dir, 'sketch'))
+        mash.dist(sketch, ref_sketch, threads=56, output_file=os.path.join(temp_dir, 'distances.tab'))
+        mash_output = mash.read_mash_output(os.path.join(temp_dir, 'distances.tab'))
+        for item in mash_output:
+            print(item.reference, item.query, str(item.distance))
+            if item.distance > 0.06:  # May need to adjust this value.
+                bad_fastqs.append(item.reference)
     return bad_fastqs
 
 
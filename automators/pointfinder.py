@@ -1,14 +1,14 @@
-from accessoryFunctions.accessoryFunctions import make_path
-from nastools.nastools import retrieve_nas_files
-from biotools import mash
+from genus_caller import call_genera
+from result_cache import ResultCache, database_version
 import pickle
 import shutil
 import click
 import glob
 import os
-import sentry_sdk
-from amrsummary import before_send
-from automator_settings import SENTRY_DSN
+from amrsummary import report_uncaught_exceptions
+from lazy_import import lazy_function
+make_path = lazy_function('accessoryFunctions.accessoryFunctions', 'make_path')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 
 def write_report(summary_dict, seqid, genus, key):
@@ -122,7 +122,8 @@ def write_table_report(summary_dict, seqid, genus):
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def pointfinder_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
+    # Nothing is caught here - errors are reported to Sentry as they leave the automator
+    report_uncaught_exceptions()
     # Unpickle Redmine objects
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
     issue = pickle.load(open(issue, 'rb'))
@@ -154,9 +155,8 @@ def pointfinder_redmine(redmine_instance, issue, work_dir, description):
     fasta_list = sorted(glob.glob(os.path.join(work_dir, '*.fasta')))
     # Set the folder to store all the PointFinder outputs
     pointfinder_output_dir = os.path.join(work_dir, 'pointfinder_outputs')
-    # Initialise a dictionaries to store the mash-calculated, and pointfinder-formatted genus outputs for each strain
+    # Initialise a dictionary to store the pointfinder-formatted genus outputs for each strain
     genus_dict = dict()
-    organism_dict = dict()
     # Create lists to store missing and unprocessed seqids
     unprocessed_seqs = list()
     missing_seqs = list()
@@ -246,30 +246,18 @@ def pointfinder_redmine(redmine_instance, issue, work_dir, description):
             }
     }
 
-    # Run mash screen on each of the assemblies
+    # Call the genus of all the assemblies with one staged copy of the RefSeq sketch
+    fasta_dict = dict()
     for item in fasta_list:
-        seqid = os.path.splitext(os.path.basename(item))[0]
-        screen_file = os.path.join(output_dir, '{seqid}_screen.tab'.format(seqid=seqid))
-        mash.screen('/mnt/nas2/databases/confindr/databases/refseq.msh',
-                    item,
-                    threads=8,
-                    w='',
-                    i='0.95',
-                    output_file=screen_file,
-                    returncmd=True)
-        screen_output = mash.read_mash_screen(screen_file)
-        # Determine the genus from the screen output file
-        for screen in screen_output:
-            # Extract the genus from the mash results
-            mash_organism = screen.query_id.split('/')[-3]
-            # Use the organism as a key in the pointfinder database name conversion dictionary
-            try:
-                mash_genus = pointfinder_org_dict[mash_organism]
-            except KeyError:
-                mash_genus = 'NA'
-            # Populate the dictionaries with the seqid, and the calculated genus/pointfinder name
-            genus_dict[seqid] = mash_genus
-            organism_dict[seqid] = mash_organism
+        fasta_dict[os.path.splitext(os.path.basename(item))[0]] = item
+    organism_dict = call_genera(fasta_dict=fasta_dict,
+                                output_dir=output_dir)
+    for seqid, mash_organism in organism_dict.items():
+        # Use the organism as a key in the pointfinder database name conversion dictionary
+        try:
+            genus_dict[seqid] = pointfinder_org_dict[mash_organism]
+        except KeyError:
+            genus_dict[seqid] = 'NA'
     # Delete all of the FASTA files
     for fasta in fasta_list:
         os.remove(fasta)
@@ -288,71 +276,90 @@ def pointfinder_redmine(redmine_instance, issue, work_dir, description):
         os.mkdir(pointfinder_output_dir)
     except FileExistsError:
         pass
-    # Pointfinder cannot handle an entire folder of sequences; each sample must be processed independently
-    for seqid in sorted(seqids):
-        # If the seqid isn't present in the dictionary, it is because the assembly could not be found - or because
-        # MASH screen failed
-        try:
-            # Look up the PointFinder and the MASH-calculated genera
-            pointfinder_genus = genus_dict[seqid]
-            genus = rev_org_dict[pointfinder_genus]
-            # If the genus isn't in the pointfinder database, do not attempt to process it
-            if pointfinder_genus in pointfinder_list:
-                # Create folder to drop FASTA files
-                assembly_folder = os.path.join(work_dir, seqid)
-                make_path(assembly_folder)
-                # Extract FASTA files.
-                retrieve_nas_files(seqids=[seqid],
-                                   outdir=assembly_folder,
-                                   filetype='fasta',
-                                   copyflag=False)
-                fasta = os.path.join(assembly_folder, '{seqid}.fasta'.format(seqid=seqid))
-                # Prepare command
-                cmd = 'python {py} -i {fasta} -s {orgn} -p {db} -o {output} -m blastn -m_p {blast_path}'\
-                    .format(py=pointfinder_py,
-                            fasta=fasta,
-                            orgn=pointfinder_genus,
-                            db=pointfinder_db,
-                            output=pointfinder_output_dir,
-                            blast_path='/mnt/nas2/virtual_environments/pointfinder/bin/blastn'
-                            )
-                # Create another shell script to execute within the PlasmidExtractor conda environment
-                template = "#!/bin/bash\n{} && {}".format(activate, cmd)
-                pointfinder_script = os.path.join(work_dir, 'run_pointfinder.sh')
-                with open(pointfinder_script, 'w+') as file:
-                    file.write(template)
-                # Modify the permissions of the script to allow it to be run on the node
-                make_executable(pointfinder_script)
-                # Run shell script
-                os.system(pointfinder_script)
-                # Find the pointfinder outputs
-                summary_dict[genus]['prediction']['output'] = \
-                    glob.glob(os.path.join(pointfinder_output_dir, '{seq}*prediction.txt'.format(seq=seqid)))[0]
-                summary_dict[genus]['table']['output'] = \
-                    glob.glob(os.path.join(pointfinder_output_dir, '{seq}*table.txt'.format(seq=seqid)))[0]
-                summary_dict[genus]['results']['output'] = \
-                    glob.glob(os.path.join(pointfinder_output_dir, '{seq}*results.txt'.format(seq=seqid)))[0]
-                # Process the predictions
-                write_report(summary_dict=summary_dict,
-                             seqid=seqid,
-                             genus=genus,
-                             key='prediction')
-                # Process the results summary
-                write_report(summary_dict=summary_dict,
-                             seqid=seqid,
-                             genus=genus,
-                             key='results')
-                # Process the table summary
-                write_table_report(summary_dict=summary_dict,
-                                   seqid=seqid,
-                                   genus=genus)
-            else:
-                unprocessed_seqs.append(seqid)
-        except KeyError:
-            if not os.path.isfile(os.path.join(output_dir, '{seq}_screen.tab'.format(seq=seqid))):
-                missing_seqs.append(seqid)
-            else:
-                mash_fails.append(seqid)
+    # PointFinder outputs for assemblies that have already been processed are reused from the result cache
+    cache_dir = os.path.join(work_dir, 'pointfinder_cache')
+    cache = ResultCache(automator='pointfinder',
+                        parameters={'method': 'blastn'},
+                        db_version=database_version(pointfinder_db))
+    try:
+        # Pointfinder cannot handle an entire folder of sequences; each sample must be processed independently
+        for seqid in sorted(seqids):
+            # If the seqid isn't present in the dictionary, it is because the assembly could not be found - or because
+            # MASH screen failed
+            try:
+                # Look up the PointFinder and the MASH-calculated genera
+                pointfinder_genus = genus_dict[seqid]
+                genus = rev_org_dict[pointfinder_genus]
+                # If the genus isn't in the pointfinder database, do not attempt to process it
+                if pointfinder_genus in pointfinder_list:
+                    # Create folder to drop FASTA files
+                    assembly_folder = os.path.join(work_dir, seqid)
+                    make_path(assembly_folder)
+                    # Extract FASTA files.
+                    retrieve_nas_files(seqids=[seqid],
+                                       outdir=assembly_folder,
+                                       filetype='fasta',
+                                       copyflag=False)
+                    fasta = os.path.join(assembly_folder, '{seqid}.fasta'.format(seqid=seqid))
+                    seqid_cache_dir = os.path.join(cache_dir, seqid)
+                    if cache.fetch(seqid, fasta, seqid_cache_dir):
+                        for output in glob.glob(os.path.join(seqid_cache_dir, '*')):
+                            shutil.copy(output, pointfinder_output_dir)
+                    else:
+                        # Prepare command
+                        cmd = 'python {py} -i {fasta} -s {orgn} -p {db} -o {output} -m blastn -m_p {blast_path}'\
+                            .format(py=pointfinder_py,
+                                    fasta=fasta,
+                                    orgn=pointfinder_genus,
+                                    db=pointfinder_db,
+                                    output=pointfinder_output_dir,
+                                    blast_path='/mnt/nas2/virtual_environments/pointfinder/bin/blastn'
+                                    )
+                        # Create another shell script to execute within the PlasmidExtractor conda environment
+                        template = "#!/bin/bash\n{} && {}".format(activate, cmd)
+                        pointfinder_script = os.path.join(work_dir, 'run_pointfinder.sh')
+                        with open(pointfinder_script, 'w+') as file:
+                            file.write(template)
+                        # Modify the permissions of the script to allow it to be run on the node
+                        make_executable(pointfinder_script)
+                        # Run shell script
+                        os.system(pointfinder_script)
+                        # Keep copies of the outputs for this assembly in the result cache
+                        make_path(seqid_cache_dir)
+                        for output in glob.glob(os.path.join(pointfinder_output_dir, '{seq}*.txt'.format(seq=seqid))):
+                            shutil.copy(output, seqid_cache_dir)
+                        cache.store(seqid, fasta, seqid_cache_dir)
+                    # Find the pointfinder outputs
+                    summary_dict[genus]['prediction']['output'] = \
+                        glob.glob(os.path.join(pointfinder_output_dir, '{seq}*prediction.txt'.format(seq=seqid)))[0]
+                    summary_dict[genus]['table']['output'] = \
+                        glob.glob(os.path.join(pointfinder_output_dir, '{seq}*table.txt'.format(seq=seqid)))[0]
+                    summary_dict[genus]['results']['output'] = \
+                        glob.glob(os.path.join(pointfinder_output_dir, '{seq}*results.txt'.format(seq=seqid)))[0]
+                    # Process the predictions
+                    write_report(summary_dict=summary_dict,
+                                 seqid=seqid,
+                                 genus=genus,
+                                 key='prediction')
+                    # Process the results summary
+                    write_report(summary_dict=summary_dict,
+                                 seqid=seqid,
+                                 genus=genus,
+                                 key='results')
+                    # Process the table summary
+                    write_table_report(summary_dict=summary_dict,
+                                       seqid=seqid,
+                                       genus=genus)
+                else:
+                    unprocessed_seqs.append(seqid)
+            except KeyError:
+                # Genus calls can come from the cache without a screen file, so check for the assembly itself
+                if seqid not in fasta_dict:
+                    missing_seqs.append(seqid)
+                else:
+                    mash_fails.append(seqid)
+    finally:
+        cache.close()
     # Attempt to clear out the tmp folder from the pointfinder_output_dir
     try:
         shutil.rmtree(os.path.join(pointfinder_output_dir, 'tmp'))
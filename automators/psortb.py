@@ -3,11 +3,10 @@ import glob
 import click
 import pickle
 import shutil
-import sentry_sdk
-from automator_settings import SENTRY_DSN
-from amrsummary import before_send
-from nastools.nastools import retrieve_nas_files
+from amrsummary import capture_exception
 from externalretrieve import upload_to_ftp, check_fastas_present
+from lazy_import import lazy_function
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
@@ -15,7 +14,6 @@ from externalretrieve import upload_to_ftp, check_fastas_present
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def psortb_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     try:
         # Unpickle Redmine objects
         redmine_instance = pickle.load(open(redmine_instance, 'rb'))
@@ -140,7 +138,7 @@ def psortb_redmine(redmine_instance, issue, work_dir, description):
         shutil.rmtree(assemblies_folder)
         shutil.rmtree(prokka_folder)
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
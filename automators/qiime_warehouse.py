@@ -0,0 +1,189 @@
+import os
+import click
+import sqlite3
+from qzv_reader import find_taxonomy_barplots, read_all_levels, run_name, run_date
+from lazy_import import lazy_import
+pd = lazy_import('pandas')
+
+# Long-format store of every run's QIIME2 taxonomy tables and sample metadata. The ingester (main, run from cron on the
+# head node) keeps the working copy on local disk, where SQLite locking works, and publishes a snapshot of it to the NAS
+# for the automators to read. Snapshots are replaced in one rename and never written in place, so readers don't need
+# any locks on NFS
+LOCAL_WAREHOUSE_DB = '/var/local/redmine/qiime2_warehouse.sqlite'
+WAREHOUSE_DB = '/mnt/nas2/redmine/qiime2_warehouse.sqlite'
+
+
+def is_taxonomy_column(column):
+    """
+    :param column: column name from a QIIME2 level CSV
+    :return: True if the column holds counts for a taxon, False if it is the sample index or metadata
+    """
+    return column.startswith('D_0__') or column.startswith('Unassigned')
+
+
+def connect(db_path=LOCAL_WAREHOUSE_DB):
+    """
+    Opens the working copy of the warehouse, creating the tables and indexes if they don't exist yet
+    :param db_path: path to the working copy of the warehouse
+    :return: sqlite3 connection
+    """
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=60)
+    connection.execute('CREATE TABLE IF NOT EXISTS runs (run TEXT PRIMARY KEY, date TEXT, path TEXT, mtime REAL)')
+    connection.execute('CREATE TABLE IF NOT EXISTS counts (run TEXT, sample TEXT, level INTEGER, taxon TEXT, '
+                       'count NUMERIC)')
+    connection.execute('CREATE TABLE IF NOT EXISTS metadata (run TEXT, sample TEXT, field TEXT, value TEXT, '
+                       'position INTEGER)')
+    connection.execute('CREATE INDEX IF NOT EXISTS counts_level_run ON counts (level, run)')
+    connection.execute('CREATE INDEX IF NOT EXISTS metadata_run ON metadata (run)')
+    connection.execute('CREATE INDEX IF NOT EXISTS runs_date ON runs (date)')
+    connection.commit()
+    return connection
+
+
+def ingest_run(connection, tax_barplot):
+    """
+    Replaces everything stored for a run with the level 1-7 tables and sample metadata from its archive
+    :param connection: sqlite3 connection to the warehouse
+    :param tax_barplot: path to the run's taxonomy_barplot.qzv
+    """
+    run = run_name(tax_barplot)
+    levels = read_all_levels(tax_barplot)
+    connection.execute('DELETE FROM counts WHERE run = ?', (run,))
+    connection.execute('DELETE FROM metadata WHERE run = ?', (run,))
+    metadata_done = False
+    for level, df in sorted(levels.items()):
+        df = df.set_index('index')
+        taxa = [column for column in df.columns if is_taxonomy_column(column)]
+        long_df = df[taxa].reset_index().melt(id_vars='index', var_name='taxon', value_name='count')
+        connection.executemany('INSERT INTO counts VALUES (?, ?, ?, ?, ?)',
+                               [(run, sample, level, taxon, count) for sample, taxon, count in
+                                zip(long_df['index'].tolist(), long_df['taxon'].tolist(), long_df['count'].tolist())])
+        # Metadata is repeated in every level's table, so only store it once
+        if not metadata_done:
+            fields = [column for column in df.columns if not is_taxonomy_column(column)]
+            rows = list()
+            for position, field in enumerate(fields):
+                for sample, value in zip(df.index.tolist(), df[field].tolist()):
+                    rows.append((run, sample, field, None if pd.isnull(value) else str(value), position))
+            connection.executemany('INSERT INTO metadata VALUES (?, ?, ?, ?, ?)', rows)
+            metadata_done = True
+    connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                       (run, run_date(tax_barplot).strftime('%Y-%m-%d'), tax_barplot, os.path.getmtime(tax_barplot)))
+    connection.commit()
+
+
+def remove_run(connection, run):
+    """
+    Drops everything stored for a run
+    :param connection: sqlite3 connection to the warehouse
+    :param run: name of the run
+    """
+    for table in ('counts', 'metadata', 'runs'):
+        connection.execute('DELETE FROM {table} WHERE run = ?'.format(table=table), (run,))
+    connection.commit()
+
+
+def publish(connection, snapshot_path=WAREHOUSE_DB):
+    """
+    Copies the working copy of the warehouse to the NAS. The copy is written under a temporary name and renamed into
+    place, so readers always see a complete snapshot
+    :param connection: sqlite3 connection to the working copy
+    :param snapshot_path: path to publish the snapshot to
+    """
+    temp_path = snapshot_path + '.{pid}.tmp'.format(pid=os.getpid())
+    snapshot = sqlite3.connect(temp_path)
+    connection.backup(snapshot)
+    snapshot.close()
+    os.replace(temp_path, snapshot_path)
+
+
+def ingest(db_path=LOCAL_WAREHOUSE_DB, snapshot_path=WAREHOUSE_DB):
+    """
+    Brings the warehouse up to date with the NAS. Only runs that are new, or whose archive has been modified since it
+    was last ingested, are read, and runs whose archive has been removed from the NAS are dropped. A new snapshot is
+    published if anything changed. Meant for the cron ingester only - the automators just read the snapshot
+    :param db_path: path to the working copy of the warehouse, on local disk
+    :param snapshot_path: path to publish the snapshot for the automators to
+    :return: tuple of (list of the runs that were (re)ingested, list of the runs that were removed)
+    """
+    connection = connect(db_path)
+    ingested_mtimes = dict(connection.execute('SELECT path, mtime FROM runs').fetchall())
+    tax_barplots = find_taxonomy_barplots()
+    ingested = list()
+    for tax_barplot in tax_barplots:
+        if ingested_mtimes.get(tax_barplot) != os.path.getmtime(tax_barplot):
+            ingest_run(connection, tax_barplot)
+            ingested.append(run_name(tax_barplot))
+    # Finding no archives at all means the NAS isn't there rather than every run having been removed
+    removed = list()
+    if tax_barplots:
+        current = set(run_name(tax_barplot) for tax_barplot in tax_barplots)
+        removed = sorted(run for (run,) in connection.execute('SELECT run FROM runs') if run not in current)
+        for run in removed:
+            remove_run(connection, run)
+    if ingested or removed or not os.path.isfile(snapshot_path):
+        publish(connection, snapshot_path)
+    connection.close()
+    return ingested, removed
+
+
+def read_levels(level, start_date=None, end_date=None, db_path=WAREHOUSE_DB):
+    """
+    Rebuilds the level CSV of every run in a date range out of the warehouse. The tables come back in the same shape
+    as qzv_reader.read_levels - an 'index' column of samples, a column per taxon, and then the metadata columns
+    :param level: taxonomic level (1 through 7)
+    :param start_date: datetime - runs on or before this date are skipped. None to not filter
+    :param end_date: datetime - runs on or after this date are skipped. None to not filter
+    :param db_path: path to the published warehouse snapshot
+    :return: list of (run name, DataFrame) sorted by run
+    """
+    # Snapshots are never modified in place, so they're opened immutable - no locking, and nothing written to the NAS
+    connection = sqlite3.connect('file:{path}?mode=ro&immutable=1'.format(path=db_path), uri=True)
+    query = 'SELECT run FROM runs WHERE 1 = 1'
+    parameters = list()
+    if start_date is not None:
+        query += ' AND date > ?'
+        parameters.append(start_date.strftime('%Y-%m-%d'))
+    if end_date is not None:
+        query += ' AND date < ?'
+        parameters.append(end_date.strftime('%Y-%m-%d'))
+    runs = [row[0] for row in connection.execute(query + ' ORDER BY run', parameters)]
+    dataframes = list()
+    for run in runs:
+        counts = pd.DataFrame(connection.execute('SELECT sample, taxon, count FROM counts WHERE level = ? AND run = ?',
+                                                 (int(level), run)).fetchall(),
+                              columns=['index', 'taxon', 'count'])
+        if counts.empty:
+            continue
+        df = counts.pivot(index='index', columns='taxon', values='count')
+        metadata = pd.DataFrame(connection.execute('SELECT sample, field, value, position FROM metadata '
+                                                   'WHERE run = ?', (run,)).fetchall(),
+                                columns=['index', 'field', 'value', 'position'])
+        if not metadata.empty:
+            fields = metadata.drop_duplicates('field').sort_values('position')['field'].tolist()
+            df = df.join(metadata.pivot(index='index', columns='field', values='value')[fields])
+        df.columns.name = None
+        dataframes.append((run, df.reset_index()))
+    connection.close()
+    return dataframes
+
+
+@click.command()
+@click.option('--db_path', default=LOCAL_WAREHOUSE_DB, help='Path to the working copy of the warehouse, on local disk')
+@click.option('--snapshot_path', default=WAREHOUSE_DB, help='Path to publish the snapshot read by the automators to')
+def main(db_path, snapshot_path):
+    """
+    Ingests any new or modified QIIME2 runs into the warehouse, drops runs that are no longer on the NAS, and publishes a
+    new snapshot for the automators. Meant to be run regularly from cron on the head node
+    """
+    ingested, removed = ingest(db_path=db_path,
+                               snapshot_path=snapshot_path)
+    for run in ingested:
+        print(run)
+    for run in removed:
+        print('Removed {}'.format(run))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,10 @@
 import os
 import csv
-import glob
 import click
 import pickle
-import zipfile
-import pandas as pd
+import qiime_warehouse
+from lazy_import import lazy_import
+pd = lazy_import('pandas')
 
 
 @click.command()
@@ -44,24 +44,10 @@ def qiimeabundance_redmine(redmine_instance, issue, work_dir, description):
             operation = '>'
             taxa_operations[taxa] = (operation, percentage)
 
-    tax_barplots = glob.glob('/mnt/nas2/processed_sequence_data/miseq_assemblies/*/qiime2/taxonomy_barplot.qzv')
-    # As it turns out, qiime2 qzv files are actually just zip files with a bunch of data/metadata.
-    # https://github.com/joey711/phyloseq/issues/830
-    # Getting at data seems to be easiest if we just unzip and read in the relevant csv files with pandas
-    for tax_barplot in tax_barplots:
-        # Check the date of the assembly to see if it's in our range.
-        cmd = 'cp {} {}'.format(tax_barplot, work_dir)
-        os.system(cmd)
-        output_dir = os.path.join(work_dir, tax_barplot.split('/')[-3])
-        with zipfile.ZipFile(os.path.join(work_dir, 'taxonomy_barplot.qzv'), 'r') as zipomatic:
-            zipomatic.extractall(output_dir)
-
-    # Now we should have folders for all of our QIIME2 runs.
-    # Grab the csv file for level of interest for all of them and create a combined CSV.
+    # Pull every run's level table out of the warehouse (kept up to date by the ingester run from cron) rather than
+    # opening every run's archive.
     dataframe_list = list()
-    csv_files = glob.glob(os.path.join(work_dir, '*', '*', 'data', 'level-{}.csv'.format(level)))
-    for csv_file in csv_files:
-        df = pd.read_csv(csv_file)
+    for run, df in qiime_warehouse.read_levels(level):
         dataframe_list.append(df)
     combined_df = pd.concat(dataframe_list, ignore_index=True, sort=False)
     combined_df.fillna(0, inplace=True)
@@ -118,9 +104,6 @@ def qiimeabundance_redmine(redmine_instance, issue, work_dir, description):
     output_dict['path'] = os.path.join(work_dir, 'qiimeabundance_results.csv')
     output_dict['filename'] = 'QIIMEabundance_results.csv'
     output_list.append(output_dict)
-    # Clean up files.
-    cmd = 'rm -r {}'.format(os.path.join(work_dir, '*/'))
-    os.system(cmd)
 
     # Upload files, set status to Feedback
     redmine_instance.issue.update(resource_id=issue.id,
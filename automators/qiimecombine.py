@@ -1,10 +1,12 @@
 import os
-import glob
 import click
 import pickle
-import zipfile
 import datetime
-import pandas as pd
+from collections import OrderedDict
+import qiime_warehouse
+from lazy_import import lazy_import
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 
 @click.command()
@@ -43,82 +45,27 @@ def qiimecombine_redmine(redmine_instance, issue, work_dir, description):
                                             'of how to format the description.')
         return
 
-    tax_barplots = glob.glob('/mnt/nas2/processed_sequence_data/miseq_assemblies/*/qiime2/taxonomy_barplot.qzv')
-    # As it turns out, qiime2 qzv files are actually just zip files with a bunch of data/metadata.
-    # https://github.com/joey711/phyloseq/issues/830
-    # Getting at data seems to be easiest if we just unzip and read in the relevant csv files with pandas
-    for tax_barplot in tax_barplots:
-        # Check the date of the assembly to see if it's in our range.
-        date_string = tax_barplot.split('/')[-3]
-        run_date = string_to_year(date_string)
-        if start_date < run_date < end_date:
-            cmd = 'cp {} {}'.format(tax_barplot, work_dir)
-            os.system(cmd)
-            output_dir = os.path.join(work_dir, tax_barplot.split('/')[-3])
-            with zipfile.ZipFile(os.path.join(work_dir, 'taxonomy_barplot.qzv'), 'r') as zipomatic:
-                zipomatic.extractall(output_dir)
-
-    # Now we should have folders for all of our QIIME2 runs (named with as run dates).
-    # Grab the csv file for level of interest for all of them.
+    # Pull the level tables for the runs in the date range out of the warehouse (kept up to date by the ingester run
+    # from cron) rather than opening every run's archive.
     dataframe_list = list()
-    csv_files = glob.glob(os.path.join(work_dir, '*', '*', 'data', 'level-{}.csv'.format(level)))
-    for csv_file in csv_files:
-        df = pd.read_csv(csv_file)
-        for column in df.columns:
-            df.rename(columns={column: column.replace(' ', '_').upper()}, inplace=True)
+    for run, df in qiime_warehouse.read_levels(level,
+                                               start_date=start_date,
+                                               end_date=end_date):
         try:
-            df = df.apply(lambda x: x.astype(str).str.upper())
-            for j in range(len(column_headers)):
-                column_header = column_headers[j]
-                column_content = column_contents[j]
-                if operators[j] == 'equals':
-                    df = df.loc[df[column_header] == column_content]
-                elif operators[j] == 'contains':
-                    df = df.loc[df[column_header].str.contains(column_content)]
-            dataframe_list.append(df)
-        except KeyError:
+            dataframe_list.append(filter_run(df, column_headers, column_contents, operators))
+        except KeyError as e:
             redmine_instance.issue.update(resource_id=issue.id,
-                                          notes='WARNING: Could not find column {} in run {}'.format(column_header,
-                                                                                                     csv_file.split('/')[-4]))
+                                          notes='WARNING: Could not find column {} in run {}'.format(e.args[0],
+                                                                                                     run))
     output_list = list()
     output_dict = dict()
     output_dict['path'] = os.path.join(work_dir, 'results.csv')
     output_dict['filename'] = 'QIIMEcombine_results.csv'
     output_list.append(output_dict)
-    result_df = pd.concat(dataframe_list, ignore_index=True, sort=False)
-    result_df.fillna(0, inplace=True)
-    # Drop any columns that are entirely zeros. Might be a more pandas-esque way to do this, but this works and is fast.
-    columns_to_drop = list()
-    for column in result_df.columns:
-        all_zeros = True
-        for item in result_df[column]:
-            if str(item) != '0':
-                all_zeros = False
-        if all_zeros is True:
-            columns_to_drop.append(column)
-
-    result_df = result_df.drop(columns_to_drop, axis=1)
-
-    # Also want to reorder the columns. Need to have index first, then all the taxonomy information, and then everything
-    # else.
-    output_column_order = ['INDEX']
-    # First pass through - grab all the taxonomy information.
-    for column in result_df.columns:
-        if column.startswith('D_'):
-            output_column_order.append(column)
-    # Final pass - grab everything else.
-    for column in result_df.columns:
-        if column != 'INDEX' and not column.startswith('D_'):
-            output_column_order.append(column)
-
-    result_df = result_df[output_column_order]
+    result_df = combine_runs(dataframe_list)
 
     result_df.to_csv(os.path.join(work_dir, 'results.csv'), index=False)
 
-    # Clean up files.
-    cmd = 'rm -r {}'.format(os.path.join(work_dir, '*/'))
-    os.system(cmd)
-
     # Upload files, set status to Feedback
     redmine_instance.issue.update(resource_id=issue.id,
                                   status_id=4,
@@ -126,6 +73,65 @@ def qiimecombine_redmine(redmine_instance, issue, work_dir, description):
                                   notes='QIIMECombine complete. See attached file for results.')
 
 
+def filter_run(df, column_headers, column_contents, operators):
+    """
+    Pulls the samples that match every filter out of a run's level table. Column names get spaces replaced with
+    underscores and are uppercased, and only the filter columns are uppercased for matching - the rest of the
+    metadata is uppercased once the matching samples have been found
+    :param df: DataFrame of a run's level CSV
+    :param column_headers: list of (uppercased) column names to filter on
+    :param column_contents: list of (uppercased) values to look for, one per column header
+    :param operators: list of 'equals' or 'contains', one per column header
+    :return: DataFrame of the matching samples
+    :raises KeyError: with the name of the column if the run doesn't have one of the filter columns
+    """
+    df = df.rename(columns=lambda column: column.replace(' ', '_').upper())
+    keep = pd.Series(True, index=df.index)
+    for column_header, column_content, operator in zip(column_headers, column_contents, operators):
+        if column_header not in df.columns:
+            raise KeyError(column_header)
+        values = df[column_header].astype(str).str.upper()
+        if operator == 'equals':
+            keep &= values == column_content
+        elif operator == 'contains':
+            keep &= values.str.contains(column_content)
+    df = df.loc[keep].copy()
+    metadata_columns = [column for column in df.columns if not column.startswith('D_')]
+    df[metadata_columns] = df[metadata_columns].apply(lambda x: x.astype(str).str.upper())
+    return df
+
+
+def combine_runs(dataframe_list):
+    """
+    Stacks the filtered tables from each run, drops any column that is zero for every sample, and orders the columns
+    with index first, then all the taxonomy information, and then everything else. Runs see different sets of taxa,
+    so rather than letting pandas align hundreds of tables with mismatched columns, the counts are written straight
+    into one zero-filled array at each taxon's position
+    :param dataframe_list: list of DataFrames from filter_run
+    :return: combined DataFrame
+    """
+    run_taxa = [[column for column in df.columns if column.startswith('D_')] for df in dataframe_list]
+    taxonomy_columns = list(OrderedDict.fromkeys(column for taxa in run_taxa for column in taxa))
+    positions = dict((column, i) for i, column in enumerate(taxonomy_columns))
+    run_counts = [df[taxa].values for df, taxa in zip(dataframe_list, run_taxa)]
+    counts = np.zeros((sum(len(df) for df in dataframe_list), len(taxonomy_columns)),
+                      dtype=np.result_type(np.int64, *[run_count.dtype for run_count in run_counts]))
+    row = 0
+    for run_count, taxa in zip(run_counts, run_taxa):
+        counts[row:row + len(run_count), [positions[column] for column in taxa]] = run_count
+        row += len(run_count)
+    metadata_df = pd.concat([df.drop(taxa, axis=1) for df, taxa in zip(dataframe_list, run_taxa)],
+                            ignore_index=True, sort=False)
+    metadata_df.fillna(0, inplace=True)
+    # Drop any columns that are entirely zeros
+    nonzero = counts.any(axis=0)
+    counts_df = pd.DataFrame(counts[:, nonzero], columns=[column for column, keep in zip(taxonomy_columns, nonzero)
+                                                         if keep])
+    metadata_df = metadata_df.loc[:, ~metadata_df.astype(str).eq('0').all()]
+    other_columns = [column for column in metadata_df.columns if column != 'INDEX']
+    return pd.concat([metadata_df[['INDEX']], counts_df, metadata_df[other_columns]], axis=1)
+
+
 def string_to_year(yymmdd_string):
     year = int('20' + yymmdd_string[:2])
     month = int(yymmdd_string[2:4])
@@ -77,24 +77,34 @@ def qiimegraph(redmine_instance, issue, work_dir, description):
                 sample_list.append(item)
         sample_list = tuple(sample_list)
 
-        for samples in sample_list:
-            cmd = '/mnt/nas/Redmine/QIIME2_CondaEnv/qiime2-2018.2/bin/python ' \
-                  '/mnt/nas/Redmine/OLCRedmineAutomator/automators/qiimegraph_generate_chart.py ' \
-                  '-i {} ' \
-                  '-o {} ' \
-                  '-s {} ' \
-                  '-t {}'.format(qiime_taxonomy_barplot, work_dir, samples, taxonomic_level)
-            if filtering is not None:
-                cmd += ' -f {}'.format(filtering)
-            p = subprocess.Popen(cmd, shell=True)
-            p.wait()
+        # One process loads the visualization and renders every chart, rather than one process per chart
+        cmd = '/mnt/nas/Redmine/QIIME2_CondaEnv/qiime2-2018.2/bin/python ' \
+              '/mnt/nas/Redmine/OLCRedmineAutomator/automators/qiimegraph_generate_chart.py ' \
+              '-i {} ' \
+              '-o {} ' \
+              '{} ' \
+              '-t {}'.format(qiime_taxonomy_barplot, work_dir,
+                             ' '.join('-s {}'.format(samples) for samples in sample_list), taxonomic_level)
+        if filtering is not None:
+            cmd += ' -f {}'.format(filtering)
+        p = subprocess.Popen(cmd, shell=True)
+        p.wait()
+
+        # Sample groups that the chart script couldn't draw (SKIPPED_CHARTS in qiimegraph_generate_chart.py)
+        skipped_note = ''
+        skipped_file = os.path.join(work_dir, 'skipped_charts.txt')
+        if os.path.isfile(skipped_file):
+            with open(skipped_file) as f:
+                skipped = [line.strip() for line in f if line.strip() != '']
+            if skipped:
+                skipped_note = '\nThe following sample groups were skipped:\n{}'.format('\n'.join(skipped))
 
         # Zip up all of the ouput
         output_files = glob.glob(os.path.join(work_dir, '*.png'))
         if len(output_files) == 0:
             redmine_instance.issue.update(resource_id=issue.id, status_id=3,
                                           notes='ERROR: Something went wrong. Please verify the provided Sample IDs are'
-                                                'correct.')
+                                                ' correct.' + skipped_note)
             quit()
 
         zipped = zipfile.ZipFile(os.path.join(work_dir, 'qiime2_graphs.zip'), 'w')
@@ -114,7 +124,7 @@ def qiimegraph(redmine_instance, issue, work_dir, description):
         ]
 
         redmine_instance.issue.update(resource_id=issue.id, uploads=output_list, status_id=4,
-                                      notes='QIIMEGRAPH Complete! Output graphs attached.')
+                                      notes='QIIMEGRAPH Complete! Output graphs attached.' + skipped_note)
     except Exception as e:
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! Send this error traceback to your friendly '
@@ -1,15 +1,19 @@
 from collections import OrderedDict
 import os
 import re
+import glob
 import click
 import pickle
-import qiime2
-import shutil
+import hashlib
+import time
 import random
-import pandas as pd
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
+import multiprocessing
+from qzv_reader import read_level
+from lazy_import import lazy_import
+pd = lazy_import('pandas')
+
+# Written to the output folder with one line per sample group that was skipped
+SKIPPED_CHARTS = 'skipped_charts.txt'
 
 
 def extract_taxonomy(value):
@@ -65,31 +69,44 @@ def get_column_pair(df, col1, col2):
     return df
 
 
-def prepare_df(filepath, index_col, filtering=None):
+def extract_taxonomy_column(values):
+    """
+    Vectorized version of extract_taxonomy - pulls the name at TAXONOMIC_LEVEL out of every taxonomy string at once
+    :param values: pandas Series of full taxonomy strings (i.e. D_0__Bacteria;D_1__Firmicutes;...)
+    :return: pandas Series of taxonomic basenames
+    """
+    prefix = re.escape(TAXONOMIC_DICT[TAXONOMIC_LEVEL][1])
+    # Same as value.split(prefix)[1] - everything after the prefix, up to the next repeat of it
+    tax_strings = values.str.extract('{0}(.*?)(?={0}|$)'.format(prefix), expand=False)
+    tax_strings = tax_strings.where(tax_strings.notnull() & (tax_strings != ''), values)
+    # Remaining taxonomy characters mean a call to the specified level couldn't be made
+    unclassified = tax_strings.str.contains(';', regex=False) & tax_strings.str.contains('__', regex=False)
+    tax_strings = tax_strings.where(~unclassified, 'Unclassified')
+    return tax_strings.where(~values.str.contains('Unassigned;_', regex=False), 'Unassigned')
+
+
+def prepare_df(df, index_col, filtering=None):
     """
-    :param filepath:
+    :param df: DataFrame of the level CSV
     :param index_col:
     :param filtering:
     :return:
     """
-    df = pd.read_csv(filepath, index_col=index_col)
+    df = df.set_index(index_col)
 
     # Remove all extraneous metadata columns
-    df = df.drop((x for x in df.columns.tolist()
-                  if (x.startswith('D_0__') is False) and
-                  (x.startswith('Unassigned;') is False)),
-                 axis=1)
+    df = df.loc[:, df.columns.str.startswith('D_0__') | df.columns.str.startswith('Unassigned;')]
 
     # Remove columns that don't have target filtering keyword; e.g. remove everything that isn't Bacteroidales
     if filtering is not None:
-        df = df.drop((x for x in df.columns.tolist() if filtering not in x), axis=1)
+        df = df.loc[:, df.columns.str.contains(filtering, regex=False)]
 
     # Transpose
     df = df.transpose()
     df = df.reset_index()
 
     # Create taxonomic basename column
-    df[TAXONOMIC_LEVEL] = df['index'].map(extract_taxonomy)
+    df[TAXONOMIC_LEVEL] = extract_taxonomy_column(df['index'])
 
     # Columns to target for conversion to percentage
     columns_to_target = [x for x in df.columns.tolist() if x not in ['index', TAXONOMIC_LEVEL]]
@@ -100,32 +117,122 @@ def prepare_df(filepath, index_col, filtering=None):
     return df
 
 
-def fixed_df(filename, index='sample_annotation', filtering=None):
+def read_level_csv(filename):
     """
-    :param filename:
-    :param index:
-    :param filtering:
-    :return:
+    :param filename: level CSV, or taxonomy_barplot.qzv to read the level CSV for TAXONOMIC_LEVEL straight out of
+    :return: DataFrame of the level CSV, or None if the archive doesn't have one
     """
-    df = prepare_df(filepath=filename, index_col=index, filtering=filtering)
-    new_filename = filename.replace('.csv', '_temp.csv')
+    if filename.endswith('.qzv'):
+        return read_level(filename, TAXONOMIC_DICT[TAXONOMIC_LEVEL][0].split('-')[1])
+    return pd.read_csv(filename)
 
-    # Stupid hack
-    df.to_csv(new_filename, index=None)
-    df = pd.read_csv(new_filename, index_col=TAXONOMIC_LEVEL).fillna('NA')
 
-    # Cleanup
-    os.remove(new_filename)
-    return df
+# Prepared dataframes are pickled here, next to the QIIME2 warehouse, so repeat requests for the same run skip reading
+# and preparing the level CSV
+PREPARED_DF_CACHE = '/mnt/nas2/redmine/qiimegraph_cache'
+# Least recently used pickles are removed once the cache grows past MAX_PREPARED_DF_CACHE_SIZE bytes, and anything that
+# hasn't been used in MAX_PREPARED_DF_AGE seconds is removed regardless of size
+MAX_PREPARED_DF_CACHE_SIZE = 2 * 1024 ** 3
+MAX_PREPARED_DF_AGE = 30 * 24 * 60 * 60
+
+
+def pyplot():
+    """
+    :return: matplotlib.pyplot, set up to draw without a display. It is only imported once there are charts to draw, so
+    bad requests are turned away without waiting on it
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+    return matplotlib.pyplot
+
+
+def evict_prepared_dfs(cache_dir=PREPARED_DF_CACHE, max_size=MAX_PREPARED_DF_CACHE_SIZE, max_age=MAX_PREPARED_DF_AGE):
+    """
+    Removes pickles that have not been used in max_age seconds, then removes the least recently used pickles until the
+    cache is no larger than max_size bytes. Pickles are touched whenever they're used, so their mtime is their last use
+    :param cache_dir: folder prepared dataframes are kept in
+    :param max_size: maximum total size of the pickles in bytes
+    :param max_age: maximum number of seconds since a pickle was last used
+    """
+    pickles = list()
+    for path in glob.glob(os.path.join(cache_dir, '*.pkl')):
+        try:
+            stat = os.stat(path)
+        except OSError:  # Removed by another run
+            continue
+        pickles.append((stat.st_mtime, stat.st_size, path))
+    cutoff = time.time() - max_age
+    total_size = sum(size for mtime, size, path in pickles if mtime >= cutoff)
+    for mtime, size, path in sorted(pickles):
+        if mtime >= cutoff:
+            if total_size <= max_size:
+                break
+            total_size -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 
-def load_visualization(filepath):
+def prepared_df_path(filename, index, filtering, cache_dir=PREPARED_DF_CACHE):
     """
-    :param filepath: path to qiime2 visualization
-    :return: qiime2 object containing all information on viz
+    :param filename: level CSV, or taxonomy_barplot.qzv
+    :param index: index column of the level CSV
+    :param filtering: group the dataset is filtered to, or None
+    :param cache_dir: folder prepared dataframes are kept in
+    :return: tuple of (path to the pickled dataframe, prefix shared by every pickle of this input file)
     """
-    data_visualization = qiime2.Visualization.load(filepath)
-    return data_visualization
+    prefix = hashlib.sha256(os.path.realpath(filename).encode()).hexdigest()[:16]
+    variant = hashlib.sha256(repr((TAXONOMIC_LEVEL, index, filtering)).encode()).hexdigest()[:16]
+    mtime = int(os.path.getmtime(filename))
+    return os.path.join(cache_dir, '{}_{}_{}.pkl'.format(prefix, mtime, variant)), os.path.join(cache_dir, prefix)
+
+
+def fixed_df(filename, index='sample_annotation', filtering=None, cache_dir=PREPARED_DF_CACHE):
+    """
+    Prepared dataframes are cached on disk, keyed on (input file, modification time, taxonomic level, index column,
+    filtering). Pickles for an older version of the input file are removed when a new one is written, and the cache is
+    kept within its size and age limits (see evict_prepared_dfs)
+    :param filename: level CSV, or taxonomy_barplot.qzv
+    :param index:
+    :param filtering:
+    :param cache_dir: folder prepared dataframes are kept in
+    :return: DataFrame indexed on taxonomic basename, with a column of percentages for each sample, or None if the
+             input doesn't have a level CSV for TAXONOMIC_LEVEL
+    """
+    cached, prefix = prepared_df_path(filename, index, filtering, cache_dir)
+    if os.path.isfile(cached):
+        try:
+            df = pd.read_pickle(cached)
+            os.utime(cached)
+            return df
+        except Exception:
+            # Half-written or from an incompatible pandas - rebuild it
+            pass
+
+    level_df = read_level_csv(filename)
+    if level_df is None:
+        return None
+    df = prepare_df(df=level_df, index_col=index, filtering=filtering)
+    df = df.set_index(TAXONOMIC_LEVEL).fillna('NA')
+    # Sample IDs are looked up as strings, even if they look like numbers
+    df.columns = [str(column) for column in df.columns]
+
+    # The cache is only an optimization - charts still get drawn if it can't be written
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        current = cached[:cached.rindex('_') + 1]
+        for stale in glob.glob(prefix + '_*.pkl'):
+            if not stale.startswith(current):
+                os.remove(stale)
+        temp_path = '{}.{}.tmp'.format(cached, os.getpid())
+        df.to_pickle(temp_path)
+        os.replace(temp_path, cached)
+        evict_prepared_dfs(cache_dir)
+    except OSError as e:
+        print('WARNING: Could not cache prepared dataframe at {}: {}'.format(cached, e))
+    return df
 
 
 def prepare_plot(df, sampleid):
@@ -203,6 +310,8 @@ def paired_multi_pie_charts(samples, out_dir, filtering):
     :param filtering:
     :return:
     """
+    plt = pyplot()
+
     # Style setup
     plt.style.use('fivethirtyeight')
 
@@ -210,7 +319,7 @@ def paired_multi_pie_charts(samples, out_dir, filtering):
     colordict = read_color_pickle()
 
     # Font size
-    mpl.rcParams['font.size'] = 8
+    plt.rcParams['font.size'] = 8
 
     # Setup figure canvas
     plt.figure(figsize=(24, 14))
@@ -308,6 +417,8 @@ def paired_multi_pie_charts(samples, out_dir, filtering):
 
     # Save the file (set transparent=True if you want to eliminate the background)
     plt.savefig(outfile, bbox_inches='tight', transparent=True)
+    # Free the figure - a worker renders several charts in a row
+    plt.close()
 
     return outfile
 
@@ -320,16 +431,60 @@ def create_paired_pie_wrapper(filename, out_dir, samples, filtering):
     :param filtering:
     :return:
     """
-    df = fixed_df(filename=filename, filtering=filtering)
+    return create_paired_pie_batch(filename, out_dir, [samples], filtering)[0]
 
-    sample_dict = OrderedDict()
-    for sample in samples:
-        (values, labels, explode) = prepare_plot(df, sample)
-        sample_dict[sample] = (values, labels, explode)
 
-    filename = paired_multi_pie_charts(sample_dict, out_dir, filtering)
+def render_paired_pie(args):
+    """
+    Pool worker - renders a single chart from samples that have already been pulled out of the dataframe
+    :param args: tuple of (OrderedDict of sample: (values, labels, explode), out_dir, filtering)
+    :return: path to chart
+    """
+    sample_dict, out_dir, filtering = args
+    return paired_multi_pie_charts(sample_dict, out_dir, filtering)
 
-    return filename
+
+def create_paired_pie_batch(filename, out_dir, sample_groups, filtering, processes=4, skipped=None):
+    """
+    Renders a chart for every group of samples. The level CSV is read and prepared once, and the charts are drawn
+    by a pool of worker processes
+    :param filename: path to level CSV
+    :param out_dir: folder to save charts into
+    :param sample_groups: list of tuples of samples, one tuple per chart
+    :param filtering: group to filter the dataset to, or None
+    :param processes: number of charts to render at once
+    :param skipped: list to add a description of each group that couldn't be charted to, if given
+    :return: list of paths to the charts that were created
+    """
+    df = fixed_df(filename=filename, filtering=filtering)
+    if df is None:
+        print('ERROR: Could not load the level CSV from {}'.format(filename))
+        return list()
+
+    jobs = list()
+    for samples in sample_groups:
+        sample_dict = OrderedDict()
+        try:
+            for sample in samples:
+                (values, labels, explode) = prepare_plot(df, sample)
+                sample_dict[sample] = (values, labels, explode)
+        except KeyError as e:
+            print('ERROR: Could not find sample {} in {}. Skipping chart for {}'.format(e.args[0], filename,
+                                                                                      ','.join(samples)))
+            if skipped is not None:
+                skipped.append('{} (sample {} not found)'.format(','.join(samples), e.args[0]))
+            continue
+        jobs.append((sample_dict, out_dir, filtering))
+
+    # Workers are forked, so they pick up the taxonomic level globals set by cli, and matplotlib if it is loaded first
+    if jobs:
+        pyplot()
+    pool = multiprocessing.Pool(processes=min(processes, max(len(jobs), 1)))
+    filenames = pool.map(render_paired_pie, jobs)
+    pool.close()
+    pool.join()
+
+    return filenames
 
 
 def supress_autopct(pct):
@@ -406,44 +561,6 @@ def read_color_pickle():
     return colordict
 
 
-def extract_viz_csv(input_path, out_dir):
-    """
-    :param input_path:
-    :param out_dir:
-    :return:
-    """
-    # Load visualization file
-    try:
-        qzv = load_visualization(input_path)
-    except:
-        print('Could not load .qzv file. Quitting.')
-        return None
-
-    # Create temporary directory to dump contents into
-    temp_dir = os.path.join(os.path.dirname(out_dir), 'temporary_qiime2_extraction')
-
-    # Outfile path
-    out_file = os.path.join(out_dir, 'qiime2_data_extract.csv')
-
-    try:
-        os.mkdir(temp_dir)
-    except:
-        shutil.rmtree(temp_dir)
-        os.mkdir(temp_dir)
-
-    # Grab CSV
-    qzv.export_data(temp_dir)
-    taxonomic_csv_path = os.path.join(temp_dir, TAXONOMIC_DICT[TAXONOMIC_LEVEL][0]+'.csv')
-
-    # Move file
-    os.rename(taxonomic_csv_path, out_file)
-
-    # Cleanup
-    shutil.rmtree(temp_dir)
-
-    return out_file
-
-
 @click.command()
 @click.option('-i', '--input_file',
               type=click.Path(exists=True),
@@ -457,7 +574,9 @@ def extract_viz_csv(input_path, out_dir):
               help='Folder to save output file into')
 @click.option('-s', '--samples',
               default=None,
-              help='List of samples to provide. Must be delimited by commas, e.g. -s SAMPLE1,SAMPLE2,SAMPLE3',
+              multiple=True,
+              help='List of samples to provide. Must be delimited by commas, e.g. -s SAMPLE1,SAMPLE2,SAMPLE3. '
+                   'Provide -s more than once to create a chart for each list of samples in one go.',
               required=True)
 @click.option('-t', '--taxonomic_level',
               required=False,
@@ -467,21 +586,28 @@ def extract_viz_csv(input_path, out_dir):
 @click.option('-f', '--filtering',
               required=False,
               help='Filter dataset to a single group (e.g. Enterobacteriaceae)')
-def cli(input_file, out_dir, samples, taxonomic_level, filtering):
+@click.option('-p', '--processes',
+              default=4,
+              help='Number of charts to render at once')
+def cli(input_file, out_dir, samples, taxonomic_level, filtering, processes):
     # generate_color_pickle()
 
-    if samples is not None:
-        samples = tuple(samples.split(','))
-
-        if len(samples) > 9:
-            print('ERROR: Cannot process more than 9 samples. Quitting.')
-            quit()
-
     # Quick validation
     if not os.path.isdir(out_dir):
         click.echo('ERROR: Provided parameter to [-o, --out_dir] is not a valid directory. Try again.')
         quit()
 
+    # Groups that are too big for one chart are skipped rather than taking the rest of the charts down with them
+    sample_groups = list()
+    skipped = list()
+    for sample_list in samples:
+        sample_group = tuple(sample_list.split(','))
+        if len(sample_group) > 9:
+            print('ERROR: Cannot chart more than 9 samples at once. Skipping chart for {}'.format(sample_list))
+            skipped.append('{} (more than 9 samples)'.format(sample_list))
+        else:
+            sample_groups.append(sample_group)
+
     # Global variables. This is a hacky way of accomodating a few functions.
     global TAXONOMIC_LEVEL
     TAXONOMIC_LEVEL = taxonomic_level
@@ -497,22 +623,19 @@ def cli(input_file, out_dir, samples, taxonomic_level, filtering):
         'species': ('level-7', 'D_6__'),
     }
 
-    filename = None
-
     # Input file handling
-    if input_file.endswith('.csv'):
-        filename = create_paired_pie_wrapper(input_file, out_dir, samples, filtering)
-    elif input_file.endswith('.qzv'):
-        input_file = extract_viz_csv(input_path=input_file, out_dir=out_dir)
-        if input_file is None:
-            quit()
-        else:
-            filename = create_paired_pie_wrapper(input_file, out_dir, samples, filtering)
-    else:
+    if not input_file.endswith('.csv') and not input_file.endswith('.qzv'):
         click.echo('ERROR: Invalid input_file provided. Please ensure file is .csv or .qzv.')
         quit()
+    filenames = create_paired_pie_batch(input_file, out_dir, sample_groups, filtering, processes, skipped=skipped)
+
+    for filename in filenames:
+        click.echo('Created chart at {} successfully'.format(filename))
 
-    click.echo('Created chart at {} successfully'.format(filename))
+    # qiimegraph.py lists these in its Redmine note
+    with open(os.path.join(out_dir, SKIPPED_CHARTS), 'w') as f:
+        for group in skipped:
+            f.write(group + '\n')
 
 
 if __name__ == '__main__':
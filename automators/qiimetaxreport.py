@@ -68,17 +68,18 @@ def qiimegraph(redmine_instance, issue, work_dir, description):
         samples = description[3]
         samples = samples.split(',')
 
-        for sample in samples:
-            cmd = '/mnt/nas/Redmine/QIIME2_CondaEnv/qiime2-2018.2/bin/python ' \
-                  '/mnt/nas/Redmine/OLCRedmineAutomator/automators/qiimetaxreport_generate_report.py ' \
-                  '-i {} ' \
-                  '-o {} ' \
-                  '-s {} ' \
-                  '-t {}'.format(qiime_taxonomy_barplot, work_dir, sample, taxonomic_level)
-            if cutoff is not None:
-                cmd += ' -c {}'.format(cutoff)
-            p = subprocess.Popen(cmd, shell=True)
-            p.wait()
+        # One process reads the archive and writes every sample's report, rather than one process per sample
+        cmd = '/mnt/nas/Redmine/QIIME2_CondaEnv/qiime2-2018.2/bin/python ' \
+              '/mnt/nas/Redmine/OLCRedmineAutomator/automators/qiimetaxreport_generate_report.py ' \
+              '-i {} ' \
+              '-o {} ' \
+              '{} ' \
+              '-t {}'.format(qiime_taxonomy_barplot, work_dir,
+                             ' '.join('-s {}'.format(sample) for sample in samples), taxonomic_level)
+        if cutoff is not None:
+            cmd += ' -c {}'.format(cutoff)
+        p = subprocess.Popen(cmd, shell=True)
+        p.wait()
 
         # Zip up the ouput
         output_files = None
@@ -1,9 +1,7 @@
 import os
-import glob
 import click
-import qiime2
-import shutil
-import pandas as pd
+from qzv_reader import read_all_levels
+from concurrent.futures import ThreadPoolExecutor
 
 
 TAXONOMIC_DICT = {
@@ -19,25 +17,40 @@ TAXONOMIC_DICT = {
 
 # NOTE: Note that the index_col is by default 'sample_annotation'. This assumes that the METADATA file used to generate
 # this run has a column called 'sample_annotation' which acts as a secondary ID alongside the Seq-IDs provided.
-def prepare_df(filepath, taxonomic_level, sample, index_col='sample_annotation', filtering=None, cutoff=None):
-    df = pd.read_csv(filepath, index_col=index_col)
+def prepare_level_df(df, index_col='sample_annotation', filtering=None):
+    """
+    Parses a level table into one row per taxon and one column per sample. This only needs doing once per level, no
+    matter how many samples are reported on
+    :param df: DataFrame of the level CSV
+    :param index_col:
+    :param filtering:
+    :return:
+    """
+    df = df.set_index(index_col)
 
     # Remove all extraneous metadata columns
-    df = df.drop((x for x in df.columns.tolist()
-                  if (x.startswith('D_0__') is False) and
-                  (x.startswith('Unassigned;') is False)),
-                 axis=1)
+    df = df.loc[:, df.columns.str.startswith('D_0__') | df.columns.str.startswith('Unassigned;')]
 
     # Remove columns that don't have target filtering keyword; e.g. remove everything that isn't Bacteroidales
     if filtering is not None:
-        df = df.drop((x for x in df.columns.tolist() if filtering not in x), axis=1)
+        df = df.loc[:, df.columns.str.contains(filtering, regex=False)]
 
     # Transpose
     df = df.transpose()
     df = df.reset_index()
+    return df
 
+
+def prepare_df(level_df, taxonomic_level, sample, cutoff=None):
+    """
+    :param level_df: DataFrame from prepare_level_df
+    :param taxonomic_level:
+    :param sample:
+    :param cutoff:
+    :return: report DataFrame for the sample, or None if the sample couldn't be found
+    """
     # Drop columns that aren't our sample of interest
-    df = df.drop((x for x in df.columns.tolist() if sample not in x and 'index' not in x), axis=1)
+    df = level_df[[x for x in level_df.columns.tolist() if sample in str(x) or 'index' in str(x)]].copy()
 
     # Columns to target for conversion to percentage
     columns_to_target = [x for x in df.columns.tolist() if x not in ['index', taxonomic_level]]
@@ -49,8 +62,8 @@ def prepare_df(filepath, taxonomic_level, sample, index_col='sample_annotation',
     try:
         df = df[df.iloc[:, 1] != 0]
     except IndexError:
-        print('The specified sample {} could not be found. Quitting.'.format(sample))
-        quit()
+        print('The specified sample {} could not be found. Skipping.'.format(sample))
+        return None
 
     if cutoff is not None:
         # Remove rows where the value for the sample is < cutoff
@@ -72,50 +85,6 @@ def convert_to_percentages(df, cols):
     return df
 
 
-def extract_csv_files(input_path, out_dir):
-    """
-    :param input_path:
-    :param out_dir:
-    :return:
-    """
-    # Load visualization file
-    try:
-        qzv = qiime2.Visualization.load(input_path)
-    except:
-        print('Could not load .qzv file. Quitting.')
-        return None
-
-    # Create temporary directory to dump contents into
-    temp_dir = os.path.join(out_dir, 'temporary_qiime2')
-    try:
-        os.makedirs(temp_dir)
-    except OSError:
-        shutil.rmtree(temp_dir)
-        os.makedirs(temp_dir)
-
-    # Export contents of QZV
-    qzv.export_data(temp_dir)
-
-    # Make list of files to keep
-    all_files = glob.glob(os.path.join(temp_dir, 'level-*.csv'))
-    files_to_move = []
-    for file in all_files:
-        for key, value in TAXONOMIC_DICT.items():
-            if value[0]+'.' in os.path.basename(file):
-                files_to_move.append(file)
-
-    # Move .csv files of interest
-    out_files = []
-    for file in sorted(files_to_move):
-        out_files.append(os.path.join(out_dir, os.path.basename(file)))
-        shutil.move(file, os.path.join(out_dir, os.path.basename(file)))
-
-    # Cleanup
-    shutil.rmtree(temp_dir)
-
-    return out_files
-
-
 def extract_taxonomy(value):
     if 'Unassigned;_' in value:
         return 'Unassigned'
@@ -160,31 +129,50 @@ def extract_taxonomy(value):
 @click.option('-s', '--sample',
               default=None,
               required=True,
-              help='Sample name to prepare data for')
+              multiple=True,
+              help='Sample name to prepare data for. Provide -s more than once (or a comma separated list) to report '
+                   'on several samples in one go')
 @click.option('-t', '--taxonomic_level',
               required=True,
-              help='Taxonomic level to generate report for. Options: '
-                   '["kingdom", "phylum", "class", "order", "family", "genus", "species"]')
+              multiple=True,
+              help='Taxonomic level to generate report for. Provide -t more than once to report on several levels. '
+                   'Options: ["kingdom", "phylum", "class", "order", "family", "genus", "species"]')
 @click.option('-c', '--cutoff',
               required=False,
               default=0.0,
               help='Filter dataset to a specified cutoff level. For example, setting this to 5.5 will only show '
                    'rows with values >= 5.5%')
-def taxonomy_report_generator(input_file, out_dir, sample, taxonomic_level, cutoff):
-    csv_files = extract_csv_files(input_file, out_dir)
-
-    taxonomic_level = taxonomic_level.lower()
-
-    target_file = None
-    for file in csv_files:
-        if TAXONOMIC_DICT[taxonomic_level][0] in file:
-            target_file = file
-
-    df = prepare_df(filepath=target_file, taxonomic_level=taxonomic_level, sample=sample, cutoff=cutoff)
-    csv_out_path = os.path.join(out_dir, 'taxonomy_report_{}_{}.csv'.format(taxonomic_level, sample))
-    df.to_csv(csv_out_path, index=False)
+@click.option('--threads',
+              default=8,
+              help='Number of reports to write at once')
+def taxonomy_report_generator(input_file, out_dir, sample, taxonomic_level, cutoff, threads):
+    samples = [s for sample_list in sample for s in sample_list.split(',') if s != '']
+    taxonomic_levels = [level.lower() for level in taxonomic_level]
+
+    # Read every requested level out of the archive in one go, and parse each of them once
+    level_csvs = read_all_levels(input_file, levels=[TAXONOMIC_DICT[level][0].split('-')[1]
+                                                     for level in taxonomic_levels])
+    level_dfs = dict()
+    for level in taxonomic_levels:
+        level_number = TAXONOMIC_DICT[level][0].split('-')[1]
+        if level_number not in level_csvs:
+            print('Could not find {} CSV in {}. Quitting.'.format(TAXONOMIC_DICT[level][0], input_file))
+            quit()
+        level_dfs[level] = prepare_level_df(level_csvs[level_number])
+
+    def write_report(args):
+        level, sample_name = args
+        df = prepare_df(level_df=level_dfs[level], taxonomic_level=level, sample=sample_name, cutoff=cutoff)
+        if df is None:
+            return None
+        csv_out_path = os.path.join(out_dir, 'taxonomy_report_{}_{}.csv'.format(level, sample_name))
+        df.to_csv(csv_out_path, index=False)
+        return csv_out_path
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(write_report, [(level, sample_name) for level in taxonomic_levels
+                                         for sample_name in samples]))
 
 
 if __name__ == '__main__':
     taxonomy_report_generator()
-
@@ -0,0 +1,91 @@
+import glob
+import zipfile
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from lazy_import import lazy_import
+pd = lazy_import('pandas')
+
+# Taxonomy barplots for every MiSeq run that has been through QIIME2
+TAXONOMY_BARPLOT_GLOB = '/mnt/nas2/processed_sequence_data/miseq_assemblies/*/qiime2/taxonomy_barplot.qzv'
+
+
+def run_name(tax_barplot):
+    """
+    :param tax_barplot: path to a taxonomy_barplot.qzv
+    :return: name of the run folder the barplot belongs to (i.e. 180401_M05722)
+    """
+    return tax_barplot.split('/')[-3]
+
+
+def run_date(tax_barplot):
+    """
+    :param tax_barplot: path to a taxonomy_barplot.qzv
+    :return: datetime of the run, taken from the YYMMDD at the start of the run folder name
+    """
+    return datetime.datetime.strptime(run_name(tax_barplot)[:6], '%y%m%d')
+
+
+def find_taxonomy_barplots(start_date=None, end_date=None):
+    """
+    Finds the taxonomy barplots for every run, keeping only runs strictly between start_date and end_date. The dates
+    come from the run folder names, so runs outside the range are never opened
+    :param start_date: datetime - runs on or before this date are skipped. None to not filter
+    :param end_date: datetime - runs on or after this date are skipped. None to not filter
+    :return: sorted list of paths to taxonomy_barplot.qzv files
+    """
+    tax_barplots = list()
+    for tax_barplot in sorted(glob.glob(TAXONOMY_BARPLOT_GLOB)):
+        if start_date is not None and not start_date < run_date(tax_barplot):
+            continue
+        if end_date is not None and not run_date(tax_barplot) < end_date:
+            continue
+        tax_barplots.append(tax_barplot)
+    return tax_barplots
+
+
+def read_level(tax_barplot, level):
+    """
+    QIIME2 qzv files are just zip files with a bunch of data/metadata (https://github.com/joey711/phyloseq/issues/830),
+    so the level CSV can be read straight out of the archive in place, without copying or extracting it.
+    :param tax_barplot: path to a taxonomy_barplot.qzv
+    :param level: taxonomic level (1 through 7)
+    :return: pandas DataFrame of the level-N.csv inside the archive, or None if the archive doesn't have one
+    """
+    member_name = 'data/level-{}.csv'.format(level)
+    with zipfile.ZipFile(tax_barplot, 'r') as zipomatic:
+        for member in zipomatic.namelist():
+            # Members are stored under a folder named with the UUID of the visualization
+            if member.endswith('/' + member_name):
+                with zipomatic.open(member) as csv_file:
+                    return pd.read_csv(csv_file)
+    return None
+
+
+def read_all_levels(tax_barplot, levels=range(1, 8)):
+    """
+    Reads several level CSVs out of a run's archive, opening it only once
+    :param tax_barplot: path to a taxonomy_barplot.qzv
+    :param levels: taxonomic levels to read
+    :return: dictionary of level: pandas DataFrame, for each level the archive has a CSV for
+    """
+    dataframes = dict()
+    with zipfile.ZipFile(tax_barplot, 'r') as zipomatic:
+        for member in zipomatic.namelist():
+            for level in levels:
+                if member.endswith('/data/level-{}.csv'.format(level)):
+                    with zipomatic.open(member) as csv_file:
+                        dataframes[level] = pd.read_csv(csv_file)
+    return dataframes
+
+
+def read_levels(tax_barplots, level, threads=8):
+    """
+    Reads the level CSV out of several runs' archives at once
+    :param tax_barplots: list of paths to taxonomy_barplot.qzv files
+    :param level: taxonomic level (1 through 7)
+    :param threads: number of archives to read at once
+    :return: list of (run name, DataFrame) in the same order as tax_barplots, skipping runs without the level CSV
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        dataframes = list(executor.map(lambda tax_barplot: read_level(tax_barplot, level), tax_barplots))
+    return [(run_name(tax_barplot), df) for tax_barplot, df in zip(tax_barplots, dataframes) if df is not None]
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import threading
+
+# RefSeq assembly summary, and the accession index built from it
+ASSEMBLY_SUMMARY = '/mnt/nas/Databases/RefSeq/assembly_summary_refseq.txt'
+ACCESSION_INDEX = '/mnt/nas2/redmine/refseq_accessions.sqlite'
+# Columns of the assembly summary holding accessions that can be looked up
+ACCESSION_COLUMNS = ('assembly_accession', 'gbrs_paired_asm')
+
+
+def _summary_version(summary):
+    """
+    :param summary: path to the assembly summary
+    :return: string identifying the current state of the assembly summary
+    """
+    stat = os.stat(summary)
+    return '{size}:{mtime}'.format(size=stat.st_size,
+                                   mtime=stat.st_mtime)
+
+
+def build_index(summary=ASSEMBLY_SUMMARY, index=ACCESSION_INDEX):
+    """
+    Builds an accession -> organism SQLite index from the RefSeq assembly summary. The summary is read line by line,
+    and the index is written to a temporary file and renamed into place, so jobs looking up accessions while the index
+    is rebuilt keep using the previous version
+    :param summary: path to the RefSeq assembly summary
+    :param index: path to write the index to
+    """
+    temp_index = index + '.{pid}.tmp'.format(pid=os.getpid())
+    if os.path.isfile(temp_index):
+        os.remove(temp_index)
+    connection = sqlite3.connect(temp_index)
+    connection.execute('CREATE TABLE accessions (accession TEXT PRIMARY KEY, organism TEXT)')
+    connection.execute('CREATE TABLE meta (version TEXT)')
+    with open(summary, 'r') as f:
+        # First line is a comment, second line is the header (prefixed with '# ')
+        next(f)
+        header = next(f).lstrip('# ').rstrip('\n').split('\t')
+        accession_indices = [header.index(column) for column in ACCESSION_COLUMNS]
+        organism_index = header.index('organism_name')
+        rows = list()
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            organism = fields[organism_index]
+            for accession_index in accession_indices:
+                accession = fields[accession_index]
+                if accession and accession != 'na':
+                    rows.append((accession, organism))
+        connection.executemany('INSERT OR IGNORE INTO accessions VALUES (?, ?)', rows)
+    connection.execute('INSERT INTO meta VALUES (?)', (_summary_version(summary),))
+    connection.commit()
+    connection.close()
+    os.replace(temp_index, index)
+
+
+class AccessionIndex(object):
+    """
+    Accession -> organism lookups against the prebuilt index. The index is rebuilt first if the assembly summary has
+    changed since it was last built
+    """
+
+    def __init__(self, summary=ASSEMBLY_SUMMARY, index=ACCESSION_INDEX):
+        """
+        :param summary: path to the RefSeq assembly summary
+        :param index: path to the SQLite accession index
+        """
+        if not self._up_to_date(summary, index):
+            build_index(summary=summary,
+                        index=index)
+        # Lookups can come from several threads at once (i.e. strainmash screening queries in parallel)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(index, timeout=60, check_same_thread=False)
+
+    @staticmethod
+    def _up_to_date(summary, index):
+        """
+        :return: True if the index exists and was built from the current version of the summary
+        """
+        if not os.path.isfile(index):
+            return False
+        connection = sqlite3.connect(index, timeout=60)
+        try:
+            row = connection.execute('SELECT version FROM meta').fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        connection.close()
+        return row is not None and row[0] == _summary_version(summary)
+
+    def organism(self, accession):
+        """
+        :param accession: RefSeq/GenBank assembly accession i.e. GCF_000005845.2
+        :return: organism name for the accession, or 'N/A' if it isn't in the summary
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT organism FROM accessions WHERE accession = ?',
+                                          (accession,)).fetchone()
+        if row is None or row[0] == 'na':
+            return 'N/A'
+        return row[0]
+
+    def close(self):
+        self.connection.close()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def extract_species(accession):
+    """
+    :param accession: RefSeq/GenBank assembly accession
+    :return: organism name for the accession, or 'N/A' if it can't be found
+    """
+    global _index
+    try:
+        with _index_lock:
+            if _index is None:
+                _index = AccessionIndex()
+        return _index.organism(accession)
+    except (OSError, sqlite3.Error):
+        return 'N/A'
@@ -3,11 +3,11 @@ import glob
 import click
 import pickle
 import shutil
-import sentry_sdk
-from amrsummary import before_send
-from automator_settings import SENTRY_DSN
+from amrsummary import capture_exception
 from automator_settings import COWBAT_DATABASES
-from nastools.nastools import retrieve_nas_files
+from result_cache import ResultCache, database_version
+from lazy_import import lazy_function
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
@@ -15,7 +15,6 @@ from nastools.nastools import retrieve_nas_files
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def resfinder_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     # Unpickle Redmine objects
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
     issue = pickle.load(open(issue, 'rb'))
@@ -39,13 +38,29 @@ def resfinder_redmine(redmine_instance, issue, work_dir, description):
                                           notes='WARNING: Could not find the following requested SEQIDs on'
                                                 ' the OLC NAS: {}'.format(missing_fastas))
 
-        # Run ResFindr
-        cmd = 'GeneSeekr blastn -s {seqfolder} -t {targetfolder} -r {reportdir} -A'\
-            .format(seqfolder=work_dir,
-                    targetfolder=os.path.join(COWBAT_DATABASES, 'resfinder'),
-                    reportdir=os.path.join(work_dir, 'reports'))
-        print(cmd)
-        os.system(cmd)
+        # Only assemblies without cached ResFinder rows are run through GeneSeekr
+        fasta_dict = dict()
+        for fasta in glob.glob(os.path.join(work_dir, '*.fasta')):
+            fasta_dict[os.path.splitext(os.path.basename(fasta))[0]] = fasta
+
+        def run_resfinder(seqfolder, reportdir):
+            # Run ResFindr
+            cmd = 'GeneSeekr blastn -s {seqfolder} -t {targetfolder} -r {reportdir} -A'\
+                .format(seqfolder=seqfolder,
+                        targetfolder=os.path.join(COWBAT_DATABASES, 'resfinder'),
+                        reportdir=reportdir)
+            print(cmd)
+            os.system(cmd)
+        cache = ResultCache(automator='resfinder',
+                            parameters={'analysis': 'resfinder', 'blast': 'blastn'},
+                            db_version=database_version(os.path.join(COWBAT_DATABASES, 'resfinder')))
+        try:
+            cache.combined_reports(fasta_dict=fasta_dict,
+                                   report_dir=os.path.join(work_dir, 'reports'),
+                                   work_dir=work_dir,
+                                   analyse=run_resfinder)
+        finally:
+            cache.close()
         # Get the output file uploaded.
         output_list = list()
         output_dict = dict()
@@ -62,7 +77,7 @@ def resfinder_redmine(redmine_instance, issue, work_dir, description):
         except IOError:
             pass
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -0,0 +1,641 @@
+import os
+import csv
+import json
+import time
+import glob
+import shutil
+import socket
+import hashlib
+import logging
+from fingerprint import get_store
+
+# Location of the shared result store on the NAS
+RESULT_CACHE_DIR = '/mnt/nas2/redmine/result_cache'
+# Eviction thresholds - least recently used entries are dropped once the store grows past MAX_CACHE_SIZE bytes, and
+# anything that hasn't been used in MAX_CACHE_AGE seconds is dropped regardless of size
+MAX_CACHE_SIZE = 200 * 1024 ** 3
+MAX_CACHE_AGE = 180 * 24 * 60 * 60
+# Eviction walks the whole store, so it is only done by one job in this many seconds
+EVICT_INTERVAL = 60 * 60
+# Objects without an index entry (i.e. left behind by a job that died while storing them) are removed after this long
+ORPHAN_AGE = 24 * 60 * 60
+
+
+def normalise_parameters(parameters):
+    """
+    Turns a dictionary of analysis parameters into a canonical string, so that the same request phrased slightly
+    differently (key order, case, whitespace) maps to the same cache key
+    :param parameters: dictionary of parameters that influence the output of an automator
+    :return: JSON string with sorted keys and lowercased, stripped string values
+    """
+    normalised = dict()
+    for key, value in parameters.items():
+        if isinstance(value, str):
+            value = value.strip().lower()
+        normalised[str(key).lower()] = value
+    return json.dumps(normalised, sort_keys=True)
+
+
+def database_version(database_path, recursive=False):
+    """
+    Cheap version stamp for a database or tool folder. Only the names, sizes and modification times of the entries are
+    used, so updating a database (which replaces its files) changes the stamp without having to read it
+    :param database_path: path to a database file or folder
+    :param recursive: stamp every file below the folder rather than only its top level entries. Needed for databases
+    that are updated in place within subfolders
+    :return: hex digest identifying the current state of the database
+    """
+    digest = hashlib.sha256()
+    database_path = os.path.realpath(database_path)
+    if os.path.isdir(database_path) and recursive:
+        for dirpath, dirnames, filenames in sorted(os.walk(database_path)):
+            for filename in sorted(filenames):
+                stat = os.stat(os.path.join(dirpath, filename))
+                digest.update('{name}:{size}:{mtime}\n'.format(name=os.path.relpath(os.path.join(dirpath, filename),
+                                                                                     database_path),
+                                                              size=stat.st_size,
+                                                              mtime=int(stat.st_mtime)).encode())
+    elif os.path.isdir(database_path):
+        entries = sorted(os.scandir(database_path), key=lambda entry: entry.name)
+        for entry in entries:
+            stat = entry.stat()
+            digest.update('{name}:{size}:{mtime}\n'.format(name=entry.name,
+                                                          size=stat.st_size,
+                                                          mtime=int(stat.st_mtime)).encode())
+    elif os.path.isfile(database_path):
+        stat = os.stat(database_path)
+        digest.update('{size}:{mtime}'.format(size=stat.st_size,
+                                              mtime=int(stat.st_mtime)).encode())
+    else:
+        digest.update(database_path.encode())
+    return digest.hexdigest()
+
+
+def _path_size(path):
+    """
+    :param path: path to a file or folder
+    :return: total size in bytes of the file, or of all the files within the folder
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+def _copy_path(source, destination):
+    """
+    Copies a file or a folder to destination
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+    if os.path.isdir(source):
+        shutil.copytree(source, destination)
+    else:
+        shutil.copyfile(source, destination)
+
+
+class ResultCache(object):
+    """
+    Store of per-SeqID automator outputs on the NAS. Entries are keyed by the automator name, the normalised
+    parameters, the version of the database used, and the content hash of the assembly, so that a resubmitted SeqID
+    only needs to be analysed again if any of those change. Outputs (a file or a folder) are kept under
+    RESULT_CACHE_DIR/objects/{key[:2]}/{key}.
+
+    Jobs on many nodes use the store at once, so there is no shared database to lock - SQLite locking can't be trusted
+    on the NAS. Instead each entry has a small {key}.json file next to its output, written once when the output is
+    stored, and its existence is the index. It records what is stored and how big it is, and its mtime is touched
+    whenever the entry is used. Hit/miss counts are written to a new file under RESULT_CACHE_DIR/metrics by every job
+    """
+
+    def __init__(self, automator, parameters, db_version, cache_dir=RESULT_CACHE_DIR, fingerprints=None):
+        """
+        :param automator: name of the automator using the cache i.e. 'ecgf'
+        :param parameters: dictionary of parameters that influence the output
+        :param db_version: string from database_version() for the database/tool used
+        :param cache_dir: root folder of the result store
+        :param fingerprints: FingerprintStore used to hash assemblies. Defaults to the shared store
+        """
+        self.automator = automator
+        self.parameters = normalise_parameters(parameters)
+        self.db_version = db_version
+        self.cache_dir = cache_dir
+        self.object_dir = os.path.join(cache_dir, 'objects')
+        os.makedirs(self.object_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.fingerprints = fingerprints if fingerprints is not None else get_store()
+
+    def key(self, fasta):
+        """
+        :param fasta: path to the assembly being analysed
+        :return: cache key for this assembly under the current automator, parameters and database version. Outputs
+        are labelled with the SeqID (i.e. report rows, {seqid}_* files), so the file name is part of the key along with
+        the contents
+        """
+        return self._digest(['{name}:{sha256}'.format(name=os.path.basename(fasta),
+                                                      sha256=self.fingerprints.sha256(fasta))])
+
+    def set_key(self, fastas):
+        """
+        :param fastas: paths to a set of assemblies analysed together (i.e. all the strains in a tree)
+        :return: cache key for the set of assemblies, independent of their order. Outputs for a set (i.e. tree tips)
+        are labelled with the file names of the assemblies, so the names are part of the key along with the contents
+        """
+        self.fingerprints.prefetch(fastas)
+        return self._digest(sorted('{name}:{sha256}'.format(name=os.path.basename(fasta),
+                                                            sha256=self.fingerprints.sha256(fasta))
+                                   for fasta in fastas))
+
+    def _digest(self, assembly_hashes):
+        """
+        :param assembly_hashes: list of assembly sha256 digests
+        :return: cache key combining the automator, parameters, database version and assembly hashes
+        """
+        digest = hashlib.sha256()
+        for part in [self.automator, self.parameters, self.db_version] + assembly_hashes:
+            digest.update(part.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def fetch(self, seqid, fasta, destination):
+        """
+        Copies the cached output for an assembly to destination, if there is one
+        :param seqid: SeqID of the assembly
+        :param fasta: path to the assembly
+        :param destination: path the cached output (file or folder) should be copied to
+        :return: True if the output was found in the cache, False otherwise
+        """
+        return self._fetch(self.key(fasta), seqid, destination)
+
+    def store(self, seqid, fasta, output):
+        """
+        Adds the output for an assembly to the cache
+        :param seqid: SeqID of the assembly
+        :param fasta: path to the assembly
+        :param output: path to the output (file or folder) generated for this assembly
+        """
+        self._store(self.key(fasta), seqid, output)
+
+    def fetch_set(self, fastas, destination):
+        """
+        Copies the cached output for a set of assemblies analysed together to destination, if there is one
+        :param fastas: paths to the assemblies
+        :param destination: path the cached output (file or folder) should be copied to
+        :return: True if the output was found in the cache, False otherwise
+        """
+        return self._fetch(self.set_key(fastas), '{count} assemblies'.format(count=len(fastas)), destination)
+
+    def store_set(self, fastas, output):
+        """
+        Adds the output for a set of assemblies analysed together to the cache
+        :param fastas: paths to the assemblies
+        :param output: path to the output (file or folder) generated for the set
+        """
+        self._store(self.set_key(fastas), '{count} assemblies'.format(count=len(fastas)), output)
+
+    def _paths(self, key):
+        """
+        :param key: cache key
+        :return: tuple of (path to the stored output, path to its index entry)
+        """
+        object_path = os.path.join(self.object_dir, key[:2], key)
+        return object_path, object_path + '.json'
+
+    def _fetch(self, key, label, destination):
+        """
+        :param key: cache key
+        :param label: SeqID (or description of the set of assemblies) the key belongs to, for logs
+        :param destination: path the cached output (file or folder) should be copied to
+        :return: True if the output was found in the cache, False otherwise
+        """
+        object_path, entry_path = self._paths(key)
+        try:
+            if not os.path.isfile(entry_path):
+                raise FileNotFoundError(entry_path)
+            _copy_path(object_path, destination)
+            # The mtime of the entry is when it was last used
+            os.utime(entry_path)
+        except (OSError, shutil.Error):  # Not stored, or evicted by another job while it was being copied
+            if os.path.isdir(destination):
+                shutil.rmtree(destination, ignore_errors=True)
+            elif os.path.isfile(destination):
+                os.remove(destination)
+            self.misses += 1
+            logging.info('Result cache miss for {label} ({automator})'.format(label=label,
+                                                                             automator=self.automator))
+            return False
+        self.hits += 1
+        logging.info('Result cache hit for {label} ({automator})'.format(label=label,
+                                                                        automator=self.automator))
+        return True
+
+    def _store(self, key, label, output):
+        """
+        Outputs are copied into a temporary path and renamed into place, so that a job that dies halfway through never
+        leaves a partial entry behind
+        :param key: cache key
+        :param label: SeqID (or description of the set of assemblies) the key belongs to, for logs and the index entry
+        :param output: path to the output (file or folder) to cache
+        """
+        # Failed runs leave nothing (or an empty folder) behind - don't cache those
+        if not os.path.exists(output) or (os.path.isdir(output) and not os.listdir(output)):
+            return
+        object_path, entry_path = self._paths(key)
+        suffix = '.{host}_{pid}.tmp'.format(host=socket.gethostname(), pid=os.getpid())
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        _copy_path(output, object_path + suffix)
+        if os.path.isdir(object_path):
+            shutil.rmtree(object_path, ignore_errors=True)
+        try:
+            os.replace(object_path + suffix, object_path)
+        except OSError:  # Another job stored the same output at the same time - keep theirs
+            shutil.rmtree(object_path + suffix, ignore_errors=True)
+            return
+        # The entry is only written once the output is in place, so an entry always has a complete output
+        with open(entry_path + suffix, 'w') as f:
+            json.dump({'automator': self.automator,
+                       'seqid': label,
+                       'size': _path_size(object_path),
+                       'created': time.time()}, f)
+        os.replace(entry_path + suffix, entry_path)
+
+    def partition(self, fasta_dict, output_dir, output_name):
+        """
+        Splits the requested assemblies into those that have cached outputs and those that need to be analysed.
+        Cached outputs are copied into output_dir as they are found
+        :param fasta_dict: dictionary of SeqID: path to assembly
+        :param output_dir: folder the per-SeqID outputs are collected in
+        :param output_name: format string for the name of each output within output_dir i.e. '{seqid}.csv'
+        :return: dictionary of SeqID: path to assembly for every SeqID that was not in the cache
+        """
+        misses = dict()
+        self.fingerprints.prefetch(fasta_dict.values())
+        for seqid, fasta in sorted(fasta_dict.items()):
+            destination = os.path.join(output_dir, output_name.format(seqid=seqid))
+            if not self.fetch(seqid, fasta, destination):
+                misses[seqid] = fasta
+        return misses
+
+    def store_all(self, fasta_dict, output_dir, output_name):
+        """
+        Adds the freshly generated output for each assembly in fasta_dict to the cache
+        :param fasta_dict: dictionary of SeqID: path to assembly, usually the misses returned by partition()
+        :param output_dir: folder the per-SeqID outputs were written to
+        :param output_name: format string for the name of each output within output_dir i.e. '{seqid}.csv'
+        """
+        for seqid, fasta in sorted(fasta_dict.items()):
+            self.store(seqid, fasta, os.path.join(output_dir, output_name.format(seqid=seqid)))
+
+    def combined_reports(self, fasta_dict, report_dir, work_dir, analyse):
+        """
+        Caching for tools that write combined multi-strain reports rather than one output per assembly. The tool is
+        only run over the assemblies without cached reports, its reports are split per SeqID and cached, and report_dir
+        is assembled from the cached and fresh parts
+        :param fasta_dict: dictionary of SeqID: path to assembly
+        :param report_dir: folder the combined reports should end up in
+        :param work_dir: folder for the per-SeqID reports and the assemblies that need to be analysed
+        :param analyse: function taking (folder of assemblies, folder to write reports to) that runs the tool
+        :return: dictionary of SeqID: path to assembly for every SeqID that was not in the cache
+        """
+        seqid_dir = os.path.join(work_dir, 'seqid_reports')
+        uncached = self.partition(fasta_dict=fasta_dict,
+                                  output_dir=seqid_dir,
+                                  output_name='{seqid}')
+        if uncached:
+            assembly_dir = os.path.join(work_dir, 'uncached_assemblies')
+            link_assemblies(fasta_dict=uncached,
+                            folder=assembly_dir)
+            fresh_report_dir = os.path.join(assembly_dir, 'reports')
+            analyse(assembly_dir, fresh_report_dir)
+            if os.path.isdir(fresh_report_dir):
+                reported = split_reports(report_dir=fresh_report_dir,
+                                         seqids=sorted(uncached),
+                                         output_dir=seqid_dir)
+                self.store_all(fasta_dict={seqid: uncached[seqid] for seqid in reported},
+                               output_dir=seqid_dir,
+                               output_name='{seqid}')
+            shutil.rmtree(assembly_dir)
+        combine_reports(seqid_dirs=[os.path.join(seqid_dir, seqid) for seqid in sorted(fasta_dict)],
+                        report_dir=report_dir)
+        shutil.rmtree(seqid_dir, ignore_errors=True)
+        return uncached
+
+    def hit_rate(self):
+        """
+        :return: fraction of lookups made by this instance that were served from the cache
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def close(self):
+        """
+        Records the hit/miss counts for this automator, and applies the eviction policy if no other job has done so in
+        the last EVICT_INTERVAL seconds
+        """
+        if self.hits or self.misses:
+            metrics_dir = os.path.join(self.cache_dir, 'metrics', self.automator)
+            os.makedirs(metrics_dir, exist_ok=True)
+            name = '{host}_{pid}_{time:.6f}.json'.format(host=socket.gethostname(), pid=os.getpid(), time=time.time())
+            with open(os.path.join(metrics_dir, '.' + name), 'w') as f:
+                json.dump({'hits': self.hits, 'misses': self.misses}, f)
+            os.replace(os.path.join(metrics_dir, '.' + name), os.path.join(metrics_dir, name))
+        logging.info('Result cache for {automator}: {hits} hits, {misses} misses ({rate:.0%})'
+                     .format(automator=self.automator,
+                             hits=self.hits,
+                             misses=self.misses,
+                             rate=self.hit_rate()))
+        stamp = os.path.join(self.cache_dir, 'evicted')
+        try:
+            due = time.time() - os.path.getmtime(stamp) >= EVICT_INTERVAL
+        except OSError:
+            due = True
+        if due:
+            with open(stamp, 'w') as f:
+                f.write('{host} {pid}'.format(host=socket.gethostname(), pid=os.getpid()))
+            self.evict()
+
+    def evict(self, max_size=MAX_CACHE_SIZE, max_age=MAX_CACHE_AGE):
+        """
+        Removes entries that have not been used in max_age seconds, then removes the least recently used entries until
+        the store is no larger than max_size bytes. Hit/miss counts older than max_age are dropped as well
+        :param max_size: maximum total size of the stored outputs in bytes
+        :param max_age: maximum number of seconds since an entry was last used
+        """
+        now = time.time()
+        cutoff = now - max_age
+        evicted = list()
+        kept = list()
+        for key, entry, last_used in _entries(self.cache_dir):
+            (evicted if last_used < cutoff else kept).append((last_used, key, entry.get('size', 0)))
+        total_size = sum(size for last_used, key, size in kept)
+        for last_used, key, size in sorted(kept):
+            if total_size <= max_size:
+                break
+            evicted.append((last_used, key, size))
+            total_size -= size
+        for last_used, key, size in evicted:
+            object_path, entry_path = self._paths(key)
+            # The entry goes first, so that nothing is fetched from a half removed output
+            try:
+                os.remove(entry_path)
+            except OSError:  # Evicted by another job
+                continue
+            _remove_path(object_path)
+
+        # Outputs without an entry, and temporary copies, that are left over from jobs that died while storing them
+        for path in glob.glob(os.path.join(self.object_dir, '*', '*')):
+            name = os.path.basename(path)
+            key = name.split('.')[0]
+            if name.endswith('.json') or (name == key and os.path.isfile(path + '.json')):
+                continue
+            try:
+                if now - os.path.getmtime(path) > ORPHAN_AGE:
+                    _remove_path(path)
+            except OSError:
+                pass
+        for path in glob.glob(os.path.join(self.cache_dir, 'metrics', '*', '*.json')):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def _remove_path(path):
+    """
+    Removes a file or folder, if it is still there
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _entries(cache_dir):
+    """
+    :param cache_dir: root folder of the result store
+    :return: generator of (key, index entry dictionary, time last used) for every entry in the store
+    """
+    for entry_path in glob.glob(os.path.join(cache_dir, 'objects', '*', '*.json')):
+        try:
+            last_used = os.path.getmtime(entry_path)
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):  # Evicted while we were looking
+            continue
+        yield os.path.basename(entry_path)[:-len('.json')], entry, last_used
+
+
+def cache_metrics(cache_dir=RESULT_CACHE_DIR):
+    """
+    Summarises the hit rate of the result store for each automator over the last MAX_CACHE_AGE
+    :param cache_dir: root folder of the result store
+    :return: dictionary of automator: {'hits': int, 'misses': int, 'hit_rate': float, 'entries': int, 'size': int}
+    """
+    metrics = dict()
+    for path in glob.glob(os.path.join(cache_dir, 'metrics', '*', '*.json')):
+        automator = os.path.basename(os.path.dirname(path))
+        try:
+            with open(path) as f:
+                counts = json.load(f)
+        except (OSError, ValueError):
+            continue
+        totals = metrics.setdefault(automator, {'hits': 0, 'misses': 0, 'entries': 0, 'size': 0})
+        totals['hits'] += counts['hits']
+        totals['misses'] += counts['misses']
+    for key, entry, last_used in _entries(cache_dir):
+        totals = metrics.setdefault(entry['automator'], {'hits': 0, 'misses': 0, 'entries': 0, 'size': 0})
+        totals['entries'] += 1
+        totals['size'] += entry['size']
+    for totals in metrics.values():
+        lookups = totals['hits'] + totals['misses']
+        totals['hit_rate'] = totals['hits'] / lookups if lookups else 0.0
+    return metrics
+
+
+# Reports that hold one block of rows per strain, and the delimiters of the text based ones. Automators that only
+# write combined multi-strain reports (GeneSeekr, StarAMR) are cached by splitting these reports into per-SeqID parts
+TABLE_DELIMITERS = {'.csv': ',', '.tsv': '\t', '.xlsx': None}
+
+
+def read_table(path):
+    """
+    :param path: path to a csv, tsv or xlsx report
+    :return: list of (sheet title, list of rows). Text reports have a single sheet with a title of None
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.xlsx':
+        import xlrd
+        workbook = xlrd.open_workbook(path, on_demand=True)
+        sheets = list()
+        for sheet in workbook.sheets():
+            rows = list()
+            for index in range(sheet.nrows):
+                row = list()
+                for cell in sheet.row(index):
+                    value = cell.value
+                    # xlrd reads every number as a float - whole numbers are written back as they were
+                    if cell.ctype == xlrd.XL_CELL_NUMBER and value.is_integer():
+                        value = int(value)
+                    elif cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+                        value = None
+                    row.append(value)
+                rows.append(row)
+            sheets.append((sheet.name, rows))
+        workbook.release_resources()
+        return sheets
+    with open(path, newline='') as f:
+        return [(None, list(csv.reader(f, delimiter=TABLE_DELIMITERS[extension])))]
+
+
+def write_table(path, sheets):
+    """
+    :param path: path to the csv, tsv or xlsx report to write
+    :param sheets: list of (sheet title, list of rows), as returned by read_table()
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.xlsx':
+        import xlsxwriter
+        workbook = xlsxwriter.Workbook(path)
+        for title, rows in sheets:
+            sheet = workbook.add_worksheet(title)
+            for index, row in enumerate(rows):
+                sheet.write_row(index, 0, row)
+        workbook.close()
+    else:
+        with open(path, 'w', newline='') as f:
+            csv.writer(f, delimiter=TABLE_DELIMITERS[extension], lineterminator='\n').writerows(sheets[0][1])
+
+
+def row_seqid(row, seqids):
+    """
+    :param row: report row
+    :param seqids: SeqIDs that were analysed
+    :return: the SeqID named in the first column of the row, None if the first column is empty, or False if it holds
+    something else
+    """
+    first = str(row[0]).strip() if row and row[0] is not None else str()
+    if not first:
+        return None
+    return next((seqid for seqid in seqids if first == seqid or first.startswith(seqid)), False)
+
+
+def split_rows(rows, seqids):
+    """
+    Splits the rows of a combined report by strain. Rows are assigned to the SeqID in their first column, and rows with
+    an empty first column (further hits for the same strain) to the SeqID above them
+    :param rows: list of rows, starting with the header
+    :param seqids: SeqIDs that were analysed
+    :return: tuple of (header, dictionary of SeqID: list of rows, list of rows that couldn't be assigned to a SeqID)
+    """
+    blocks = {seqid: list() for seqid in seqids}
+    unassigned = list()
+    current = None
+    for row in rows[1:]:
+        seqid = row_seqid(row, seqids)
+        if seqid:
+            current = seqid
+        elif seqid is False:
+            current = None
+        if current is None:
+            unassigned.append(row)
+        else:
+            blocks[current].append(row)
+    return rows[0] if rows else list(), blocks, unassigned
+
+
+def _report_files(report_dir):
+    """
+    :param report_dir: folder of reports
+    :return: sorted paths of every file below the folder, relative to it
+    """
+    files = list()
+    for dirpath, dirnames, filenames in os.walk(report_dir):
+        for filename in filenames:
+            files.append(os.path.relpath(os.path.join(dirpath, filename), report_dir))
+    return sorted(files)
+
+
+def split_reports(report_dir, seqids, output_dir):
+    """
+    Splits a folder of combined reports into one folder of reports per SeqID, so that they can be cached with
+    ResultCache.store_all(output_name='{seqid}'). Tables are split by row, other files go to the SeqID in their name, or
+    to every SeqID if they don't name one (i.e. a settings file). Tables (or workbook sheets) that don't name any of the
+    SeqIDs are treated the same way
+    :param report_dir: folder of reports written by one run over all the SeqIDs
+    :param seqids: SeqIDs that were analysed in the run
+    :param output_dir: folder to create the {seqid} report folders in
+    :return: set of the SeqIDs that had rows in at least one of the tables. The others may have been skipped by the
+    tool rather than having no results, so they shouldn't be cached
+    """
+    reported = set()
+    for relative in _report_files(report_dir):
+        path = os.path.join(report_dir, relative)
+        if os.path.splitext(relative)[1].lower() in TABLE_DELIMITERS:
+            seqid_sheets = {seqid: list() for seqid in seqids}
+            for title, rows in read_table(path):
+                header, blocks, unassigned = split_rows(rows, seqids)
+                if not any(blocks.values()):
+                    for seqid in seqids:
+                        seqid_sheets[seqid].append((title, rows))
+                    continue
+                if unassigned:
+                    logging.warning('Could not tell which strain {count} rows of {report} belong to'
+                                    .format(count=len(unassigned),
+                                            report=relative))
+                for seqid in seqids:
+                    seqid_sheets[seqid].append((title, [header] + blocks[seqid]))
+                    if blocks[seqid]:
+                        reported.add(seqid)
+            for seqid, sheets in seqid_sheets.items():
+                write_table(os.path.join(output_dir, seqid, relative), sheets)
+        else:
+            owners = [seqid for seqid in seqids if seqid in os.path.basename(relative)] or seqids
+            for seqid in owners:
+                _copy_path(path, os.path.join(output_dir, seqid, relative))
+    return reported
+
+
+def combine_reports(seqid_dirs, report_dir):
+    """
+    Combines per-SeqID report folders made by split_reports() (fresh or from the cache) back into combined reports
+    :param seqid_dirs: report folders to combine, in the order their rows should appear
+    :param report_dir: folder to write the combined reports to
+    """
+    tables = dict()
+    for seqid_dir in seqid_dirs:
+        if not os.path.isdir(seqid_dir):
+            continue
+        seqid = os.path.basename(seqid_dir.rstrip(os.sep))
+        for relative in _report_files(seqid_dir):
+            path = os.path.join(seqid_dir, relative)
+            if os.path.splitext(relative)[1].lower() in TABLE_DELIMITERS:
+                sheets = tables.setdefault(relative, dict())
+                for title, rows in read_table(path):
+                    if title not in sheets:
+                        sheets[title] = rows
+                    # Sheets shared by every SeqID (that don't name this one) are only included once
+                    elif any(row_seqid(row, [seqid]) for row in rows[1:]):
+                        sheets[title] += rows[1:]
+            elif not os.path.exists(os.path.join(report_dir, relative)):
+                _copy_path(path, os.path.join(report_dir, relative))
+    for relative, sheets in tables.items():
+        write_table(os.path.join(report_dir, relative), list(sheets.items()))
+
+
+def link_assemblies(fasta_dict, folder):
+    """
+    Links a set of assemblies into a folder of their own, i.e. so that a tool that works on a whole folder only sees the
+    assemblies that weren't in the cache
+    :param fasta_dict: dictionary of SeqID: path to assembly
+    :param folder: folder to create and link the assemblies into
+    """
+    os.makedirs(folder, exist_ok=True)
+    for fasta in fasta_dict.values():
+        os.symlink(os.path.realpath(fasta), os.path.join(folder, os.path.basename(fasta)))
@@ -7,9 +7,13 @@ import shutil
 import copy
 import glob
 import os
-from Bio import SeqIO
-from Bio import Phylo
-from scipy import cluster
+from tree_distances import cophenetic_matrix
+from lazy_import import lazy_import, lazy_function
+cluster = lazy_import('scipy.cluster')
+squareform = lazy_function('scipy.spatial.distance', 'squareform')
+SeqIO = lazy_import('Bio.SeqIO')
+Phylo = lazy_import('Bio.Phylo')
+np = lazy_import('numpy')
 
 
 def make_ref(input_file, output_file):
@@ -47,73 +51,68 @@ def create_clustering(treefile, desired_clusters=10):
     :param desired_clusters: The total number of clusters you want to return.
     :return: A list of strains that represent each cluster.
     """
-    num_clusters = -1
     tree = Phylo.read(treefile, "newick")
-    terminals = list()
-    clades = tree.find_clades()
-    matrix = list()
-    # Get a list of all the terminal branches
-    for clade in clades:
-        if clade.is_terminal():
-            terminals.append(str(clade))
-
-    # Create a matrix with distances between each tip and each other tip
-    for i in range(len(terminals)):
-        for j in range(i + 1, len(terminals)):
-            dist = tree.distance(terminals[i], terminals[j])
-            matrix.append(dist)
-
-    count = 1
+    # Create a matrix with distances between each tip and each other tip, all from a single walk of the tree
+    clades, matrix = cophenetic_matrix(tree)
+    terminals = [str(clade) for clade in clades]
+
     print('Finding correct number of clusters.')
     # Create the linkage thingy so we can try clustering.
-    z = cluster.hierarchy.linkage(matrix, method='average')
-    # Try different cutoff levels for making clusters. Start at a very large cluster distance.
-    # Check if enough clusters are created. If not enough, make the cutoff slightly smaller and repeat process.
-    cluster_distance = 0.9
-    while num_clusters < desired_clusters:
-        clustering = cluster.hierarchy.fcluster(z, cluster_distance, criterion='distance')
-        num_clusters = (max(clustering))
-        cluster_distance -= 0.00003
-        count += 1
+    z = cluster.hierarchy.linkage(squareform(matrix, checks=False), method='average')
+    clustering = find_clusters(z, desired_clusters)
+    num_clusters = max(clustering)
     # Once we've found the desired number of clusters, create a 2d array where each element of the array is a cluster
     # and each element is made up of a list of strains that are part of that cluster.
     clusters = list()
     for i in range(num_clusters):
         clusters.append(list())
     for i in range(len(clustering)):
-        clusters[clustering[i] - 1].append(terminals[i])
+        clusters[clustering[i] - 1].append(i)
 
     # Now that we have a list of strains for each cluster, choose the strain that's the most like everything else
     # in each cluster (the most average-y thing I guess?) to be the representative.
     strains = list()
     for c in clusters:
-        representative_strain = choose_representative_strain(c, tree)
+        representative_strain = terminals[choose_representative_strain(c, matrix)]
         representative_strain = representative_strain.replace('.fasta', '')
         strains.append(representative_strain)
 
     return strains
 
 
-def choose_representative_strain(cluster, tree):
+def find_clusters(z, desired_clusters):
+    """
+    Cuts the linkage into the desired number of clusters. maxclust normally gets there directly, but if tied merge
+    heights mean it can't, bisect on the merge heights for the largest cutoff that gives at least that many clusters.
+    :param z: Linkage matrix from scipy.cluster.hierarchy.linkage
+    :param desired_clusters: Number of clusters wanted.
+    :return: Array of cluster numbers (starting at 1) for each tip.
+    """
+    clustering = cluster.hierarchy.fcluster(z, desired_clusters, criterion='maxclust')
+    if max(clustering) >= desired_clusters:
+        return clustering
+    # Number of clusters only goes down as the cutoff goes up, so bisect on the sorted merge heights
+    heights = np.concatenate(([0.0], np.unique(z[:, 2])))
+    low, high = 0, len(heights) - 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        if max(cluster.hierarchy.fcluster(z, heights[middle], criterion='distance')) >= desired_clusters:
+            low = middle
+        else:
+            high = middle - 1
+    return cluster.hierarchy.fcluster(z, heights[low], criterion='distance')
+
+
+def choose_representative_strain(cluster, matrix):
     """
     Given a cluster, will find which tip in that cluster tends to be closest to all others (aka the best representative)
     and return that tip
-    :param cluster: Cluster found.
-    :param tree: Tree read in by Bio.Phylo
-    :return: representative strain.
+    :param cluster: List of indices of the tips in the cluster.
+    :param matrix: Matrix of distances between every pair of tips, from cophenetic_matrix.
+    :return: index of the representative strain.
     """
-    representative = 'NA'
-    best_distance = 100000000.0  # Start off at an absolutely ridiculous value.
-    # Iterate through
-    for strain1 in cluster:
-        total_length = 0.0
-        for strain2 in cluster:
-            if strain1 != strain2:
-                total_length += tree.distance(strain1, strain2)
-        if total_length < best_distance:
-            best_distance = total_length
-            representative = strain1
-    return representative
+    total_lengths = matrix[np.ix_(cluster, cluster)].sum(axis=1)
+    return cluster[int(np.argmin(total_lengths))]
 
 
 def main(args):
@@ -3,9 +3,10 @@ import glob
 import click
 import pickle
 import shutil
-from biotools import mash
 from automator_settings import COWBAT_DATABASES
-from nastools.nastools import retrieve_nas_files
+from lazy_import import lazy_import, lazy_function
+mash = lazy_import('biotools.mash')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 
 @click.command()
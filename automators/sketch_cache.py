@@ -0,0 +1,60 @@
+import os
+import subprocess
+from fingerprint import get_store
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-assembly mash sketches, stored by assembly fingerprint and file name (the name is stored in the sketch and reported
+# by mash dist, so the same assembly under another SeqID needs its own sketch)
+SKETCH_CACHE_DIR = '/mnt/nas2/redmine/sketch_cache'
+
+
+def _sketch(fasta, sketch):
+    """
+    Sketches a single assembly. The sketch is made from the real path of the assembly (i.e. the file on the NAS rather
+    than a link to it in a work directory), so the name stored in the sketch stays meaningful for later requests. It is
+    written under a temporary name and renamed into place so that a half-written sketch is never picked up
+    :param fasta: path to assembly
+    :param sketch: path the sketch should end up at
+    """
+    temp_prefix = sketch.replace('.msh', '.{pid}.tmp'.format(pid=os.getpid()))
+    subprocess.check_call(['mash', 'sketch', '-p', '1', '-o', temp_prefix, os.path.realpath(fasta)])
+    os.replace(temp_prefix + '.msh', sketch)
+
+
+def sketch_assemblies(fastas, threads=8, cache_dir=SKETCH_CACHE_DIR):
+    """
+    Finds the cached sketch for each assembly, sketching (in parallel) only the assemblies that haven't been seen
+    :param fastas: list of paths to assemblies
+    :param threads: number of assemblies to sketch at once
+    :param cache_dir: root folder of the sketch cache
+    :return: list of paths to sketches, in the same order as fastas
+    """
+    fingerprints = get_store()
+    fingerprints.prefetch(fastas)
+    sketches = list()
+    missing = dict()
+    for fasta in fastas:
+        sha256 = fingerprints.sha256(fasta)
+        name = os.path.basename(os.path.realpath(fasta))
+        sketch = os.path.join(cache_dir, sha256[:2], '{sha256}_{name}.msh'.format(sha256=sha256,
+                                                                                 name=name))
+        sketches.append(sketch)
+        if not os.path.isfile(sketch):
+            os.makedirs(os.path.dirname(sketch), exist_ok=True)
+            missing[sketch] = fasta
+    if missing:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for future in [executor.submit(_sketch, fasta, sketch) for sketch, fasta in missing.items()]:
+                future.result()
+    return sketches
+
+
+def combine_sketches(sketches, output_prefix):
+    """
+    Pastes a set of sketches together into a single sketch
+    :param sketches: list of paths to sketches
+    :param output_prefix: prefix for the combined sketch (mash adds .msh)
+    :return: path to the combined sketch
+    """
+    subprocess.check_call(['mash', 'paste', output_prefix] + sketches)
+    return output_prefix + '.msh'
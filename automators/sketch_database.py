@@ -0,0 +1,211 @@
+import os
+import glob
+import time
+import click
+import shutil
+import socket
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Maintained mash sketch of every assembly on the NAS. Each build lives in its own versions/ folder, and 'current' is a
+# symlink to the latest complete build
+SKETCH_DATABASE_DIR = '/mnt/nas2/redmine/sketch_database'
+SKETCH_NAME = 'all_sequences.msh'
+ASSEMBLY_GLOB = '/mnt/nas2/processed_sequence_data/*/*/BestAssemblies/*.fasta'
+# Hand built sketch used before the maintained database existed
+LEGACY_SKETCH = '/mnt/nas2/redmine/bio_requests/14674/all_sequences.msh'
+# Number of old versions to keep around for jobs that may still be reading them
+KEEP_VERSIONS = 2
+# An update lock older than this many seconds is taken to have been left behind by a run that died
+LOCK_TIMEOUT = 24 * 60 * 60
+
+
+def current_sketch(database_dir=SKETCH_DATABASE_DIR):
+    """
+    :param database_dir: root folder of the sketch database
+    :return: path to the current all-sequences sketch, or the legacy hand built sketch if no build exists yet
+    """
+    sketch = os.path.join(os.path.realpath(os.path.join(database_dir, 'current')), SKETCH_NAME)
+    if os.path.isfile(sketch):
+        return sketch
+    return LEGACY_SKETCH
+
+
+def read_manifest_entries(version_dir):
+    """
+    :param version_dir: folder of a sketch database build
+    :return: dictionary of assembly path: (size, mtime, name of the batch sketch it is in) for every assembly in the
+    build. Builds made before batches were kept list paths only, and have None for all three
+    """
+    manifest = os.path.join(version_dir, 'manifest.txt')
+    entries = dict()
+    if not os.path.isfile(manifest):
+        return entries
+    with open(manifest, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 4:
+                entries[fields[0]] = (int(fields[1]), int(fields[2]), fields[3])
+            else:
+                entries[fields[0]] = (None, None, None)
+    return entries
+
+
+def read_manifest(version_dir):
+    """
+    :param version_dir: folder of a sketch database build
+    :return: set of the assembly paths included in the build
+    """
+    return set(read_manifest_entries(version_dir))
+
+
+def acquire_lock(database_dir):
+    """
+    Takes the update lock, so that overlapping runs (i.e. a slow build still going when cron starts the next one) can't
+    both build a new version and switch 'current' over. The lock file is created exclusively, which also works on NFS.
+    Locks left behind by runs that died on this host, or that are older than LOCK_TIMEOUT, are taken over
+    :param database_dir: root folder of the sketch database
+    :return: path to the lock file, or None if another update holds it
+    """
+    lock = os.path.join(database_dir, 'update.lock')
+    for _ in range(2):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(lock, 'r') as f:
+                    host, pid = f.read().split()
+                age = time.time() - os.path.getmtime(lock)
+            except (OSError, ValueError):  # Released, or not written yet, while we were looking
+                return None
+            if host == socket.gethostname() and not os.path.isdir('/proc/{pid}'.format(pid=pid)) \
+                    or age > LOCK_TIMEOUT:
+                os.remove(lock)
+                continue
+            return None
+        with os.fdopen(fd, 'w') as f:
+            f.write('{host} {pid}'.format(host=socket.gethostname(), pid=os.getpid()))
+        return lock
+    return None
+
+
+def sketch_batch(fastas, output_prefix, threads):
+    """
+    Sketches a batch of assemblies with mash
+    :param fastas: list of paths to assemblies
+    :param output_prefix: prefix for the output sketch (mash adds .msh)
+    :param threads: number of threads for mash to use
+    :return: path to the sketch
+    """
+    file_list = output_prefix + '_files.txt'
+    with open(file_list, 'w') as f:
+        f.write('\n'.join(fastas) + '\n')
+    subprocess.check_call(['mash', 'sketch', '-p', str(threads), '-l', file_list, '-o', output_prefix])
+    os.remove(file_list)
+    return output_prefix + '.msh'
+
+
+def update_sketch_database(database_dir=SKETCH_DATABASE_DIR, assembly_glob=ASSEMBLY_GLOB, threads=8, processes=4,
+                           batch_size=500):
+    """
+    Brings the sketch database up to date. Assemblies are sketched in batches that are kept between builds, and the
+    manifest records the size, mtime and batch of every assembly. Only batches holding an assembly that is new, has
+    been changed in place (i.e. re-run into the same BestAssemblies path) or has been removed are sketched again, and
+    the batch sketches are merged into a new version with mash paste. The 'current' link is then switched over to the
+    new version in one rename, so jobs always see a complete sketch
+    :param database_dir: root folder of the sketch database
+    :param assembly_glob: glob matching every assembly that should be in the database
+    :param threads: number of threads for each mash sketch process
+    :param processes: number of mash sketch processes to run at once
+    :param batch_size: number of assemblies to sketch per mash sketch process
+    :return: path to the current sketch, or None if another update is already running
+    """
+    os.makedirs(database_dir, exist_ok=True)
+    lock = acquire_lock(database_dir)
+    if lock is None:
+        print('Another update of the sketch database is running')
+        return None
+    try:
+        return _update_sketch_database(database_dir=database_dir,
+                                       assembly_glob=assembly_glob,
+                                       threads=threads,
+                                       processes=processes,
+                                       batch_size=batch_size)
+    finally:
+        os.remove(lock)
+
+
+def _update_sketch_database(database_dir, assembly_glob, threads, processes, batch_size):
+    """
+    Does the work of update_sketch_database() once the lock is held
+    """
+    current_dir = os.path.realpath(os.path.join(database_dir, 'current'))
+    included = read_manifest_entries(current_dir)
+    assemblies = dict()
+    for fasta in glob.glob(assembly_glob):
+        try:
+            stat = os.stat(fasta)
+        except OSError:  # Removed while we were looking
+            continue
+        assemblies[fasta] = (stat.st_size, int(stat.st_mtime))
+    # A batch sketch can't have assemblies taken out of it, so any batch with a stale assembly is sketched again
+    stale_batches = set(batch for fasta, (size, mtime, batch) in included.items()
+                        if batch is None or assemblies.get(fasta) != (size, mtime))
+    kept = dict((fasta, entry) for fasta, entry in included.items() if entry[2] not in stale_batches)
+    to_sketch = sorted(fasta for fasta in assemblies if fasta not in kept)
+    if not to_sketch and (not stale_batches or not kept):
+        return current_sketch(database_dir)
+    version = time.strftime('%Y%m%d%H%M%S')
+    version_dir = os.path.join(database_dir, 'versions', version)
+    batch_dir = os.path.join(database_dir, 'batches')
+    os.makedirs(version_dir)
+    os.makedirs(batch_dir, exist_ok=True)
+    batches = [to_sketch[i:i + batch_size] for i in range(0, len(to_sketch), batch_size)]
+    batch_names = ['{version}_{i}'.format(version=version, i=i) for i in range(len(batches))]
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        list(executor.map(lambda args: sketch_batch(*args),
+                          [(batch, os.path.join(batch_dir, name), threads)
+                           for batch, name in zip(batches, batch_names)]))
+    for batch, name in zip(batches, batch_names):
+        for fasta in batch:
+            kept[fasta] = assemblies[fasta] + (name,)
+    # Merge every batch still in use into the new build
+    sketches = [os.path.join(batch_dir, name + '.msh') for name in sorted(set(entry[2] for entry in kept.values()))]
+    subprocess.check_call(['mash', 'paste', os.path.join(version_dir, os.path.splitext(SKETCH_NAME)[0])] + sketches)
+    with open(os.path.join(version_dir, 'manifest.txt'), 'w') as f:
+        for fasta, (size, mtime, batch) in sorted(kept.items()):
+            f.write('{fasta}\t{size}\t{mtime}\t{batch}\n'.format(fasta=fasta, size=size, mtime=mtime, batch=batch))
+    # Atomically point 'current' at the new build
+    temp_link = os.path.join(database_dir, 'current.{pid}.tmp'.format(pid=os.getpid()))
+    os.symlink(version_dir, temp_link)
+    os.replace(temp_link, os.path.join(database_dir, 'current'))
+    # Clear out old builds, and the batches that none of the remaining builds use
+    versions = sorted(glob.glob(os.path.join(database_dir, 'versions', '*')))
+    for old_version in versions[:-(KEEP_VERSIONS + 1)]:
+        shutil.rmtree(old_version, ignore_errors=True)
+    in_use = set()
+    for remaining_version in versions[-(KEEP_VERSIONS + 1):]:
+        in_use.update(entry[2] for entry in read_manifest_entries(remaining_version).values())
+    for batch_sketch in glob.glob(os.path.join(batch_dir, '*.msh')):
+        if os.path.splitext(os.path.basename(batch_sketch))[0] not in in_use:
+            os.remove(batch_sketch)
+    return current_sketch(database_dir)
+
+
+@click.command()
+@click.option('--threads', default=8, help='Number of threads for each mash sketch process')
+@click.option('--processes', default=4, help='Number of mash sketch processes to run at once')
+def main(threads, processes):
+    """
+    Adds any new or changed assemblies on the NAS to the all-sequences sketch database, and drops removed ones. Meant
+    to be run regularly (i.e. from cron). The first run on a build made before batches were kept sketches everything
+    again
+    """
+    print(update_sketch_database(threads=threads,
+                                 processes=processes))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,10 @@ import glob
 import click
 import pickle
 import shutil
-import sentry_sdk
-from automator_settings import SENTRY_DSN
-from amrsummary import before_send
-from biotools import mash
-from nastools.nastools import retrieve_nas_files
+from amrsummary import capture_exception
+from lazy_import import lazy_import, lazy_function
+mash = lazy_import('biotools.mash')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 
 @click.command()
@@ -16,7 +15,6 @@ from nastools.nastools import retrieve_nas_files
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def snvphyl_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     # Unpickle Redmine objects
     redmine_instance = pickle.load(open(redmine_instance, 'rb'))
     issue = pickle.load(open(issue, 'rb'))
@@ -130,7 +128,7 @@ def snvphyl_redmine(redmine_instance, issue, work_dir, description):
 
         shutil.rmtree(os.path.join(work_dir, 'fastqs'))
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
@@ -1,15 +1,15 @@
-from accessoryFunctions.accessoryFunctions import make_path
-from nastools.nastools import retrieve_nas_files
-from biotools import mash
+from genus_caller import call_genera
+from result_cache import ResultCache, database_version
 import pickle
 import shutil
 import click
 import glob
 import os
 
-import sentry_sdk
-from amrsummary import before_send
-from automator_settings import SENTRY_DSN
+from amrsummary import capture_exception
+from lazy_import import lazy_function
+make_path = lazy_function('accessoryFunctions.accessoryFunctions', 'make_path')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
 
 @click.command()
 @click.option('--redmine_instance', help='Path to pickled Redmine API instance')
@@ -17,7 +17,6 @@ from automator_settings import SENTRY_DSN
 @click.option('--work_dir', help='Path to Redmine issue work directory')
 @click.option('--description', help='Path to pickled Redmine description')
 def staramr_redmine(redmine_instance, issue, work_dir, description):
-    sentry_sdk.init(SENTRY_DSN, before_send=before_send)
     try:
         # Unpickle Redmine objects
         redmine_instance = pickle.load(open(redmine_instance, 'rb'))
@@ -50,9 +49,8 @@ def staramr_redmine(redmine_instance, issue, work_dir, description):
         fasta_list = sorted(glob.glob(os.path.join(work_dir, '*.fasta')))
         # Set the folder to store all the PointFinder outputs
         staramr_output_dir = os.path.join(work_dir, 'staramr_outputs')
-        # Initialise a dictionaries to store the mash-calculated, and pointfinder-formatted genus outputs for each strain
+        # Initialise a dictionary to store the pointfinder-formatted genus outputs for each strain
         genus_dict = dict()
-        organism_dict = dict()
         # Create lists to store missing and unprocessed seqids
         unprocessed_seqs = list()
         missing_seqs = list()
@@ -71,30 +69,18 @@ def staramr_redmine(redmine_instance, issue, work_dir, description):
                         'gonorrhoeae': 'Neisseria',
                         'salmonella': 'Salmonella'}
 
-        # Run mash screen on each of the assemblies
+        # Call the genus of all the assemblies with one staged copy of the RefSeq sketch
+        fasta_dict = dict()
         for item in fasta_list:
-            seqid = os.path.splitext(os.path.basename(item))[0]
-            screen_file = os.path.join(output_dir, '{seqid}_screen.tab'.format(seqid=seqid))
-            mash.screen('/mnt/nas2/databases/confindr/databases/refseq.msh',
-                        item,
-                        threads=8,
-                        w='',
-                        i='0.95',
-                        output_file=screen_file,
-                        returncmd=True)
-            screen_output = mash.read_mash_screen(screen_file)
-            # Determine the genus from the screen output file
-            for screen in screen_output:
-                # Extract the genus from the mash results
-                mash_organism = screen.query_id.split('/')[-3]
-                # Use the organism as a key in the pointfinder database name conversion dictionary
-                try:
-                    mash_genus = pointfinder_org_dict[mash_organism]
-                except KeyError:
-                    mash_genus = 'NA'
-                # Populate the dictionaries with the seqid, and the calculated genus/pointfinder name
-                genus_dict[seqid] = mash_genus
-                organism_dict[seqid] = mash_organism
+            fasta_dict[os.path.splitext(os.path.basename(item))[0]] = item
+        organism_dict = call_genera(fasta_dict=fasta_dict,
+                                    output_dir=output_dir)
+        for seqid, mash_organism in organism_dict.items():
+            # Use the organism as a key in the pointfinder database name conversion dictionary
+            try:
+                genus_dict[seqid] = pointfinder_org_dict[mash_organism]
+            except KeyError:
+                genus_dict[seqid] = 'NA'
         # Delete all of the FASTA files
         for fasta in fasta_list:
             os.remove(fasta)
@@ -105,6 +91,9 @@ def staramr_redmine(redmine_instance, issue, work_dir, description):
         # These unfortunate hard coded paths appear to be necessary
         activate = 'source /home/ubuntu/miniconda3/bin/activate /mnt/nas2/virtual_environments/staramr'
         staramr_py = '/mnt/nas2/virtual_environments/staramr/bin/staramr'
+        # The StarAMR databases live within the package, and are updated in place by staramr db update
+        staramr_db = glob.glob('/mnt/nas2/virtual_environments/staramr/lib/python3*/site-packages/staramr/databases/'
+                               'data')
         # List of organisms in the pointfinder database
         staramr_list = ['campylobacter', 'salmonella']
         try:
@@ -131,24 +120,39 @@ def staramr_redmine(redmine_instance, issue, work_dir, description):
                                    outdir=assembly_folder,
                                    filetype='fasta',
                                    copyflag=False)
-                fastas = sorted(glob.glob(os.path.join(assembly_folder, '*.fasta')))
-                outdir = os.path.join(staramr_output_dir, genus)
-                cmd = '{py} search --pointfinder-organism {orgn} -o {output} ' \
-                    .format(py=staramr_py,
-                            orgn=genus,
-                            output=outdir,
-                            )
-                for fasta in fastas:
-                    cmd += fasta + ' '
-                # Create another shell script to execute within the PlasmidExtractor conda environment
-                template = "#!/bin/bash\n{} && {}".format(activate, cmd)
-                pointfinder_script = os.path.join(work_dir, 'run_staramr.sh')
-                with open(pointfinder_script, 'w+') as f:
-                    f.write(template)
-                # Modify the permissions of the script to allow it to be run on the node
-                make_executable(pointfinder_script)
-                # Run shell script
-                os.system(pointfinder_script)
+                genus_fasta_dict = dict()
+                for fasta in sorted(glob.glob(os.path.join(assembly_folder, '*.fasta'))):
+                    genus_fasta_dict[os.path.splitext(os.path.basename(fasta))[0]] = fasta
+
+                def run_staramr(seqfolder, outdir):
+                    cmd = '{py} search --pointfinder-organism {orgn} -o {output} ' \
+                        .format(py=staramr_py,
+                                orgn=genus,
+                                output=outdir,
+                                )
+                    for fasta in sorted(glob.glob(os.path.join(seqfolder, '*.fasta'))):
+                        cmd += fasta + ' '
+                    # Create another shell script to execute within the PlasmidExtractor conda environment
+                    template = "#!/bin/bash\n{} && {}".format(activate, cmd)
+                    pointfinder_script = os.path.join(work_dir, 'run_staramr.sh')
+                    with open(pointfinder_script, 'w+') as f:
+                        f.write(template)
+                    # Modify the permissions of the script to allow it to be run on the node
+                    make_executable(pointfinder_script)
+                    # Run shell script
+                    os.system(pointfinder_script)
+                # StarAMR is only run on the assemblies of this genus that don't have cached results
+                cache = ResultCache(automator='staramr',
+                                    parameters={'pointfinder_organism': genus},
+                                    db_version=database_version(staramr_db[0] if staramr_db else staramr_py,
+                                                                recursive=True))
+                try:
+                    cache.combined_reports(fasta_dict=genus_fasta_dict,
+                                           report_dir=os.path.join(staramr_output_dir, genus),
+                                           work_dir=assembly_folder,
+                                           analyse=run_staramr)
+                finally:
+                    cache.close()
             else:
                 for seqid in genus_seqid_dict[genus]:
                     unprocessed_seqs.append(seqid)
@@ -207,7 +211,7 @@ def staramr_redmine(redmine_instance, issue, work_dir, description):
                                       status_id=4,
                                       notes=notes)
     except Exception as e:
-        sentry_sdk.capture_exception(e)
+        capture_exception(e)
         redmine_instance.issue.update(resource_id=issue.id,
                                       notes='Something went wrong! We log this automatically and will look into the '
                                             'problem and get back to you with a fix soon.')
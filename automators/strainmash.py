@@ -3,10 +3,18 @@ import re
 import glob
 import click
 import pickle
+import heapq
 import shutil
-import pandas as pd
-from biotools import mash
-from nastools.nastools import retrieve_nas_files
+from refseq_index import extract_species
+from genus_caller import stage_sketch
+from cpu_allocation import allocated_cpus
+from concurrent.futures import ThreadPoolExecutor
+from lazy_import import lazy_import, lazy_function
+mash = lazy_import('biotools.mash')
+retrieve_nas_files = lazy_function('nastools.nastools', 'retrieve_nas_files')
+
+# Mash sketch of the GenBank type strains that queries are screened against
+TYPESTRAIN_SKETCH = '/mnt/nas/Databases/GenBank/typestrains/typestrains_sketch.msh'
 
 
 @click.command()
@@ -20,9 +28,6 @@ def strainmash_redmine(redmine_instance, issue, work_dir, description):
     issue = pickle.load(open(issue, 'rb'))
     description = pickle.load(open(description, 'rb'))
 
-    # Reference path
-    typestrain_db_path = '/mnt/nas/Databases/GenBank/typestrains/typestrains_sketch.msh'
-
     # Parse description to get list of SeqIDs
     seqids = []
     for i in range(0, len(description)):
@@ -45,21 +50,29 @@ def strainmash_redmine(redmine_instance, issue, work_dir, description):
     os.mkdir(output_dir)
 
     # Get all of the FASTA files
-    fasta_list = glob.glob(os.path.join(work_dir, '*.fasta'))
-
-    # Run mash_screen on everything
-    for item in fasta_list:
-        output_filepath = os.path.join(output_dir, (item.replace('.fasta', '') + '_strainmash.txt'))
-
-        mash_screen(reference=typestrain_db_path,
-                    queryfile=item,
-                    outname=output_filepath)
-
-
-    # Move all files to the actual output folder - this is a workaround to a weird bug
-    output_files = glob.glob(os.path.join(work_dir, '*strainmash.txt'))
-    for file in output_files:
-        os.rename(file, os.path.join(output_dir, os.path.basename(file)))
+    fasta_list = sorted(glob.glob(os.path.join(work_dir, '*.fasta')))
+
+    # Screen all of the queries at once against a single node-local copy of the typestrain sketch
+    typestrain_sketch = stage_sketch(TYPESTRAIN_SKETCH)
+    cpus = allocated_cpus()
+    processes = max(1, min(len(fasta_list), cpus))
+    threads = max(1, cpus // processes)
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        futures = dict()
+        for item in fasta_list:
+            sample = os.path.basename(item).replace('.fasta', '')
+            output_filepath = os.path.join(output_dir, sample + '_strainmash.txt')
+            futures[sample] = executor.submit(mash_screen,
+                                              reference=typestrain_sketch,
+                                              queryfile=item,
+                                              outname=output_filepath,
+                                              threads=threads)
+    # Combined table of the top hits for every query, alongside the per-sample files
+    with open(os.path.join(output_dir, 'strainmash_summary.txt'), 'w') as summary:
+        summary.write('Sample\t' + '\t'.join(COLNAMES) + '\n')
+        for sample in sorted(futures):
+            for row in futures[sample].result():
+                summary.write(sample + '\t' + '\t'.join(str(value) for value in row) + '\n')
 
     # Zip output folder
     shutil.make_archive(output_dir, 'zip', work_dir, 'output')
@@ -89,74 +102,67 @@ def strainmash_redmine(redmine_instance, issue, work_dir, description):
     shutil.rmtree(output_dir)
 
 
-def mash_screen(reference, queryfile, outname):
-    mash.screen(reference, queryfile, output_file=outname, w='')
-    mash2pandas(outname)
-
-
-def mash2pandas(outname):
-    # Pandas
-    df = pd.read_csv(outname, sep='\t', header=None)
-    try:
-        df = df.drop(df.columns[[5]], axis=1)
-    except:
-        pass
-    df = df.loc[df[0] >= 0.7]
-    df = df.sort_values(df.columns[0], ascending=False)
-
-    # Get rid of path from names in output (artifact of the straindb)
-    df[4] = df[4].apply(lambda x: os.path.basename(x))
-
-    # Grab only the accession with some regex
-    df[4] = df[4].apply(lambda x: re.findall(r"^\w{3}_\d+\.\d", x)[0])
-
-    # Reset the index
-    df.reset_index(drop=True, inplace=True)
-
-    # Take only the top 10 rows to significantly cut down on Entrez retrieval time
-    df = df[:10]
-
-    # Map the extract_entrez_data function on each accession
-    df['Organism'] = df[4].map(extract_species)
-
-    # Print out top hit
-    tophit_name = df[4].iloc[0]
-    tophit_score = df[1].iloc[0]
-    print(df)
-    print('\nTop Hit: {}\nScore: {}'.format(tophit_name, tophit_score))
-
-    # Header names
-    colnames = [
-        'MashDistance',
-        'NumMatchingHashes',
-        'MedianMultiplicity',
-        'Pvalue',
-        'ReferenceStrain',
-        'Organism'
-    ]
-
-    # Overwrite mash.screen output with a nice Pandas df
-    try:
-        df.to_csv(outname, sep='\t', header=colnames, index=False)
-    except:
-        df.to_csv(outname, sep='\t', header=None, index=False)
-
-
-def extract_species(accession):
-    try:
-        df = pd.read_csv('/mnt/nas/Databases/RefSeq/assembly_summary_refseq.txt',
-                         skiprows=1,
-                         delimiter='\t')
-        df_filtered = df[df.values == accession]
-        organism = df_filtered['organism_name'].values[0]
-
-        # Consistency
-        if organism is 'na':
-            organism = 'N/A'
-    except:
-        organism = 'N/A'
-
-    return organism
+# Header names
+COLNAMES = [
+    'MashDistance',
+    'NumMatchingHashes',
+    'MedianMultiplicity',
+    'Pvalue',
+    'ReferenceStrain',
+    'Organism'
+]
+
+
+def mash_screen(reference, queryfile, outname, threads=1, top_k=10):
+    """
+    Runs mash screen on a query, and overwrites the raw output with a table of the top hits
+    :param reference: path to the typestrain sketch
+    :param queryfile: path to query FASTA
+    :param outname: path to the output file
+    :param threads: number of threads for mash to use
+    :param top_k: number of hits to keep
+    :return: list of the top hits, as rows of COLNAMES
+    """
+    mash.screen(reference, queryfile, threads=threads, output_file=outname, w='')
+    rows = parse_screen(outname, top_k=top_k)
+    if rows:
+        print('\nTop Hit: {}\nScore: {}'.format(rows[0][4], rows[0][1]))
+    # Overwrite mash.screen output with the top hits
+    with open(outname, 'w') as f:
+        f.write('\t'.join(COLNAMES) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(value) for value in row) + '\n')
+    return rows
+
+
+def parse_screen(outname, top_k=10, min_identity=0.7):
+    """
+    Streams through mash screen output, keeping only the best top_k hits with an identity of at least min_identity,
+    rather than loading the whole table
+    :param outname: path to mash screen output
+    :param top_k: number of hits to keep
+    :param min_identity: minimum identity for a hit to be kept
+    :return: list of the top hits sorted by identity, as rows of COLNAMES
+    """
+    hits = list()
+    with open(outname, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5 or float(fields[0]) < min_identity:
+                continue
+            hits.append((float(fields[0]), fields[1], fields[2], fields[3], fields[4]))
+            # Keep the list bounded - only ever hold a few times top_k rows
+            if len(hits) > top_k * 10:
+                hits = heapq.nlargest(top_k, hits, key=lambda hit: hit[0])
+    rows = list()
+    for identity, shared_hashes, multiplicity, pvalue, query_id in heapq.nlargest(top_k, hits,
+                                                                                  key=lambda hit: hit[0]):
+        # Get rid of path from names in output (artifact of the straindb), and grab only the accession
+        reference = os.path.basename(query_id)
+        accession = re.findall(r"^\w{3}_\d+\.\d", reference)
+        reference = accession[0] if accession else reference
+        rows.append([identity, shared_hashes, multiplicity, pvalue, reference, extract_species(reference)])
+    return rows
 
 
 if __name__ == '__main__':
@@ -0,0 +1,79 @@
+from lazy_import import lazy_import
+np = lazy_import('numpy')
+
+
+def clade_depths(tree):
+    """
+    Finds the distance from the root to every clade in a tree in a single walk. The walk is iterative, so very deep
+    (i.e. ladder-like) trees don't run into the recursion limit the way Bio.Phylo's own helpers can
+    :param tree: Tree read in by Bio.Phylo
+    :return: tuple of (dictionary of id(clade): depth, list of clades in preorder)
+    """
+    depths = {id(tree.root): 0.0}
+    preorder = list()
+    stack = [tree.root]
+    while stack:
+        clade = stack.pop()
+        preorder.append(clade)
+        for child in reversed(clade.clades):
+            depths[id(child)] = depths[id(clade)] + (child.branch_length or 0.0)
+            stack.append(child)
+    return depths, preorder
+
+
+def cophenetic_matrix(tree):
+    """
+    Builds the matrix of tree distances between every pair of tips. Rather than walking the tree for each pair, the
+    tips under each internal clade are gathered bottom-up, and the distances between tips that meet at a clade are
+    filled in as a block: depth(a) + depth(b) - 2 * depth(clade)
+    :param tree: Tree read in by Bio.Phylo
+    :return: tuple of (list of terminal clades, numpy array of pairwise distances in the same order)
+    """
+    depths, preorder = clade_depths(tree)
+    terminals = [clade for clade in preorder if clade.is_terminal()]
+    index = dict((id(clade), i) for i, clade in enumerate(terminals))
+    tip_depths = np.array([depths[id(clade)] for clade in terminals])
+    matrix = np.zeros((len(terminals), len(terminals)))
+    tips = dict()
+    # Children always come after their parents in preorder, so going backwards handles every child first
+    for clade in reversed(preorder):
+        if clade.is_terminal():
+            tips[id(clade)] = np.array([index[id(clade)]])
+            continue
+        gathered = np.array([], dtype=int)
+        for child in clade.clades:
+            child_tips = tips.pop(id(child))
+            if len(gathered):
+                block = tip_depths[gathered][:, None] + tip_depths[child_tips][None, :] - 2 * depths[id(clade)]
+                matrix[np.ix_(gathered, child_tips)] = block
+                matrix[np.ix_(child_tips, gathered)] = block.T
+            gathered = np.concatenate((gathered, child_tips))
+        tips[id(clade)] = gathered
+    return terminals, matrix
+
+
+def distances_to_clade(tree, target):
+    """
+    Finds the tree distance from every tip to a single target clade in one walk. Every tip branches off the
+    root-to-target path at its last common ancestor with the target, so carrying the depth of that ancestor down the
+    tree gives each tip's distance as depth(tip) + depth(target) - 2 * depth(ancestor)
+    :param tree: Tree read in by Bio.Phylo
+    :param target: Clade to measure distances to (i.e. the reference tip)
+    :return: tuple of (list of terminal clades, numpy array of distances to target in the same order)
+    """
+    on_path = set(id(clade) for clade in [tree.root] + tree.get_path(target))
+    target_depth = sum(clade.branch_length or 0.0 for clade in tree.get_path(target))
+    terminals = list()
+    distances = list()
+    # Stack holds (clade, depth of clade, depth of the last ancestor the clade shares with target)
+    stack = [(tree.root, 0.0, 0.0)]
+    while stack:
+        clade, depth, ancestor_depth = stack.pop()
+        if id(clade) in on_path:
+            ancestor_depth = depth
+        if clade.is_terminal():
+            terminals.append(clade)
+            distances.append(depth + target_depth - 2 * ancestor_depth)
+        for child in reversed(clade.clades):
+            stack.append((child, depth + (child.branch_length or 0.0), ancestor_depth))
+    return terminals, np.array(distances)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Resident worker for a single automator, meant to be left running on the nodes set aside for it (i.e. under
+supervisor). The automator and everything it imports are loaded once when the worker starts, along with any reference
+data in WARM_UPS. Jobs are then taken from the automator's queue in worker_queue, which api.py fills instead of
+submitting SLURM jobs for automators with 'worker': True in AUTOMATOR_KEYWORDS whenever a worker is up.
+
+Every job is run in a child forked off the warm worker, so it starts with everything already loaded but can't leave
+anything behind in the worker - a job that crashes, leaks or changes global state only takes its own child down.
+
+    python worker.py --automator strainmash --jobs 4
+"""
+import os
+import time
+import click
+import signal
+import importlib
+import traceback
+from cpu_allocation import allocated_cpus
+from batch_runner import automator_command, run_issue, report_failure
+from worker_queue import beat, claim_job, heartbeat_path, requeue_orphans, WORKER_QUEUE_DIR
+
+
+def preload_file(path, chunk_size=64 * 1024 * 1024):
+    """
+    Reads a file through once so that it is in the page cache when the tools run by the jobs (i.e. mash) read it
+    :param path: path to the file
+    :param chunk_size: number of bytes to read at a time
+    """
+    with open(path, 'rb') as f:
+        while f.read(chunk_size):
+            pass
+
+
+def warm_genus_caller():
+    from genus_caller import stage_sketch, REFSEQ_SKETCH
+    preload_file(stage_sketch(REFSEQ_SKETCH))
+
+
+def warm_strainmash():
+    from genus_caller import stage_sketch
+    from refseq_index import AccessionIndex
+    from strainmash import TYPESTRAIN_SKETCH
+    preload_file(stage_sketch(TYPESTRAIN_SKETCH))
+    # Rebuilds the accession index now if the assembly summary has changed, rather than in the first job. The
+    # connection is closed again since SQLite connections can't be shared with forked children
+    AccessionIndex().close()
+
+
+def warm_closerelatives():
+    from sketch_database import current_sketch
+    preload_file(current_sketch())
+
+
+# Reference data loaded when a worker starts, for the automators that have any
+WARM_UPS = {
+    'closerelatives': warm_closerelatives,
+    'pointfinder': warm_genus_caller,
+    'staramr': warm_genus_caller,
+    'strainmash': warm_strainmash,
+}
+
+
+def start_job(command, job, cpus):
+    """
+    Runs a job in a child forked off the worker
+    :param command: click command for the automator
+    :param job: dictionary of paths to the issue's pickles and work directory, as in the queue manifest
+    :param cpus: number of CPUs the job may use
+    :return: pid of the child
+    """
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        # The worker's own SIGTERM handler only stops it taking new jobs - jobs should just stop when signalled
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # Jobs size their thread pools from their SLURM allocation, so give them their share of the worker's CPUs the
+        # same way rather than letting every job use the whole node
+        os.environ['SLURM_CPUS_PER_TASK'] = str(cpus)
+        try:
+            if run_issue(command, job):
+                status = 0
+            else:
+                report_failure(job)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    return pid
+
+
+@click.command()
+@click.option('--automator', help='Name of the automator module to serve (i.e. strainmash)')
+@click.option('--jobs', default=1, help='Number of jobs to run at once')
+@click.option('--poll', default=5, help='Seconds to wait between checks of the queue')
+@click.option('--queue_dir', default=WORKER_QUEUE_DIR, help='Root folder of the worker queue')
+def worker(automator, jobs, poll, queue_dir):
+    start = time.time()
+    command = automator_command(importlib.import_module(automator))
+    if automator in WARM_UPS:
+        WARM_UPS[automator]()
+    print('{} worker ready in {:.1f}s'.format(automator, time.time() - start))
+    cpus = max(1, allocated_cpus() // jobs)
+
+    # SIGTERM stops the worker taking new jobs, and it exits once the ones it has are done
+    stopping = list()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+
+    # pid: (path to claimed manifest, job, time started)
+    children = dict()
+    try:
+        while not stopping or children:
+            # A stopping worker keeps beating until its jobs are done, so that they aren't requeued from under it
+            beat(automator, queue_dir, stopping=bool(stopping))
+
+            # Clear out finished jobs
+            while children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                claimed, job, started = children.pop(pid)
+                print('Finished {} in {:.1f}s with status {}'.format(job['work_dir'], time.time() - started, status))
+                if os.WIFSIGNALED(status):
+                    # The child was killed before it could say anything itself
+                    try:
+                        report_failure(job)
+                    except Exception:
+                        traceback.print_exc()
+                if os.path.isfile(claimed):
+                    os.remove(claimed)
+
+            # Jobs claimed by workers that have died go back in the queue
+            for requeued in requeue_orphans(automator, queue_dir):
+                print('Requeued {}'.format(requeued))
+
+            # Start new ones
+            while not stopping and len(children) < jobs:
+                claimed, job = claim_job(automator, queue_dir)
+                if claimed is None:
+                    break
+                print('Starting {}'.format(job['work_dir']))
+                children[start_job(command, job, cpus)] = (claimed, job, time.time())
+
+            time.sleep(poll)
+    finally:
+        if os.path.isfile(heartbeat_path(automator, queue_dir)):
+            os.remove(heartbeat_path(automator, queue_dir))
+
+
+if __name__ == '__main__':
+    worker()
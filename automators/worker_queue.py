@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import socket
+
+# Spool of jobs for resident workers. Each automator gets a folder with pending/ and running/ folders of job manifests,
+# and a workers/ folder with a heartbeat file for every worker serving it. It lives on the NAS so that api.py on the
+# head node and the workers on their own nodes all see it
+WORKER_QUEUE_DIR = '/mnt/nas2/redmine/worker_queue'
+# A worker that hasn't touched its heartbeat for this many seconds is taken to be gone
+HEARTBEAT_TIMEOUT = 120
+# Jobs that no worker has picked up after this many seconds are sent to SLURM by api.py instead
+PENDING_TIMEOUT = 10 * 60
+
+
+def automator_dir(automator, queue_dir=WORKER_QUEUE_DIR):
+    """
+    :param automator: name of the automator (i.e. strainmash)
+    :param queue_dir: root folder of the worker queue
+    :return: folder for the automator's queue, with its pending, running and workers folders created
+    """
+    folder = os.path.join(queue_dir, automator)
+    for subfolder in ('pending', 'running', 'workers'):
+        os.makedirs(os.path.join(folder, subfolder), exist_ok=True)
+    return folder
+
+
+def heartbeat_path(automator, queue_dir=WORKER_QUEUE_DIR):
+    """
+    :return: path to the heartbeat file for a worker running in this process
+    """
+    return os.path.join(automator_dir(automator, queue_dir), 'workers',
+                        '{host}_{pid}'.format(host=socket.gethostname(), pid=os.getpid()))
+
+
+def beat(automator, queue_dir=WORKER_QUEUE_DIR, stopping=False):
+    """
+    Marks the worker running in this process as alive
+    :param stopping: True if the worker is finishing the jobs it has and not taking new ones. It keeps beating until
+                     they're done, so that they aren't taken back off it
+    """
+    with open(heartbeat_path(automator, queue_dir), 'w') as f:
+        f.write('{} stopping'.format(time.time()) if stopping else str(time.time()))
+
+
+def worker_heartbeats(automator, queue_dir=WORKER_QUEUE_DIR):
+    """
+    :return: dictionary of {host}_{pid} name: whether the worker is taking jobs, for every worker of the automator that
+             has sent a heartbeat recently
+    """
+    workers_dir = os.path.join(queue_dir, automator, 'workers')
+    if not os.path.isdir(workers_dir):
+        return dict()
+    now = time.time()
+    heartbeats = dict()
+    for worker in os.listdir(workers_dir):
+        try:
+            if now - os.path.getmtime(os.path.join(workers_dir, worker)) < HEARTBEAT_TIMEOUT:
+                with open(os.path.join(workers_dir, worker)) as f:
+                    heartbeats[worker] = not f.read().endswith('stopping')
+        except OSError:  # Worker shut down and removed its heartbeat while we were looking
+            pass
+    return heartbeats
+
+
+def live_workers(automator, queue_dir=WORKER_QUEUE_DIR):
+    """
+    :return: number of workers for the automator that have sent a heartbeat recently and are taking jobs
+    """
+    return sum(worker_heartbeats(automator, queue_dir).values())
+
+
+def queue_job(automator, job, queue_dir=WORKER_QUEUE_DIR):
+    """
+    Adds a job to an automator's queue. The manifest is written under a temporary name and renamed into place, so
+    workers never see half of it
+    :param automator: name of the automator
+    :param job: dictionary of paths to the issue's redmine_instance, issue and description pickles, and its work_dir
+    :return: path to the queued manifest
+    """
+    pending = os.path.join(automator_dir(automator, queue_dir), 'pending')
+    name = '{time:.6f}_{issue}.json'.format(time=time.time(), issue=os.path.basename(job['work_dir']))
+    temp_manifest = os.path.join(pending, '.' + name)
+    with open(temp_manifest, 'w') as f:
+        json.dump(job, f)
+    os.rename(temp_manifest, os.path.join(pending, name))
+    return os.path.join(pending, name)
+
+
+def claim_job(automator, queue_dir=WORKER_QUEUE_DIR):
+    """
+    Takes the oldest pending job for an automator. Jobs are claimed by renaming them into running/, so when several
+    workers go for the same job only one of them gets it
+    :return: tuple of (path to the claimed manifest, job dictionary), or (None, None) if nothing is waiting
+    """
+    folder = automator_dir(automator, queue_dir)
+    for name in sorted(os.listdir(os.path.join(folder, 'pending'))):
+        if name.startswith('.'):
+            continue
+        claimed = os.path.join(folder, 'running', '{host}_{pid}_{name}'.format(host=socket.gethostname(),
+                                                                               pid=os.getpid(),
+                                                                               name=name))
+        try:
+            os.rename(os.path.join(folder, 'pending', name), claimed)
+        except OSError:  # Another worker got there first
+            continue
+        with open(claimed) as f:
+            return claimed, json.load(f)
+    return None, None
+
+
+def requeue_orphans(automator, queue_dir=WORKER_QUEUE_DIR):
+    """
+    Puts jobs claimed by workers that have since died (no recent heartbeat from the {host}_{pid} in the claimed name)
+    back in pending/ under their original name, so they keep their place in the queue
+    :return: list of paths to the requeued manifests
+    """
+    folder = automator_dir(automator, queue_dir)
+    heartbeats = worker_heartbeats(automator, queue_dir)
+    requeued = list()
+    for claimed in os.listdir(os.path.join(folder, 'running')):
+        # Claimed names are {host}_{pid}_{time}_{issue}.json, and neither the time nor the issue has an underscore
+        try:
+            worker, queued_time, issue = claimed.rsplit('_', 2)
+        except ValueError:
+            continue
+        if worker in heartbeats:
+            continue
+        name = '{}_{}'.format(queued_time, issue)
+        try:
+            os.rename(os.path.join(folder, 'running', claimed), os.path.join(folder, 'pending', name))
+        except OSError:  # Already requeued by someone else
+            continue
+        requeued.append(os.path.join(folder, 'pending', name))
+    return requeued
+
+
+def take_stale_jobs(automator, timeout=PENDING_TIMEOUT, queue_dir=WORKER_QUEUE_DIR):
+    """
+    Takes every pending job that has been waiting for longer than timeout off the queue, so that it can be run some
+    other way (i.e. on SLURM). Jobs are taken by renaming them to a hidden name that workers skip, so a job is either
+    claimed by a worker or taken here, never both
+    :param timeout: seconds a job can wait for a worker
+    :return: list of job dictionaries, oldest first
+    """
+    pending = os.path.join(automator_dir(automator, queue_dir), 'pending')
+    now = time.time()
+    jobs = list()
+    for name in sorted(os.listdir(pending)):
+        if name.startswith('.'):
+            continue
+        try:
+            queued = float(name.split('_')[0])
+        except ValueError:
+            continue
+        if now - queued < timeout:
+            continue
+        taken = os.path.join(pending, '.{}.taken'.format(name))
+        try:
+            os.rename(os.path.join(pending, name), taken)
+        except OSError:  # A worker got there first
+            continue
+        with open(taken) as f:
+            jobs.append(json.load(f))
+        os.remove(taken)
+    return jobs
@@ -0,0 +1,314 @@
+"""
+Checks that are made on a request when api.py picks it up, before anything is sent to the cluster. Each automator
+keyword in REQUEST_SCHEMAS has a list of rules. A rule gets the issue and its parsed description, and returns the note
+to post to Redmine if the request can't be run, or None if the request is fine as far as that rule is concerned.
+
+The notes are the same ones the automators post when they find these problems themselves - the automators keep their
+own checks, so jobs started by hand are still covered, and the option lists here need to be kept in step with them.
+"""
+import os
+import glob
+import logging
+from functools import partial
+from automators.autoroga_request import permitted_users, parse_request
+from automators.sketch_database import SKETCH_DATABASE_DIR, ASSEMBLY_GLOB, read_manifest
+
+
+class AssemblyIndex(object):
+    """
+    SeqIDs of every assembly on the NAS, read from the manifest of the current sketch database build. SeqIDs that aren't
+    in the manifest (i.e. they were assembled after the last build) are looked for on the NAS before they are reported
+    as missing
+    """
+    def __init__(self, database_dir=SKETCH_DATABASE_DIR, assembly_glob=ASSEMBLY_GLOB):
+        self.database_dir = database_dir
+        self.assembly_glob = assembly_glob
+        self.version_dir = None
+        self.seqids = set()
+
+    def refresh(self):
+        """
+        Re-reads the manifest if a new build of the sketch database has been made since it was last read
+        """
+        version_dir = os.path.realpath(os.path.join(self.database_dir, 'current'))
+        if version_dir != self.version_dir:
+            self.seqids = set(os.path.splitext(os.path.basename(path))[0] for path in read_manifest(version_dir))
+            self.version_dir = version_dir
+
+    def missing(self, seqids):
+        """
+        :param seqids: list of SeqIDs
+        :return: list of the SeqIDs that have no assembly on the NAS. Empty if the index can't be read, so that requests
+                 are never turned away just because the sketch database isn't available
+        """
+        self.refresh()
+        if not self.seqids:
+            return list()
+        missing = list()
+        for seqid in seqids:
+            if seqid in self.seqids:
+                continue
+            if glob.glob(os.path.join(os.path.dirname(self.assembly_glob), seqid + '.fasta')):
+                self.seqids.add(seqid)
+                continue
+            missing.append(seqid)
+        return missing
+
+
+assembly_index = AssemblyIndex()
+
+
+def parse_options(description, keywords, flags=()):
+    """
+    Splits a description made up of KEYWORD=value lines and SeqIDs the same way geneseekr and primer_finder do. Lines
+    are matched against the keywords in order, so keywords need to be listed in the same order the automator checks them
+    :param description: parsed redmine description list object
+    :param keywords: list of upper case keywords
+    :param flags: keywords that don't take a value
+    :return: tuple of (dictionary of lower case keyword: value, list of SeqIDs)
+    """
+    options = dict()
+    seqids = list()
+    for item in description:
+        item = item.upper().rstrip()
+        if item == '':
+            continue
+        for keyword in keywords:
+            if keyword in item:
+                if keyword in flags:
+                    options[keyword.lower()] = True
+                else:
+                    options[keyword.lower()] = item.split('=')[1].lower() if '=' in item else ''
+                break
+        else:
+            seqids.append(item)
+    return options, seqids
+
+
+def option_choice(parser, option, choices, invalid_note, missing_note=None, default=''):
+    """
+    :param parser: function that splits a description into options and SeqIDs
+    :param option: name of the option
+    :param choices: list of allowed values
+    :param invalid_note: note posted if the value isn't allowed. {value} is filled in with the value that was given
+    :param missing_note: note posted if the option isn't given at all. None if it has a default
+    :param default: value used if the option isn't given
+    :return: rule
+    """
+    def rule(issue, description):
+        options, seqids = parser(description)
+        value = options.get(option, default)
+        if not value and missing_note is not None:
+            return missing_note
+        if value not in choices:
+            return invalid_note.format(value=value)
+    return rule
+
+
+def option_required_for(parser, option, dependent, values, note):
+    """
+    :param parser: function that splits a description into options and SeqIDs
+    :param option: name of the option that has to be given
+    :param dependent: name of the option that decides whether it has to be given
+    :param values: values of dependent that need the option
+    :param note: note posted if the option is missing. {value} is filled in with the value of dependent
+    :return: rule
+    """
+    def rule(issue, description):
+        options, seqids = parser(description)
+        if options.get(dependent) in values and not options.get(option):
+            return note.format(value=options[dependent])
+    return rule
+
+
+def seqids_required(parser, note):
+    """
+    :param parser: function that splits a description into options and SeqIDs
+    :param note: note posted if the description has no SeqIDs
+    :return: rule
+    """
+    def rule(issue, description):
+        options, seqids = parser(description)
+        if not seqids:
+            return note
+    return rule
+
+
+def first_line_integer(note):
+    """
+    :param note: note posted if the first line of the description isn't a number. {first_line} is filled in with it
+    :return: rule
+    """
+    def rule(issue, description):
+        try:
+            int(description[0])
+        except ValueError:
+            return note.format(first_line=description[0])
+    return rule
+
+
+def diversitree_tree_program(issue, description):
+    seqids = [item.upper() for item in description[1:]]
+    if seqids and 'TREEPROGRAM' in seqids[-1]:
+        treemaker = seqids[-1].split('=')[1].lower()
+        if treemaker not in ['parsnp', 'mashtree']:
+            return 'Error! Available tree creation programs are mashtree and parsnp. ' \
+                   'Your choice was {}'.format(treemaker)
+
+
+def closerelatives_seqid(issue, description):
+    if len(description) > 1 and assembly_index.missing([description[1]]):
+        return 'Error! Could not find FASTA file for the specified SEQID. The SEQID' \
+               ' that you specified was: {}'.format(description[1])
+
+
+def reference_strain(issue, description):
+    """
+    Checks the reference strain of a snvphyl or cowsnphr request - there has to be exactly one, and unless it is
+    attached to the issue it has to be on the NAS
+    """
+    reference = list()
+    compare = False
+    for item in description:
+        item = item.upper()
+        if item == '':
+            continue
+        if 'COMPARE' in item:
+            compare = True
+            continue
+        if not compare and 'REFERENCE' not in item:
+            reference.append(item)
+    if len(reference) != 1:
+        return 'ERROR: You must specify one reference strain, and you ' \
+               'specified {} reference strains. Please create a new' \
+               ' issue and try again.'.format(len(reference))
+    if reference[0] != 'ATTACHED' and assembly_index.missing(reference):
+        return 'ERROR: Could not find the specified reference file.' \
+               ' Please verify it is a correct SEQID, create a new ' \
+               'issue, and try again.'
+
+
+def autoroga_author(issue, description):
+    if issue.author.id not in permitted_users:
+        return 'ERROR: Only authorized users are allowed to submit autoROGA requests.' \
+               'If you think you should be authorized, please contact andrew.low@canada.ca'
+
+
+def autoroga_reports(issue, description):
+    try:
+        report_specs, force_flag = parse_request(description)
+    except ValueError as e:
+        return str(e)
+    seqids = list()
+    for report_spec in report_specs:
+        seqids += [seqid for seqid in report_spec['seqids'] if seqid not in seqids]
+    missing = assembly_index.missing(seqids)
+    if missing:
+        return 'ERROR: Could not find one or more of the provided Seq IDs on the NAS.\n' \
+               'TRACEBACK: {}'.format(', '.join(missing))
+
+
+# Options for geneseekr and primer_finder, in the order the automators look for them
+geneseekr_options = partial(parse_options,
+                            keywords=['ALIGN', 'BLAST', 'CUTOFF', 'EVALUE', 'UNIQUE', 'ORGANISM', 'ANALYSIS', 'FASTA'],
+                            flags=['ALIGN', 'FASTA'])
+GENESEEKR_ANALYSES = ['custom', 'gdcs', 'genesippr', 'mlst', 'resfinder', 'rmlst', 'serosippr', 'sixteens',
+                      'virulence']
+GENESEEKR_BLASTS = ['blastn', 'blastp', 'blastx', 'tblastn', 'tblastx']
+
+primer_finder_options = partial(parse_options,
+                                keywords=['PROGRAM', 'ANALYSIS', 'MISMATCHES', 'KMERSIZE', 'FORMAT', 'EXPORTAMPLICONS'],
+                                flags=['EXPORTAMPLICONS'])
+PRIMER_FINDER_PROGRAMS = ['legacy', 'supremacy']
+PRIMER_FINDER_ANALYSES = ['vtyper', 'custom']
+PRIMER_FINDER_FORMATS = ['fasta', 'fastq']
+PRIMER_FINDER_MISMATCHES = ['0', '1', '2', '3']
+PRIMER_FINDER_DOCS = 'https://olc-bioinformatics.github.io/redmine-docs/analysis/primerfinder/'
+
+REQUEST_SCHEMAS = {
+    'autoroga': [
+        autoroga_author,
+        autoroga_reports,
+    ],
+    'diversitree': [
+        first_line_integer('Error! The first line of your request must be the number of'
+                           ' strains you want picked from the tree.'),
+        diversitree_tree_program,
+    ],
+    'closerelatives': [
+        first_line_integer('Error! The first line of the description must be the number'
+                           ' of strains you want to find. The first line of your '
+                           'description was: {first_line}'),
+        closerelatives_seqid,
+    ],
+    'geneseekr': [
+        option_required_for(geneseekr_options, 'organism', 'analysis', ['gdcs', 'mlst', 'cgmlst'],
+                            'ERROR: Analysis type {value} requires the genus to be used for the '
+                            'analyses. Please create a new issue with organism=ORGANISM '
+                            'included in the issue.'),
+        option_choice(geneseekr_options, 'analysis', GENESEEKR_ANALYSES,
+                      missing_note='WARNING: Could not identify an analysis type. '
+                                   'Please ensure that the first line of the issue contains one'
+                                   ' of the following keywords: ' + ', '.join(GENESEEKR_ANALYSES),
+                      invalid_note='WARNING: supplied analysis type {value} current not in the supported '
+                                   'list of analyses: ' + ', '.join(GENESEEKR_ANALYSES)),
+        option_choice(geneseekr_options, 'blast', GENESEEKR_BLASTS, default='blastn',
+                      invalid_note='WARNING: requested BLAST analysis, {value}, is not one of the currently '
+                                   'supported analyses: ' + ', '.join(GENESEEKR_BLASTS)),
+        seqids_required(geneseekr_options, 'WARNING: No SEQIDs provided!'),
+    ],
+    'primer_finder': [
+        option_choice(primer_finder_options, 'program', PRIMER_FINDER_PROGRAMS,
+                      missing_note='WARNING: No program type provided. Please ensure that issue contains '
+                                   '"program=requested_program", where requested_program is one of the '
+                                   'following keywords: ' + ','.join(PRIMER_FINDER_PROGRAMS) +
+                                   '. Please see the the usage guide: ' + PRIMER_FINDER_DOCS +
+                                   ' for additional details',
+                      invalid_note='WARNING: Requested program type: {value} not in list of supported analyses: ' +
+                                   ','.join(PRIMER_FINDER_PROGRAMS) + '. Please see ' + PRIMER_FINDER_DOCS +
+                                   ' for additional details'),
+        option_choice(primer_finder_options, 'analysis', PRIMER_FINDER_ANALYSES,
+                      missing_note='WARNING: No analysis type provided. Please ensure that issue contains '
+                                   '"analysistype=requested_analysis_type", where requested_analysis_type is one of '
+                                   'the following keywords: ' + ','.join(PRIMER_FINDER_ANALYSES) +
+                                   '. Please see the the usage guide: ' + PRIMER_FINDER_DOCS +
+                                   ' for additional details',
+                      invalid_note='WARNING: Requested analysis type: {value} not in list of supported analyses: ' +
+                                   ','.join(PRIMER_FINDER_ANALYSES) + '. Please see ' + PRIMER_FINDER_DOCS +
+                                   ' for additional details'),
+        option_choice(primer_finder_options, 'format', PRIMER_FINDER_FORMATS, default='fasta',
+                      invalid_note='WARNING: Requested file format {value} not in list of supported formats: ' +
+                                   ','.join(PRIMER_FINDER_FORMATS) + '. Please see ' + PRIMER_FINDER_DOCS +
+                                   ' for additional details'),
+        option_choice(primer_finder_options, 'mismatches', PRIMER_FINDER_MISMATCHES, default='2',
+                      invalid_note='WARNING: Requested number of mismatches, {value}, is not in the acceptable range '
+                                   'of allowed mismatches: ' + ','.join(PRIMER_FINDER_MISMATCHES) + '. Please see ' +
+                                   PRIMER_FINDER_DOCS + ' for additional details'),
+    ],
+    'snvphyl': [
+        reference_strain,
+    ],
+    'cowsnphr': [
+        reference_strain,
+    ],
+}
+
+
+def validate_request(issue, job_type, description):
+    """
+    Runs the rules for a request's automator, stopping at the first one that fails
+    :param issue: object pulled from Redmine instance
+    :param job_type: automator keyword for the issue (i.e. 'diversitree')
+    :param description: parsed redmine description list object
+    :return: note to post to Redmine if the request can't be run, or None if it should be sent to the cluster
+    """
+    for rule in REQUEST_SCHEMAS.get(job_type, list()):
+        try:
+            note = rule(issue, description)
+        except Exception as e:
+            # Anything the rules don't understand is left for the automator to deal with
+            logging.error('Could not check {} request {}: {}'.format(job_type, issue.id, e))
+            return None
+        if note is not None:
+            return note
+    return None
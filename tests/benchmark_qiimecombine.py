@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Times the qiimecombine filtering/pruning/ordering steps against the way they used to be done, on a synthetic set of
+runs shaped like QIIME2 level CSVs, and checks that both give the same results.csv.
+"""
+import numpy as np
+import pandas as pd
+import argparse
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'automators'))
+from qiimecombine import filter_run, combine_runs
+
+
+def synthetic_runs(num_runs, samples_per_run, taxa_per_run, total_taxa, seed=0):
+    random = np.random.RandomState(seed)
+    taxa = ['D_0__Bacteria;D_1__Phylum{};D_2__Class{}'.format(i % 40, i) for i in range(total_taxa)]
+    sample_types = ['meat', 'Water', 'Soil', 'dairy', 'Environmental swab']
+    runs = list()
+    for run in range(num_runs):
+        run_taxa = sorted(random.choice(taxa, taxa_per_run, replace=False))
+        counts = random.poisson(2, size=(samples_per_run, taxa_per_run))
+        counts[:, random.rand(taxa_per_run) < 0.3] = 0
+        df = pd.DataFrame(counts, columns=run_taxa)
+        df.insert(0, 'index', ['R{}S{}'.format(run, i) for i in range(samples_per_run)])
+        df['sample type'] = random.choice(sample_types, samples_per_run)
+        df['Location'] = random.choice(['Ottawa', 'Guelph', 'Calgary'], samples_per_run)
+        df['Empty'] = 0
+        runs.append(df)
+    return runs
+
+
+def legacy_combine(dataframes, column_headers, column_contents, operators):
+    dataframe_list = list()
+    for df in dataframes:
+        df = df.copy()
+        for column in df.columns:
+            df.rename(columns={column: column.replace(' ', '_').upper()}, inplace=True)
+        df = df.apply(lambda x: x.astype(str).str.upper())
+        for j in range(len(column_headers)):
+            if operators[j] == 'equals':
+                df = df.loc[df[column_headers[j]] == column_contents[j]]
+            elif operators[j] == 'contains':
+                df = df.loc[df[column_headers[j]].str.contains(column_contents[j])]
+        dataframe_list.append(df)
+    result_df = pd.concat(dataframe_list, ignore_index=True, sort=False)
+    result_df.fillna(0, inplace=True)
+    columns_to_drop = list()
+    for column in result_df.columns:
+        all_zeros = True
+        for item in result_df[column]:
+            if str(item) != '0':
+                all_zeros = False
+        if all_zeros is True:
+            columns_to_drop.append(column)
+    result_df = result_df.drop(columns_to_drop, axis=1)
+    output_column_order = ['INDEX']
+    for column in result_df.columns:
+        if column.startswith('D_'):
+            output_column_order.append(column)
+    for column in result_df.columns:
+        if column != 'INDEX' and not column.startswith('D_'):
+            output_column_order.append(column)
+    return result_df[output_column_order]
+
+
+def vectorized_combine(dataframes, column_headers, column_contents, operators):
+    return combine_runs([filter_run(df, column_headers, column_contents, operators) for df in dataframes])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=500, help='Number of synthetic runs')
+    parser.add_argument('--samples', type=int, default=48, help='Number of samples per run')
+    parser.add_argument('--taxa', type=int, default=200, help='Number of taxa seen in each run')
+    parser.add_argument('--total_taxa', type=int, default=1000, help='Number of taxa across all runs')
+    args = parser.parse_args()
+
+    dataframes = synthetic_runs(args.runs, args.samples, args.taxa, args.total_taxa)
+    filters = (['SAMPLE_TYPE', 'LOCATION'], ['MEAT', 'O'], ['equals', 'contains'])
+    results = dict()
+    for name, combine in [('legacy', legacy_combine), ('vectorized', vectorized_combine)]:
+        start = time.time()
+        results[name] = combine(dataframes, *filters)
+        print('{}: {:.2f}s ({} rows x {} columns)'.format(name, time.time() - start, *results[name].shape))
+    assert results['legacy'].to_csv(index=False) == results['vectorized'].to_csv(index=False)
+    print('results.csv is identical')
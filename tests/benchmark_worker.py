@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+Compares starting automator jobs cold, the way a SLURM job does (new interpreter, all the imports, reference data read
+from scratch), with handing them to a warm worker (fork of a process that already has all of that loaded). Queueing
+and virtualenv activation on SLURM come on top of the cold numbers.
+
+Run on a node with the automator environment. With --manifest, a real job (as written to the worker queue) is run both
+ways as well - it should be a request that doesn't mind being run twice.
+"""
+import subprocess
+import argparse
+import time
+import json
+import sys
+import os
+
+AUTOMATORS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'automators')
+sys.path.insert(0, AUTOMATORS_DIR)
+from batch_runner import automator_command, run_issue
+from worker import WARM_UPS
+
+
+def cold_start(automator):
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', 'import {}'.format(automator)], cwd=AUTOMATORS_DIR)
+    return time.time() - start
+
+
+def warm_start():
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    return time.time() - start
+
+
+def cold_job(automator, job):
+    start = time.time()
+    subprocess.call([sys.executable, os.path.join(AUTOMATORS_DIR, automator + '.py'),
+                     '--redmine_instance', job['redmine_instance'],
+                     '--issue', job['issue'],
+                     '--work_dir', job['work_dir'],
+                     '--description', job['description']])
+    return time.time() - start
+
+
+def warm_job(command, job):
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if run_issue(command, job) else 1)
+    os.waitpid(pid, 0)
+    return time.time() - start
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('automator', help='Name of the automator to benchmark (i.e. strainmash)')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of times to time each start')
+    parser.add_argument('--manifest', help='Path to a job manifest to also time a full job both ways')
+    args = parser.parse_args()
+
+    print('cold start (imports): {:.3f}s'.format(median([cold_start(args.automator) for _ in range(args.repeats)])))
+
+    start = time.time()
+    module = __import__(args.automator)
+    command = automator_command(module)
+    if args.automator in WARM_UPS:
+        WARM_UPS[args.automator]()
+    print('worker warm up (imports + reference data, paid once): {:.3f}s'.format(time.time() - start))
+    print('warm start (fork): {:.3f}s'.format(median([warm_start() for _ in range(args.repeats)])))
+
+    if args.manifest:
+        with open(args.manifest) as f:
+            job = json.load(f)
+        print('cold job: {:.3f}s'.format(cold_job(args.automator, job)))
+        print('warm job: {:.3f}s'.format(warm_job(command, job)))
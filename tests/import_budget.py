@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+Keeps the time it takes to import each automator in check. Every job starts a fresh interpreter, so anything imported
+at the top of an automator is paid for before it can post anything back to Redmine - heavy dependencies should be
+loaded with automators/lazy_import.py instead.
+
+Import times come from python -X importtime, taking the fastest of a few runs. Run in the automator virtualenv:
+
+    python tests/import_budget.py              # check every automator against its budget
+    python tests/import_budget.py --record     # measure every automator and write new budgets
+    python tests/import_budget.py --report ec_typer autoroga   # show the slowest imports for some automators
+
+Automators without a budget are only listed, and skipped if they can't be imported where the check is run (i.e. a
+checkout without automator_settings.py, or without their dependencies installed). An automator that has a budget has to
+import, so a broken import fails the check.
+"""
+import subprocess
+import argparse
+import json
+import glob
+import sys
+import os
+
+AUTOMATORS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'automators')
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_budgets.json')
+
+
+def import_times(module):
+    """
+    :param module: name of the automator module
+    :return: tuple of (cumulative import time of the module in ms, list of (ms, name) for the modules it pulled in
+             directly), or (None, error) if it couldn't be imported
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            cwd=AUTOMATORS_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        return None, result.stderr.strip().split('\n')[-1]
+    total = None
+    direct = list()
+    # Modules are listed after everything they import, indented two spaces per level, so the level 1 entries since
+    # the last top level one are the direct imports of the next top level module
+    children = list()
+    for line in result.stderr.split('\n'):
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        if depth == 1:
+            children.append((int(cumulative) / 1000, name.strip()))
+        elif depth == 0:
+            if name.strip() == module:
+                total = int(cumulative) / 1000
+                direct = children
+            children = list()
+    return total, sorted(direct, reverse=True)
+
+
+def measure(module, repeats):
+    """
+    :return: fastest of several import times for the module in ms, and the breakdown from that run
+    """
+    best = (None, None)
+    for _ in range(repeats):
+        total, detail = import_times(module)
+        if total is None:
+            return total, detail
+        if best[0] is None or total < best[0]:
+            best = (total, detail)
+    return best
+
+
+def automators():
+    """
+    :return: names of every module in the automators folder
+    """
+    paths = glob.glob(os.path.join(AUTOMATORS_DIR, '*.py'))
+    return sorted(os.path.splitext(os.path.basename(path))[0] for path in paths if not path.endswith('__init__.py'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='*', help='Automators to look at. Defaults to every automator')
+    parser.add_argument('--record', action='store_true', help='Write new budgets from the current import times')
+    parser.add_argument('--headroom', type=float, default=1.5, help='Budgets are the measured time times this...')
+    parser.add_argument('--slack', type=float, default=50, help='...plus this many ms, so that noise on a busy node '
+                                                                'doesn\'t fail the check')
+    parser.add_argument('--report', action='store_true', help='List the slowest imports of each automator')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of times to import each automator')
+    args = parser.parse_args()
+
+    budgets = dict()
+    if os.path.isfile(BUDGET_FILE):
+        with open(BUDGET_FILE) as f:
+            budgets = json.load(f)
+    modules = args.modules or automators()
+
+    failures = list()
+    skipped = list()
+    for module in modules:
+        total, detail = measure(module, args.repeats)
+        if total is None:
+            if module in budgets and not args.record:
+                print('{:<32} import failed: {}'.format(module, detail))
+                failures.append(module)
+            else:
+                print('{:<32} skipped, import failed: {}'.format(module, detail))
+                skipped.append(module)
+            continue
+        if args.record:
+            budgets[module] = int(total * args.headroom + args.slack)
+            print('{:<32} {:8.1f} ms  budget {} ms'.format(module, total, budgets[module]))
+        elif module in budgets:
+            over = total > budgets[module]
+            print('{:<32} {:8.1f} ms  budget {} ms{}'.format(module, total, budgets[module], '  OVER' if over else ''))
+            if over:
+                failures.append(module)
+        else:
+            print('{:<32} {:8.1f} ms  no budget'.format(module, total))
+        if args.report:
+            for ms, name in detail[:10]:
+                print('    {:8.1f} ms  {}'.format(ms, name))
+
+    if args.record:
+        with open(BUDGET_FILE, 'w') as f:
+            json.dump(budgets, f, indent=4, sort_keys=True)
+            f.write('\n')
+    if skipped:
+        print('Skipped, could not be imported here: {}'.format(', '.join(skipped)))
+    if failures:
+        print('Over budget or failed to import: {}'.format(', '.join(failures)))
+        sys.exit(1)
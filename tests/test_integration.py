@@ -4,13 +4,15 @@ from validator_helper import validate
 from redminelib import Redmine
 import urllib.request
 import sentry_sdk
-import hashlib
 import argparse
 import tempfile
 import logging
 import zipfile
 import time
+import sys
 import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'automators'))
+from fingerprint import file_sha256
 
 """
 Test script to make sure that adding an automator/changing some dependency somewhere doesn't break all the things.
@@ -92,8 +94,8 @@ def validate_csv_content(query_csv, ref_csv):
         column_list = validate.find_all_columns(csv_file=ref_csv, columns_to_exclude=[], range_fraction=0.05, separator='\t')
     else:
         column_list = validate.find_all_columns(csv_file=ref_csv, columns_to_exclude=[], range_fraction=0.05)
-    if 'ec_typer_report.tsv' in ref_csv:  # EC typer report doesn't play nicely with validator helper, so just take an md5sum
-        if md5(ref_csv) == md5(query_csv):
+    if 'ec_typer_report.tsv' in ref_csv:  # EC typer report doesn't play nicely with validator helper, so just take a sha256
+        if file_sha256(ref_csv) == file_sha256(query_csv):
             return True
         else:
             return False
@@ -136,18 +138,6 @@ def validate_attachments(issue, file_to_find, validate_content=False):
     return validation_status
 
 
-def md5(fname):
-    """
-    Gets MD5sum for a file - use for quick and dirty comparisons of files.
-    Hooray for stackoverflow: https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
-    """
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-
 def validate_csv_in_zip(issue, zip_file, report_file, ref_csv):
     """
     Crude validation that checks that CSV contents are the exact same between some folder in a zip
@@ -169,7 +159,7 @@ def validate_csv_in_zip(issue, zip_file, report_file, ref_csv):
                     attachment.download(savepath=tmpdir, filename=zip_file)
                     zipped_archive = zipfile.ZipFile(downloaded_zip)
                     zipped_archive.extractall(path=tmpdir)
-                    if md5(ref_csv) == md5(os.path.join(tmpdir, report_file)):
+                    if file_sha256(ref_csv) == file_sha256(os.path.join(tmpdir, report_file)):
                         validation_status = 'Validated'
                     else:
                         validation_status = 'Contents not identical. Check on what changed.'
@@ -268,7 +258,7 @@ def monitor_issues(redmine, issue_dict, timeout):
             # DIVERSITREE #####
             elif issue_subject == 'diversitree' and issues_validated[issue_subject] == 'Unknown':
                 if issue.status.id == 4:
-                    # TODO: HTML validation - should just be able to md5sum or something on file contents.
+                    # TODO: HTML validation - should just be able to sha256 or something on file contents.
                     issues_validated[issue_subject] = validate_attachments(issue, 'diversitree_report.html')
                     logging.info('{} is complete, status is {}'.format(issue_subject, issues_validated[issue_subject]))
                 else: